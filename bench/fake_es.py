@@ -0,0 +1,542 @@
+"""
+In-memory stand-in for the parts of the Elasticsearch HTTP API our scripts use:
+`_mget`, `_msearch` with term queries, sort on `id` and `search_after`, `_bulk`,
+index create/delete/exists, `_mapping`, `_settings`, `_refresh`, aliases,
+`_reindex`, `_forcemerge`, `_tasks` and `_delete_by_query` with term, terms,
+range and bool queries.
+
+Not an Elasticsearch: no scoring, no analysis, only what the scripts send.
+Responses carry the `X-Elastic-Product` header the python client insists on.
+
+Latency and failures can be injected per request, and every request is counted
+by endpoint, so benchmarks can report how many round trips a run needed.
+
+$ python -m bench.fake_es --port 9200 --nodes nodes.jsonl --edges edges.jsonl
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from bisect import bisect_right
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from bench.synth import NODE_PROPS, EDGE_PROPS
+from utils import codec
+from utils.constants import NODE_INDEX, EDGE_INDEX, ADJ_INDEX
+from utils.projection import project_source
+
+
+OPERATORS = {
+    "gt": lambda value, bound: value > bound,
+    "gte": lambda value, bound: value >= bound,
+    "lt": lambda value, bound: value < bound,
+    "lte": lambda value, bound: value <= bound,
+}
+
+
+class Store:
+    """
+    Indices, aliases and finished tasks, guarded by one lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indices = {}
+        self.aliases = {}
+        self.tasks = {}
+        # (index, field) -> {value: docs sorted by id}, dropped whenever the index changes
+        self.postings = {}
+
+    def create(self, name: str, body: dict):
+        self.indices[name] = {
+            "mappings": body.get("mappings", {"properties": {}}),
+            "settings": body.get("settings", {}),
+            "docs": {},
+        }
+
+    def resolve(self, name: str) -> list[str]:
+        if name in self.indices:
+            return [name]
+
+        return sorted(index for index, aliases in self.aliases.items() if name in aliases)
+
+    def get_index(self, name: str) -> tuple[str, dict] | None:
+        resolved = self.resolve(name)
+        if len(resolved) != 1:
+            return None
+
+        return resolved[0], self.indices[resolved[0]]
+
+    def changed(self, name: str):
+        for key in [key for key in self.postings if key[0] == name]:
+            del self.postings[key]
+
+    def get_postings(self, name: str, field: str) -> dict:
+        key = (name, field)
+        postings = self.postings.get(key)
+        if postings is None:
+            postings = {}
+            for doc_id, source in self.indices[name]["docs"].items():
+                value = source.get(field)
+                if isinstance(value, str):
+                    postings.setdefault(value, []).append((doc_id, source))
+            for hits in postings.values():
+                hits.sort(key=lambda hit: hit[0])
+            self.postings[key] = postings
+
+        return postings
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0, reject_rate=0.0, seed=None):
+        super().__init__(address, Handler)
+        self.store = Store()
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+
+        self.counts = Counter()
+        self.docs = Counter()
+        self.counts_lock = threading.Lock()
+
+    def count(self, endpoint: str, docs=0):
+        with self.counts_lock:
+            self.counts[endpoint] += 1
+            self.docs[endpoint] += docs
+
+    def get_stats(self) -> dict:
+        with self.counts_lock:
+            return {"requests": dict(self.counts), "docs": dict(self.docs)}
+
+    def reset_stats(self):
+        with self.counts_lock:
+            self.counts.clear()
+            self.docs.clear()
+
+    def load(self, name: str, docs, props: dict | None = None):
+        """
+        Put docs straight into an index, bypassing http.
+        """
+        with self.store.lock:
+            self.store.create(name, {"mappings": {"properties": props or {}}})
+            index_docs = self.store.indices[name]["docs"]
+            for doc in docs:
+                index_docs[doc["id"]] = doc
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeElasticsearch
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method: str):
+        url = urlsplit(self.path)
+        # task ids like fake:1 come percent-encoded
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        server = self.server
+        delay = server.latency_ms + server.random.uniform(0, server.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+
+        try:
+            status, response = route(server, method, parts, query, body)
+        except KeyError as e:
+            status, response = 404, error("index_not_found_exception", f"no such index [{e.args[0]}]", 404)
+        except Exception as e:
+            status, response = 500, error("exception", repr(e), 500)
+
+        self.send(method, status, response)
+
+    def send(self, method: str, status: int, response):
+        payload = b"" if response is None else codec.dumps(response)
+
+        self.send_response(status)
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(payload)
+
+
+def error(error_type: str, reason: str, status: int) -> dict:
+    return {"error": {"type": error_type, "reason": reason}, "status": status}
+
+
+def iter_ndjson(body: bytes):
+    for line in body.splitlines():
+        if line.strip():
+            yield codec.loads(line)
+
+
+def route(server: FakeElasticsearch, method: str, parts: list[str], query: dict, body: bytes):
+    store = server.store
+
+    if not parts:
+        server.count("info")
+        return 200, {"name": "fake", "cluster_name": "fake", "version": {"number": "8.17.0"}, "tagline": "You Know, for Search"}
+
+    endpoint = parts[-1] if parts[-1].startswith("_") else None
+
+    # injected failures only hit data endpoints, like an overloaded cluster would
+    if endpoint in ("_mget", "_msearch", "_bulk") and server.random.random() < server.fail_rate:
+        server.count(f"{endpoint}_failed")
+        return 429, error("es_rejected_execution_exception", "injected rejection", 429)
+
+    if endpoint == "_mget":
+        return mget(server, parts[0], codec.loads(body), query.get("_source_includes"))
+    if endpoint == "_msearch":
+        return msearch(server, parts[0] if len(parts) > 1 else None, body)
+    if endpoint == "_bulk":
+        return bulk(server, parts[0] if len(parts) > 1 else None, body)
+
+    with store.lock:
+        return admin(server, method, parts, query, codec.loads(body) if body else {})
+
+
+def mget(server: FakeElasticsearch, name: str, body: dict, source_includes: str | None = None):
+    store = server.store
+    fields = source_includes.split(",") if source_includes else None
+    ids = body.get("ids") or [doc["_id"] for doc in body.get("docs", [])]
+
+    with store.lock:
+        found = store.get_index(name)
+        if found is None:
+            raise KeyError(name)
+        concrete, index = found
+        docs = index["docs"]
+
+        response = []
+        for _id in ids:
+            source = docs.get(_id)
+            if source is None:
+                response.append({"_index": concrete, "_id": _id, "found": False})
+            else:
+                response.append({"_index": concrete, "_id": _id, "_version": 1, "found": True, "_source": project_source(source, fields)})
+
+    server.count("_mget", len(ids))
+    return 200, {"docs": response}
+
+
+def search(server: FakeElasticsearch, name: str, request: dict) -> dict:
+    store = server.store
+    found = store.get_index(name)
+    if found is None:
+        return error("index_not_found_exception", f"no such index [{name}]", 404)
+    concrete, index = found
+
+    size = request.get("size", 10)
+    term = request.get("query", {}).get("term")
+
+    if term:
+        field, value = next(iter(term.items()))
+        if isinstance(value, dict):
+            value = value["value"]
+        field = field.removesuffix(".keyword")
+        hits = store.get_postings(concrete, field).get(value, [])
+    else:
+        hits = sorted(index["docs"].items())
+
+    # the scripts always sort on id
+    start = 0
+    search_after = request.get("search_after")
+    if search_after:
+        start = bisect_right([hit[0] for hit in hits], search_after[0])
+
+    page = hits[start:start + size]
+
+    return {
+        "took": 1,
+        "timed_out": False,
+        "hits": {
+            "total": {"value": len(hits), "relation": "eq"},
+            "hits": [{"_index": concrete, "_id": doc_id, "_source": source, "sort": [doc_id]} for doc_id, source in page],
+        },
+        "status": 200,
+    }
+
+
+def msearch(server: FakeElasticsearch, default_index: str | None, body: bytes):
+    lines = list(iter_ndjson(body))
+    responses = []
+    total_hits = 0
+
+    with server.store.lock:
+        for header, request in zip(lines[0::2], lines[1::2]):
+            response = search(server, header.get("index", default_index), request)
+            total_hits += len(response.get("hits", {}).get("hits", []))
+            responses.append(response)
+
+    server.count("_msearch", total_hits)
+    return 200, {"took": 1, "responses": responses}
+
+
+def bulk(server: FakeElasticsearch, default_index: str | None, body: bytes):
+    store = server.store
+    lines = iter_ndjson(body)
+    items = []
+    errors = False
+    touched = set()
+
+    with store.lock:
+        for meta in lines:
+            op_type, action = next(iter(meta.items()))
+            doc = None if op_type == "delete" else next(lines)
+
+            name = action.get("_index", default_index)
+            doc_id = action.get("_id") or uuid.uuid4().hex
+            item = {"_index": name, "_id": doc_id}
+
+            if server.random.random() < server.reject_rate:
+                item.update(status=429, error={"type": "es_rejected_execution_exception", "reason": "injected rejection"})
+                items.append({op_type: item})
+                errors = True
+                continue
+
+            found = store.get_index(name)
+            if found is None:
+                # like auto create
+                store.create(name, {})
+                found = store.get_index(name)
+
+            concrete, index = found
+            docs = index["docs"]
+            item["_index"] = concrete
+            touched.add(concrete)
+
+            if op_type in ("index", "create"):
+                status = 200 if doc_id in docs else 201
+                if op_type == "create" and doc_id in docs:
+                    item.update(status=409, error={"type": "version_conflict_engine_exception", "reason": "exists"})
+                    errors = True
+                else:
+                    docs[doc_id] = doc
+                    item.update(status=status, result="created" if status == 201 else "updated")
+            elif op_type == "update":
+                if doc_id not in docs and not doc.get("doc_as_upsert"):
+                    item.update(status=404, error={"type": "document_missing_exception", "reason": f"[{doc_id}]: document missing"})
+                    errors = True
+                else:
+                    docs[doc_id] = {**docs.get(doc_id, {}), **doc.get("doc", {})}
+                    item.update(status=200, result="updated")
+            elif op_type == "delete":
+                found_doc = docs.pop(doc_id, None) is not None
+                item.update(status=200 if found_doc else 404, result="deleted" if found_doc else "not_found")
+
+            items.append({op_type: item})
+
+        for name in touched:
+            store.changed(name)
+
+    server.count("_bulk", len(items))
+    return 200, {"took": 1, "errors": errors, "items": items}
+
+
+def admin(server: FakeElasticsearch, method: str, parts: list[str], query: dict, body: dict):
+    store = server.store
+    first = parts[0]
+
+    if first == "_alias" and len(parts) == 2:
+        server.count("_alias")
+        matched = {index: {"aliases": {parts[1]: {}}} for index in store.resolve(parts[1]) if index != parts[1]}
+        if not matched:
+            return 404, None if method == "HEAD" else error("aliases_not_found_exception", parts[1], 404)
+        return 200, None if method == "HEAD" else matched
+
+    if first == "_aliases":
+        server.count("_aliases")
+        for action in body["actions"]:
+            op, spec = next(iter(action.items()))
+            if op == "add":
+                store.aliases.setdefault(spec["index"], set()).add(spec["alias"])
+            elif op == "remove":
+                store.aliases.get(spec["index"], set()).discard(spec["alias"])
+            elif op == "remove_index":
+                store.indices.pop(spec["index"], None)
+                store.aliases.pop(spec["index"], None)
+        return 200, {"acknowledged": True}
+
+    if first == "_tasks":
+        server.count("_tasks")
+        return 200, store.tasks[parts[1]]
+
+    if first == "_reindex":
+        server.count("_reindex")
+        source = store.get_index(body["source"]["index"])[1]
+        dest = store.get_index(body["dest"]["index"])[1]
+        dest["docs"].update({doc_id: dict(doc) for doc_id, doc in source["docs"].items()})
+        store.changed(body["dest"]["index"])
+        return finish_task(store, {"created": len(source["docs"]), "failures": []})
+
+    if len(parts) == 1:
+        name = first
+        server.count(f"index_{method.lower()}")
+
+        if method == "HEAD":
+            return (200 if name in store.indices else 404), None
+        if method == "PUT":
+            if name in store.indices:
+                return 400, error("resource_already_exists_exception", f"index [{name}] already exists", 400)
+            store.create(name, body)
+            return 200, {"acknowledged": True, "index": name}
+        if method == "DELETE":
+            if name not in store.indices:
+                raise KeyError(name)
+            del store.indices[name]
+            store.aliases.pop(name, None)
+            store.changed(name)
+            return 200, {"acknowledged": True}
+
+    name, endpoint = first, parts[1]
+    server.count(endpoint)
+
+    found = store.get_index(name)
+    if found is None:
+        raise KeyError(name)
+    concrete, index = found
+
+    if endpoint == "_mapping":
+        return 200, {concrete: {"mappings": index["mappings"]}}
+    if endpoint == "_settings":
+        if method == "PUT":
+            index["settings"].update(body)
+            return 200, {"acknowledged": True}
+        return 200, {concrete: {"settings": index["settings"]}}
+    if endpoint == "_refresh":
+        return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+    if endpoint == "_forcemerge":
+        return finish_task(store, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+    if endpoint == "_count":
+        return 200, {"count": len(index["docs"])}
+    if endpoint == "_delete_by_query":
+        query = prepare_query(body["query"])
+        deleted = [doc_id for doc_id, source in index["docs"].items() if matches(source, query)]
+        for doc_id in deleted:
+            del index["docs"][doc_id]
+        store.changed(concrete)
+        return 200, {"took": 1, "deleted": len(deleted), "version_conflicts": 0, "failures": []}
+
+    return 400, error("illegal_argument_exception", f"unsupported endpoint {method} /{'/'.join(parts)}", 400)
+
+
+def prepare_query(query: dict) -> dict:
+    """
+    The query with terms lists turned into sets, it gets matched against every doc.
+    """
+    kind, spec = next(iter(query.items()))
+
+    if kind == "terms":
+        field, values = next(iter(spec.items()))
+        return {kind: {field: set(values)}}
+    if kind == "bool":
+        return {kind: {key: [prepare_query(sub) for sub in subs] for key, subs in spec.items()}}
+
+    return query
+
+
+def matches(source: dict, query: dict) -> bool:
+    kind, spec = next(iter(query.items()))
+
+    if kind == "term":
+        field, value = next(iter(spec.items()))
+        return source.get(field) == (value["value"] if isinstance(value, dict) else value)
+    if kind == "terms":
+        field, values = next(iter(spec.items()))
+        value = source.get(field)
+        return isinstance(value, str) and value in values
+    if kind == "range":
+        field, bounds = next(iter(spec.items()))
+        value = source.get(field)
+        return value is not None and all(OPERATORS[op](value, bound) for op, bound in bounds.items())
+    if kind == "bool":
+        must = spec.get("must", []) + spec.get("filter", [])
+        should = spec.get("should", [])
+        return all(matches(source, sub) for sub in must) and (not should or any(matches(source, sub) for sub in should))
+
+    raise ValueError(f"unsupported query {kind}")
+
+
+def finish_task(store: Store, response: dict):
+    # everything runs inline, so tasks are done by the time anyone asks
+    task_id = f"fake:{len(store.tasks) + 1}"
+    store.tasks[task_id] = {"completed": True, "task": {"status": {}}, "response": response}
+
+    return 200, {"task": task_id}
+
+
+def load_jsonl(path: str):
+    with open(path, "rb") as f:
+        for line in f:
+            yield codec.loads(line)
+
+
+def start(port=0, latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0, reject_rate=0.0, seed=None) -> FakeElasticsearch:
+    """
+    Start a server on a background thread; `server.server_address` has the actual port.
+    """
+    server = FakeElasticsearch(("127.0.0.1", port), latency_ms, jitter_ms, fail_rate, reject_rate, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--nodes", help="nodes.jsonl to load into rtx_kg2_nodes and the adjacency index")
+    parser.add_argument("--edges", help="edges.jsonl to load into rtx_kg2_edges")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Random extra latency, up to this much")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of mget/msearch/bulk requests rejected with 429")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Share of bulk items rejected with 429")
+    args = parser.parse_args()
+
+    server = FakeElasticsearch(("127.0.0.1", args.port), args.latency_ms, args.jitter_ms, args.fail_rate, args.reject_rate)
+
+    if args.nodes:
+        nodes = list(load_jsonl(args.nodes))
+        server.load(NODE_INDEX, nodes, NODE_PROPS)
+        server.load(ADJ_INDEX, (dict(node) for node in nodes), NODE_PROPS)
+    if args.edges:
+        server.load(EDGE_INDEX, load_jsonl(args.edges), EDGE_PROPS)
+
+    print(f"Fake es on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.get_stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+End to end benchmarks against the fake es in bench/fake_es.py.
+
+For every size, synthetic data is generated once. Then for every worker count
+and script, a fresh fake es is loaded with it and the script runs as a
+subprocess in its own scratch dir, exactly as it would against su12. Each case
+records wall time, edges/sec or nodes/sec, peak RSS of the whole process tree
+and request counts per endpoint, plus the stage breakdown from the run's own
+metrics report. Results of one invocation go to a single json file, named by
+time and commit, so runs from different commits can be compared.
+
+$ python -m bench.run --sizes 20000,100000 --workers 2,4
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+
+from bench import fake_es
+from bench.synth import generate, NODE_PROPS, EDGE_PROPS
+from utils.constants import NODE_INDEX, EDGE_INDEX, ADJ_INDEX
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {
+    "merge": "merge_index.py",
+    "adjacency": "merge_adjacency_list.py",
+}
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def watch_rss(process: subprocess.Popen, peak: dict, interval=0.1):
+    """
+    Track the peak summed RSS of a process and all its children, until it exits.
+    """
+    try:
+        root = psutil.Process(process.pid)
+    except psutil.NoSuchProcess:
+        return
+
+    while process.poll() is None:
+        total = 0
+        try:
+            for proc in [root, *root.children(recursive=True)]:
+                try:
+                    total += proc.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+        except psutil.NoSuchProcess:
+            break
+
+        peak["rss"] = max(peak["rss"], total)
+        time.sleep(interval)
+
+
+def start_server(data: dict, args) -> fake_es.FakeElasticsearch:
+    server = fake_es.start(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                           fail_rate=args.fail_rate, reject_rate=args.reject_rate, seed=args.seed)
+
+    nodes = list(fake_es.load_jsonl(data["nodes"]))
+    server.load(NODE_INDEX, nodes, NODE_PROPS)
+    # what clean_slate would have copied over as the adjacency base
+    server.load(ADJ_INDEX, (dict(node) for node in nodes), NODE_PROPS)
+    server.load(EDGE_INDEX, fake_es.load_jsonl(data["edges"]), EDGE_PROPS)
+
+    return server
+
+
+def read_metrics_report(case_dir: str) -> dict | None:
+    reports = glob.glob(f"{case_dir}/runs/*/metrics.json")
+    if not reports:
+        return None
+
+    with open(reports[0]) as f:
+        return json.load(f)
+
+
+def run_case(script: str, mode: str, workers: int, data: dict, case_dir: str, args) -> dict:
+    os.makedirs(case_dir, exist_ok=True)
+    shutil.copy(data["node_ids"], f"{case_dir}/nodes_id.bin")
+
+    server = start_server(data, args)
+    port = server.server_address[1]
+
+    env = {
+        **os.environ,
+        "SERVER": "127.0.0.1",
+        "PORT": str(port),
+        "OUTPUT_DIR": "./output",
+        "EDGE_FILE": data["edges"],
+        "INDEX_NAME": "rtx_kg2_edges_merged",
+        "NESTED_INDEX_NAME": "rtx_kg2_edges_merged_nested",
+        "ADJACENCY_LIST_INDEX_NAME": ADJ_INDEX,
+        "N_WORKERS": str(workers),
+        "PROD": "true" if mode == "prod" else "false",
+        "PYTHONPATH": REPO_DIR,
+    }
+
+    command = [sys.executable, f"{REPO_DIR}/{SCRIPTS[script]}"]
+    if script == "merge":
+        command.append(data["edges"])
+
+    with open(f"{case_dir}/stdout.log", "w") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=case_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        peak = {"rss": 0}
+        watcher = threading.Thread(target=watch_rss, args=(process, peak), daemon=True)
+        watcher.start()
+
+        try:
+            returncode = process.wait(timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            returncode = process.wait()
+
+        seconds = time.perf_counter() - started
+        watcher.join()
+
+    stats = server.get_stats()
+    server.shutdown()
+    server.server_close()
+
+    report = read_metrics_report(case_dir)
+    counters = report["counters"] if report else {}
+
+    if script == "merge":
+        edges = data["num_edges"]
+        nodes = None
+    else:
+        edges = None
+        nodes = counters.get("adj_nodes")
+
+    return {
+        "script": script,
+        "mode": mode,
+        "workers": workers,
+        "num_edges": data["num_edges"],
+        "num_nodes": data["num_nodes"],
+        "returncode": returncode,
+        "seconds": round(seconds, 3),
+        "edges_per_sec": round(edges / seconds, 1) if edges else None,
+        "nodes_per_sec": round(nodes / seconds, 1) if nodes else None,
+        "peak_rss_mb": round(peak["rss"] / 2 ** 20, 1),
+        "requests": stats["requests"],
+        # ids for mget, hits for msearch, items for bulk
+        "request_docs": stats["docs"],
+        "stages": {name: {"count": stage["count"], "seconds": stage["seconds"], "docs_per_sec": stage["docs_per_sec"]}
+                   for name, stage in (report["stages"].items() if report else [])},
+        "counters": counters,
+    }
+
+
+def print_row(row: dict):
+    rate = f"{row['edges_per_sec']} edges/s" if row["script"] == "merge" else f"{row['nodes_per_sec']} nodes/s"
+    requests = sum(row["requests"].values())
+    status = "ok" if row["returncode"] == 0 else f"exit {row['returncode']}"
+    print(f"{row['script']:>9} {row['mode']:>4} edges={row['num_edges']:<9} workers={row['workers']:<3} "
+          f"{row['seconds']:>8.2f}s {rate:>20} rss={row['peak_rss_mb']}MB requests={requests} {status}")
+
+
+def parse_ints(value: str) -> list[int]:
+    return [int(part) for part in value.split(",") if part]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=parse_ints, default=[20000, 100000], help="Edge counts, comma separated")
+    parser.add_argument("--edges-per-node", type=float, default=5, help="Nodes generated per size are edges / this")
+    parser.add_argument("--workers", type=parse_ints, default=[2, 4], help="Worker counts, comma separated")
+    parser.add_argument("--scripts", default="merge,adjacency", help="Comma separated, out of: " + ", ".join(SCRIPTS))
+    parser.add_argument("--modes", default="dev", help="merge_index modes, comma separated: dev writes files, prod bulk loads")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of node degrees")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of mget/msearch/bulk requests rejected")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Share of bulk items rejected")
+    parser.add_argument("--timeout", type=float, default=3600, help="Seconds before a case is killed")
+    parser.add_argument("--work-dir", default="bench_work", help="Scratch space for data and runs")
+    parser.add_argument("--out", default=f"{REPO_DIR}/bench/results", help="Directory for result files")
+    args = parser.parse_args()
+
+    scripts = args.scripts.split(",")
+    modes = args.modes.split(",")
+    commit = get_commit()
+    started_at = time.strftime("%Y%m%d-%H%M%S")
+
+    results = []
+    for size in args.sizes:
+        num_nodes = max(1, int(size / args.edges_per_node))
+        data_dir = f"{args.work_dir}/data-{size}"
+        print(f"Generating {num_nodes} nodes, {size} edges")
+        data = generate(data_dir, num_nodes, size, skew=args.skew, seed=args.seed)
+        data = {key: os.path.abspath(value) if isinstance(value, str) else value for key, value in data.items()}
+
+        for workers in args.workers:
+            for script in scripts:
+                # adjacency has no dev/prod split, it always writes to es
+                for mode in (modes if script == "merge" else ["-"]):
+                    case_dir = os.path.abspath(f"{args.work_dir}/{started_at}/{script}-{mode}-{size}-{workers}")
+                    row = run_case(script, mode, workers, data, case_dir, args)
+                    print_row(row)
+                    results.append(row)
+
+    os.makedirs(args.out, exist_ok=True)
+    out_path = f"{args.out}/{started_at}-{commit}.json"
+    with open(out_path, "w") as f:
+        json.dump({
+            "commit": commit,
+            "started_at": started_at,
+            "config": {key: value for key, value in vars(args).items() if key not in ("out", "work_dir")},
+            "results": results,
+        }, f, indent=2)
+
+    print(f"Results in {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Synthetic knowledge graph shaped like rtx-kg2: nodes with a handful of fields,
+edges whose endpoints follow a Zipf-like degree distribution, so a few hub
+nodes carry a large share of the edges.
+
+$ python -m bench.synth --nodes 20000 --edges 100000 --out bench_data
+"""
+
+import argparse
+import json
+import os
+import random
+from itertools import accumulate
+
+from utils.node_ids import write_node_id_file
+
+CATEGORIES = ["biolink:Gene", "biolink:Protein", "biolink:Disease", "biolink:ChemicalEntity", "biolink:Pathway",
+              "biolink:PhenotypicFeature", "biolink:Cell", "biolink:AnatomicalEntity"]
+PREDICATES = ["biolink:interacts_with", "biolink:related_to", "biolink:treats", "biolink:causes",
+              "biolink:subclass_of", "biolink:has_phenotype", "biolink:located_in", "biolink:affects"]
+SOURCES = ["infores:semmeddb", "infores:chembl", "infores:uniprot", "infores:go", "infores:drugbank"]
+WORDS = ["kinase", "receptor", "alpha", "beta", "protein", "factor", "binding", "domain", "family", "member",
+         "syndrome", "type", "acid", "cell", "pathway", "response", "regulation", "complex", "channel", "transport"]
+
+TEXT = {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}}
+
+NODE_PROPS = {
+    "id": TEXT,
+    "name": TEXT,
+    "category": TEXT,
+    "all_names": TEXT,
+    "iri": TEXT,
+    "description": TEXT,
+    "publications": TEXT,
+}
+
+EDGE_PROPS = {
+    "id": TEXT,
+    "subject": TEXT,
+    "object": TEXT,
+    "predicate": TEXT,
+    "primary_knowledge_source": TEXT,
+    "knowledge_level": TEXT,
+    "agent_type": TEXT,
+    "publications": TEXT,
+    "domain_range_exclusion": {"type": "boolean"},
+}
+
+
+def get_node_id(index: int) -> str:
+    return f"SYN:{index:09d}"
+
+
+def get_edge_id(index: int) -> str:
+    return f"SYNE:{index:010d}"
+
+
+def make_words(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+
+def make_node(rng: random.Random, index: int) -> dict:
+    node_id = get_node_id(index)
+    name = make_words(rng, 1, 4)
+
+    return {
+        "id": node_id,
+        "name": name,
+        "category": rng.choice(CATEGORIES),
+        "all_names": [name, make_words(rng, 1, 4)],
+        "iri": f"https://example.org/{node_id}",
+        "description": make_words(rng, 5, 40),
+        "publications": [f"PMID:{rng.randint(1, 40000000)}" for _ in range(rng.randint(0, 5))],
+    }
+
+
+def make_edge(rng: random.Random, index: int, subject: str, obj: str) -> dict:
+    return {
+        "id": get_edge_id(index),
+        "subject": subject,
+        "object": obj,
+        "predicate": rng.choice(PREDICATES),
+        "primary_knowledge_source": rng.choice(SOURCES),
+        "knowledge_level": "knowledge_assertion",
+        "agent_type": "manual_agent",
+        "publications": [f"PMID:{rng.randint(1, 40000000)}" for _ in range(rng.randint(0, 3))],
+        "domain_range_exclusion": False,
+    }
+
+
+def generate(out_dir: str, num_nodes: int, num_edges: int, skew=1.1, seed=0) -> dict:
+    """
+    Write nodes.jsonl, edges.jsonl and nodes_id.bin into `out_dir`.
+
+    Endpoints are drawn with weight 1 / rank ** skew, over a shuffled ranking so
+    hubs are spread through the id space rather than bunched at the start.
+
+    :return: paths and sizes of what was written
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    ranking = list(range(num_nodes))
+    rng.shuffle(ranking)
+    cum_weights = list(accumulate(1 / (rank + 1) ** skew for rank in range(num_nodes)))
+
+    nodes_path = f"{out_dir}/nodes.jsonl"
+    edges_path = f"{out_dir}/edges.jsonl"
+    ids_path = f"{out_dir}/nodes_id.bin"
+
+    with open(nodes_path, "w") as f:
+        for index in range(num_nodes):
+            f.write(json.dumps(make_node(rng, index)) + "\n")
+
+    degrees = [0] * num_nodes
+    with open(edges_path, "w") as f:
+        for index in range(num_edges):
+            subject, obj = (ranking[rank] for rank in rng.choices(range(num_nodes), cum_weights=cum_weights, k=2))
+            degrees[subject] += 1
+            degrees[obj] += 1
+            f.write(json.dumps(make_edge(rng, index, get_node_id(subject), get_node_id(obj))) + "\n")
+
+    write_node_id_file(ids_path, map(get_node_id, range(num_nodes)))
+
+    return {
+        "nodes": nodes_path,
+        "edges": edges_path,
+        "node_ids": ids_path,
+        "num_nodes": num_nodes,
+        "num_edges": num_edges,
+        "max_degree": max(degrees, default=0),
+        "skew": skew,
+        "seed": seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=20000)
+    parser.add_argument("--edges", type=int, default=100000)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of the degree distribution")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_data")
+    args = parser.parse_args()
+
+    print(json.dumps(generate(args.out, args.nodes, args.edges, args.skew, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
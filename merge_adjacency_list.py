@@ -1,38 +1,66 @@
 import argparse
 import asyncio
 import json
-import math
 import multiprocessing
-import sys
-import uuid
+import os
+import time
+from collections.abc import Sequence
 from multiprocessing.managers import ListProxy
-from time import sleep
 
 from elastic_transport import ObjectApiResponse
 from elasticsearch import Elasticsearch, helpers, AsyncElasticsearch
 from elasticsearch.helpers import BulkIndexError
 
+from utils.adjacency import NodeActionBuilder, StaleBuckets, make_node_actions, collect_failed_updates
+from utils.adjacency_changes import run_changes
+from utils.adjacency_external import run_external
+from utils.adjacency_scan import run_scan
+from utils import codec
 from utils.benchmark import timeit
+from utils.checkpoint import RunManifest, get_run_id
+from utils.degrees import get_degree_table, fetch_degrees, plan_work_units
 from utils.env import check_is_prod, get_es_url
-from utils.es import created_adjacency_list_index
-from utils.constants import EDGE_INDEX, ADJ_INDEX
+from utils.es import created_adjacency_list_index, get_es_client, get_async_es_client, publish_index
+from utils.constants import EDGE_INDEX, ADJ_MSEARCH_PACK
+from utils.executor import add_executor_args, get_executor, get_worker_resource, close_worker_loop
+from utils.metrics import get_metrics, get_metrics_snapshot, report_metrics
+from utils.node_ids import open_node_ids, take_range, get_default_node_id_file
 from utils.parallel import get_n_workers
 
+POSITION_DIRECTIONS = {"subject": "out", "object": "in"}
 
-def clean_slate(es_url: str):
-    migrate = created_adjacency_list_index(es_url)
+
+def clean_slate(es_url: str, version: str) -> str:
+    build_name, migrate = created_adjacency_list_index(es_url, version)
 
     # migrate data from nodes to adj_list as a base
     migrate()
 
-
-def get_run_id():
-    return uuid.uuid4().hex[:10]
+    return build_name
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch", type=int, help="Index of the batch to process")
+    parser.add_argument("--engine", choices=["node", "scan", "external", "changes"], default="node",
+                        help="node: query edges per node; scan: read the whole edge index once and group locally; "
+                             "external: build from an edges jsonl file with an on-disk sort; "
+                             "changes: apply added, changed and removed edges to the nodes they touch")
+    parser.add_argument("--edges-file", help="Path to edges.jsonl, required by the external engine")
+    parser.add_argument("--changes", help="Path to an edge changes jsonl file, required by the changes engine, see utils.adjacency_changes")
+    parser.add_argument("--output", help="External engine only: write adjacency docs to this jsonl file instead of es")
+    parser.add_argument("--degrees", help="Node engine: degree table json used to balance work, built from es if missing")
+    parser.add_argument("--pack", type=int, default=ADJ_MSEARCH_PACK,
+                        help="Node engine: nodes whose first pages are fetched in one msearch, 1 to query node by node")
+    parser.add_argument("--degree-agg", action="store_true", help="Node engine: fetch degrees of the selected nodes with a terms aggregation")
+    parser.add_argument("--resume", metavar="RUN_ID", help="Node engine: resume an unfinished run, skipping work units it already completed")
+    parser.add_argument("--node-ids", help="Node engine: node id file from utils/node_id_extractor.py, ./nodes_id.bin by default")
+    parser.add_argument("--retry-failed", metavar="PATH", help="Node and changes engines: process the nodes listed in a failed_nodes_<run_id>.json file")
+    parser.add_argument("--new-build", action="store_true", help="Create a new build of the adjacency index, seeded with nodes, and write into it")
+    parser.add_argument("--target-index", help="Write into this index build instead of the live index")
+    parser.add_argument("--publish", metavar="INDEX", help="Make a finished index build live by swapping the alias over, then exit")
+    parser.add_argument("--force-merge", action="store_true", help="With --publish: force merge the build before it goes live")
+    add_executor_args(parser, default="process")
 
     args = parser.parse_args()
 
@@ -40,79 +68,197 @@ def main():
 
     es_url = get_es_url()
     # clean_slate(es_url)
-    run_id = get_run_id()
+    run_id = get_run_id() if args.resume is None else args.resume
 
     total_workers = get_n_workers()
-    # how many async actions allowed per worker
-    concurrency_limit = 5
-    progress_array = multiprocessing.Array('i', [0] * total_workers)
 
-    limit = 10000
-    # limit = 1500
+    if args.publish is not None:
+        publish_index(es_url, os.getenv("ADJACENCY_LIST_INDEX_NAME"), args.publish, force_merge=args.force_merge)
+        return
 
-    # node_id_file = './10k_nodes_id.json'
-    node_id_file = './nodes_id.json'
+    if args.new_build:
+        assert args.resume is None, "--new-build starts a new run"
+        args.target_index = clean_slate(es_url, run_id)
+        # nodes are all written for the first time, no stale buckets to look for
+        os.environ["ADJ_NEW_BUILD"] = "true"
+        print(f'Loading into {args.target_index}, pass --target-index {args.target_index} to later runs and --publish {args.target_index} when done')
 
+    if args.target_index is not None:
+        # worker processes inherit it, see utils.adjacency.get_adj_index
+        os.environ["ADJACENCY_TARGET_INDEX"] = args.target_index
 
-    if args.batch is not None:
-        node_ids = get_node_ids_for_batch(node_id_file, args.batch)
-    else:
-        node_ids = get_node_ids(node_id_file, limit)
+    if args.engine != "node":
+        assert args.resume is None, "--resume only works with the node engine"
+        assert args.retry_failed is None or args.engine == "changes", "--retry-failed only works with the node and changes engines"
+
+    if args.engine == "changes":
+        assert args.changes is not None, "--engine changes needs --changes"
+        only_nodes = select_node_ids(None, None, None, args.retry_failed) if args.retry_failed is not None else None
+
+        started = time.perf_counter()
+        with get_executor(args.executor, total_workers, args.scheduler) as executor, timeit(f'{run_id} changes engine'):
+            failed_nodes = run_changes(es_url, args.changes, executor, only_nodes)
+
+            if failed_nodes:
+                print(f'{len(failed_nodes)} nodes failed')
+                write_failed_nodes(failed_nodes, run_id)
+
+            metric_snapshots = list(executor.run_on_workers(get_metrics_snapshot).values())
+
+        report_metrics("adjacency", run_id, metric_snapshots, time.perf_counter() - started)
+        return
+
+    if args.engine == "scan":
+        started = time.perf_counter()
+        with multiprocessing.Manager() as manager, timeit(f'{run_id} scan engine'):
+            failed_nodes = manager.list()
+            metric_snapshots = manager.list()
+            run_scan(es_url, total_workers, failed_nodes, metric_snapshots)
+
+            if failed_nodes:
+                print(f'{len(failed_nodes)} nodes failed')
+                write_failed_nodes(failed_nodes, run_id)
+
+            metric_snapshots = list(metric_snapshots)
+
+        report_metrics("adjacency", run_id, metric_snapshots, time.perf_counter() - started)
+        return
+
+    if args.engine == "external":
+        assert args.edges_file is not None, "--engine external needs --edges-file"
+
+        started = time.perf_counter()
+        with multiprocessing.Manager() as manager, timeit(f'{run_id} external engine'):
+            failed_nodes = manager.list()
+            metric_snapshots = manager.list()
+            if args.output is not None:
+                run_external(args.edges_file, total_workers, failed_nodes, metric_snapshots, output_file=args.output)
+            else:
+                run_external(args.edges_file, total_workers, failed_nodes, metric_snapshots, es_url=es_url)
 
-    total_nodes = len(node_ids)
-    nodes_per_worker = math.ceil(total_nodes / total_workers)
+            if failed_nodes:
+                print(f'{len(failed_nodes)} nodes failed')
+                write_failed_nodes(failed_nodes, run_id)
 
-    # Start monitor
-    monitor_proc = multiprocessing.Process(target=monitor_progress, args=(progress_array, total_nodes, run_id))
-    monitor_proc.start()
+            metric_snapshots = list(metric_snapshots)
 
-    with multiprocessing.Manager() as manager, timeit(f'{run_id} process {total_nodes} nodes'):
-        # create container for failed nodes
-        failed_nodes = manager.list()
+        report_metrics("adjacency", run_id, metric_snapshots, time.perf_counter() - started)
+        return
 
-        # Spawn workers
-        workers = []
-        for i in range(total_workers):
-            start = i * nodes_per_worker
-            end = min(start + nodes_per_worker, total_nodes)
-            chunk = node_ids[start:end]
+    # how many async actions allowed per worker
+    concurrency_limit = 5
+
+    if args.resume is not None:
+        # same nodes and units as the original run
+        manifest = RunManifest.load(run_id, "adjacency")
+        params = manifest.params
+        node_ids = select_node_ids(params["node_id_file"], params["batch"], params["limit"], params["retry_failed"])
+        units = [tuple(unit) for unit in params["units"]]
+        args.pack = params["pack"]
+        if params.get("target_index") is not None:
+            os.environ["ADJACENCY_TARGET_INDEX"] = params["target_index"]
+
+        progress = manifest.get_progress()
+        completed_units = {entry["unit"] for entry in progress}
+        previously_failed = [node_id for entry in progress for node_id in entry["failed"]]
+        print(f'Resuming run {run_id}: {len(completed_units)}/{len(units)} work units already completed')
+    else:
+        limit = 10000
+        # limit = 1500
+
+        # node_id_file = './10k_nodes_id.json'
+        node_id_file = args.node_ids or get_default_node_id_file()
+
+        node_ids = select_node_ids(node_id_file, args.batch, limit, args.retry_failed)
+
+        # estimate work per node so hub nodes do not pile up in one worker
+        degrees = None
+        if args.degrees is not None:
+            degrees = get_degree_table(get_es_client(es_url, request_timeout=300), args.degrees)
+        elif args.degree_agg:
+            with timeit(f'fetch degrees of {len(node_ids)} nodes'):
+                degrees = fetch_degrees(get_es_client(es_url, request_timeout=300), node_ids)
+
+        units = plan_work_units(node_ids, degrees, total_workers, min_unit_cost=args.pack)
+
+        manifest = RunManifest.create(run_id, "adjacency", {
+            "node_id_file": node_id_file,
+            "batch": args.batch,
+            "limit": limit,
+            "retry_failed": args.retry_failed,
+            "pack": args.pack,
+            "units": units,
+            "target_index": args.target_index,
+        })
+        completed_units = set()
+        previously_failed = []
+        print(f'Run {run_id}, resume with --resume {run_id}')
+
+    pending_units = [(index, start, end) for index, (start, end) in enumerate(units) if index not in completed_units]
+    total_nodes = sum(end - start for _, start, end in pending_units)
+
+    started = time.perf_counter()
+    with get_executor(args.executor, total_workers, args.scheduler) as executor, timeit(f'{run_id} process {total_nodes} nodes'):
+        print(f'{len(pending_units)} work units for {executor.n_workers} workers')
+
+        # units go out heaviest first, idle workers pick up the next one instead of owning a fixed chunk
+        tasks = {
+            unit_index: (es_url, concurrency_limit, args.pack, take_range(node_ids, start, end))
+            for unit_index, start, end in pending_units
+        }
+        unit_ranges = {unit_index: (start, end) for unit_index, start, end in pending_units}
 
-            p = multiprocessing.Process(target=run_per_worker, args=(es_url, concurrency_limit, chunk, progress_array, failed_nodes, i))
-            p.start()
-            workers.append(p)
+        failed_nodes = list(previously_failed)
+        for unit_index, (_, unit_failed) in executor.run_tasks(run_unit, tasks, label=f"Run {run_id}", count=lambda result: result[0], unit="nodes"):
+            failed_nodes.extend(unit_failed)
+            # only now is the whole unit acknowledged by es
+            manifest.record({"unit": unit_index, "failed": unit_failed})
 
-        # Wait for all workers to finish
-        for p in workers:
-            p.join()
+        # a unit that blew up as a whole stays pending for --resume, its nodes count as failed
+        for failure in executor.failures:
+            print(f'work unit {failure.key} failed on {failure.worker}: {failure.error}')
+            start, end = unit_ranges[failure.key]
+            failed_nodes.extend(node_ids[start:end])
 
         if failed_nodes:
             print(f'{len(failed_nodes)} nodes failed')
             write_failed_nodes(failed_nodes, run_id)
 
+        metric_snapshots = list(executor.run_on_workers(get_metrics_snapshot).values())
+        executor.run_on_workers(close_worker_loop)
 
-    monitor_proc.join()
+    report_metrics("adjacency", run_id, metric_snapshots, time.perf_counter() - started)
 
-def write_failed_nodes(failed_nodes: ListProxy, run_id: str):
+def write_failed_nodes(failed_nodes: ListProxy | list, run_id: str):
     with open(f'./failed_nodes_{run_id}.json', 'w', encoding='utf-8') as f:
         json.dump(list(failed_nodes), f)
 
-def get_node_ids_for_batch(target_file: str, batch_index: int, num_of_batches=5):
+def select_node_ids(node_id_file: str, batch_index: int | None, limit: int | None, retry_failed: str | None):
+    if retry_failed is not None:
+        with open(retry_failed, "rb") as f:
+            # a node can fail more than once, e.g. for several of its buckets
+            return list(dict.fromkeys(codec.load(f)))
+
+    if batch_index is not None:
+        return get_node_ids_for_batch(node_id_file, batch_index)
+
+    return get_node_ids(node_id_file, limit)
+
+def get_node_ids_for_batch(target_file: str, batch_index: int, num_of_batches=5) -> Sequence[str]:
     assert 0 <= batch_index < num_of_batches
 
-    with open(target_file, "rb") as f:
-        full_ids = json.load(f)
+    full_ids = open_node_ids(target_file)
 
     total_len = len(full_ids)
     k, m = divmod(total_len, num_of_batches)
     start = batch_index * k + min(batch_index, m)
     end = start + k + (1 if batch_index < m else 0)
 
-    return full_ids[start:end]
+    return take_range(full_ids, start, end)
 
 
-def get_node_ids(target_file: str, limit: int | None):
-    with open(target_file, "rb") as f:
-        full_ids = json.load(f)
+def get_node_ids(target_file: str, limit: int | None) -> Sequence[str]:
+    full_ids = open_node_ids(target_file)
 
 
     if limit is None:
@@ -120,80 +266,92 @@ def get_node_ids(target_file: str, limit: int | None):
 
 
     # only use partial ids for testing
-    node_ids = full_ids[:limit]
-    del full_ids
+    return take_range(full_ids, 0, limit)
 
-    return node_ids
 
-
-def monitor_progress(progress_array, total_count: int, run_id: str):
-    while True:
-        sleep(1)
-        current_total = sum(progress_array)
-        print(f"Run {run_id} progress: {current_total}/{total_count} nodes processed", end='\r', flush=True)
-        if current_total >= total_count:
-            print()  # newline after complete
-            break
-
-async def generate_actions(es_client: AsyncElasticsearch, concurrency_limit: int, nodes_ids: list[str], progress_array: list, failed_nodes: list, worker_id:int):
+async def generate_actions(es_client: AsyncElasticsearch, concurrency_limit: int, pack_size: int, nodes_ids: list[str], failed_nodes: list, stale_buckets: StaleBuckets):
     semaphore = asyncio.Semaphore(concurrency_limit)
+    # bounded, so fetching waits for bulk to catch up
+    actions = asyncio.Queue(maxsize=concurrency_limit * 2)
+    done = object()
 
-    async def process_with_semaphore(_node_id: str):
+    async def process_with_semaphore(_node_ids: list[str]):
         async with semaphore:
-            payload, total_edges = await process_single_node(es_client, _node_id)
-            progress_array[worker_id] += 1
-            return payload, _node_id
+            if len(_node_ids) == 1:
+                is_processed = await process_single_node(es_client, _node_ids[0], actions)
+                failed = [] if is_processed else _node_ids
+            else:
+                failed = await process_packed_nodes(es_client, _node_ids, actions)
 
-    tasks_generator = (process_with_semaphore(node_id) for node_id in nodes_ids)
+        for _node_id in failed:
+            print(f'something wrong with {_node_id}')
+            failed_nodes.append(_node_id)
 
-    for coro in asyncio.as_completed(tasks_generator):
-        payload, node_id = await coro
-        if payload is not None:
-            yield payload
-        else:
-            print(f'something wrong with {node_id}')
-            failed_nodes.append(node_id)
+    packs = [nodes_ids[i:i + pack_size] for i in range(0, len(nodes_ids), pack_size)]
+
+    async def produce():
+        try:
+            await asyncio.gather(*(process_with_semaphore(pack) for pack in packs))
+        finally:
+            await actions.put(done)
+
+    producer = asyncio.create_task(produce())
+
+    while (action := await actions.get()) is not done:
+        stale_buckets.note(action)
+        yield action
 
+    await producer
+
+
+# one event loop per worker process, so its async client outlives single units
+def run_unit(es_url: str, concurrency_limit: int, pack_size: int, node_ids: Sequence[str]) -> tuple[int, list[str]]:
+    loop = get_worker_resource("event_loop", asyncio.new_event_loop)
+
+    return loop.run_until_complete(process_unit(es_url, concurrency_limit, pack_size, node_ids))
 
-# async wrapper for worker task
-def run_per_worker(*args):
-    asyncio.run(per_worker(*args))
 
 # entry point for paral. work
-async def per_worker(es_url:str, *args):
-    async_es_client = AsyncElasticsearch(es_url, request_timeout=300)
+async def process_unit(es_url: str, concurrency_limit: int, pack_size: int, node_ids: Sequence[str]) -> tuple[int, list[str]]:
+    """
+    Build and write adjacency docs of one work unit.
+
+    :return: number of nodes processed, ids of nodes that failed
+    """
+    async_es_client = get_worker_resource("async_es_client", lambda: get_async_es_client(es_url, request_timeout=300))
 
     # settings = await async_es_client.indices.get_settings(index="rtx_kg2_nodes_adjacency_list")
     # clean_print("nested objects limit", settings["rtx_kg2_nodes_adjacency_list"]["settings"]["index"]["mapping"]['nested_objects']['limit'])
 
-    actions_generated = generate_actions(async_es_client, *args)
+    unit_failed = []
+    stale_buckets = StaleBuckets()
+    actions_generated = generate_actions(async_es_client, concurrency_limit, pack_size, list(node_ids), unit_failed, stale_buckets)
 
     # test to consume the async generator
     # _ = [_ async for _ in actions_generated]
 
-    successful_count, errors = await helpers.async_bulk(
-        async_es_client,
-        actions_generated,
-        raise_on_error=False,
-        max_chunk_bytes = 90 * 1024 * 1024
-    )
+    # fetching and writing overlap, so this times the unit as a whole
+    with get_metrics().stage("adj_unit") as sample:
+        successful_count, errors = await helpers.async_bulk(
+            async_es_client,
+            actions_generated,
+            raise_on_error=False,
+            max_chunk_bytes = 90 * 1024 * 1024
+        )
+        sample["docs"] = successful_count
 
     if errors:
-        for failure in errors:
-            action = failure["update"]
-            error = action.get("error", {})
-            doc_id = action.get("_id", "<unknown>")
+        # append to failed nodes
+        collect_failed_updates(errors, unit_failed)
 
-            clean_print(f"❌ Failed document ID: {doc_id}")
-            clean_print(f"   Reason: {error.get('type')} - {error.get('reason')}")
+    # buckets the nodes had before this build and don't anymore
+    with get_metrics().stage("adj_stale_buckets") as sample:
+        sample["docs"] = await stale_buckets.async_delete(async_es_client, unit_failed)
 
-            clean_print("  ")
+    get_metrics().inc("adj_nodes", len(node_ids))
+    get_metrics().inc("adj_failed_nodes", len(unit_failed))
 
-            # append to failed nodes
-            args[-2].append(doc_id)
-
-
-    await async_es_client.close()
+    return len(node_ids), unit_failed
 
 
 
@@ -256,29 +414,28 @@ def process_hits(node_id: str, position: str, hits: list | None, results: list):
     return get_query_payload(node_id, position, search_after)
 
 
-def clean_print(*args, **kwargs):
-    sys.stdout.write('\033[2K\r')  # Clear line and move cursor to beginning
-    sys.stdout.flush()
-    print(*args, **kwargs, flush=True)
-
-
-async def get_edges(es_client: AsyncElasticsearch, node_id: str):
-    out_edges = []
-    in_edges = []
+async def iter_edges(es_client: AsyncElasticsearch, node_id: str, first_hits: dict | None = None):
+    """
+    Yield (direction, edges) of a node page by page, so callers do not have to hold all of them.
 
+    :param first_hits: optional first page of hits per position, already fetched elsewhere
+    """
+    if first_hits is None:
+        first_hits = {}
 
     query_targets = [
         {
             "position": 'subject',
-            "results": out_edges,
-            "hits": None,
+            "results": [],
+            "hits": first_hits.get('subject'),
         },
         {
             "position": 'object',
-            "results": in_edges,
-            "hits": None,
+            "results": [],
+            "hits": first_hits.get('object'),
         }
     ]
+    all_targets = list(query_targets)
 
     while True:
         query_body = []
@@ -296,49 +453,112 @@ async def get_edges(es_client: AsyncElasticsearch, node_id: str):
                 query_body.append(next_query_body)
                 next_query_targets.append(target)
 
+        # hand over what the last round brought in
+        for target in all_targets:
+            if target["results"]:
+                yield POSITION_DIRECTIONS[target["position"]], target["results"]
+                target["results"] = []
 
         if not query_body:
             break
 
-        responses = await es_client.msearch(index=EDGE_INDEX, body=query_body)
+        with get_metrics().stage("edge_search") as sample:
+            responses = await es_client.msearch(index=EDGE_INDEX, body=query_body)
 
-        for index, target in enumerate(next_query_targets):
-            response = responses["responses"][index]
-            target['hits'] = extract_hits_from_response(response)
+            for index, target in enumerate(next_query_targets):
+                response = responses["responses"][index]
+                target['hits'] = extract_hits_from_response(response)
+                sample["docs"] += len(target['hits'])
 
 
         query_targets = next_query_targets
 
-    # clean_print(f'{node_id} in: {len(in_edges)} out: {len(out_edges)}')
 
-    # total_edges_count = len(out_edges) + len(in_edges)
-    #
-    # if total_edges_count > 50000:
-    #     clean_print(f'{node_id} has {total_edges_count} edges')
+async def get_edges(es_client: AsyncElasticsearch, node_id: str):
+    out_edges = []
+    in_edges = []
+
+    async for direction, edges in iter_edges(es_client, node_id):
+        if direction == "out":
+            out_edges.extend(edges)
+        else:
+            in_edges.extend(edges)
+
+    # clean_print(f'{node_id} in: {len(in_edges)} out: {len(out_edges)}')
 
     return out_edges, in_edges
 
-async def process_single_node(es_client: AsyncElasticsearch, node_id: str):
+async def process_single_node(es_client: AsyncElasticsearch, node_id: str, actions: asyncio.Queue, first_hits: dict | None = None) -> bool:
+    """
+    Fetch a node's edges and put its bulk actions on the queue as they become ready.
+    Super nodes are flushed bucket by bucket while their edges are still being paged through.
+    """
+    builder = NodeActionBuilder(node_id)
+
     try:
-        out_edges, in_edges = await get_edges(es_client, node_id)
+        async for direction, edges in iter_edges(es_client, node_id, first_hits):
+            for action in builder.add(direction, edges):
+                await actions.put(action)
 
     except Exception as e:
         print(e)
-        return None, 0
+        return False
 
-    total_edges = len(in_edges) + len(out_edges)
+    for action in builder.finish():
+        await actions.put(action)
+
+    return True
 
-    payload = {
-        "_op_type": "update",
-        "_index": ADJ_INDEX,
-        "_id": node_id,
-        "doc": {
-            "out_edges": out_edges,
-            "in_edges": in_edges,
-        }
-    }
 
-    return payload, total_edges
+async def process_packed_nodes(es_client: AsyncElasticsearch, node_ids: list[str], actions: asyncio.Queue) -> list[str]:
+    """
+    Fetch the first page of edges for many nodes in one msearch and put their bulk actions on the queue.
+    Only nodes with a full first page go on to be paged one by one.
+
+    :return: ids of nodes that failed
+    """
+    query_body = []
+    for node_id in node_ids:
+        for position in POSITION_DIRECTIONS:
+            # meta field
+            query_body.append({})
+            # actual query
+            query_body.append(get_query_payload(node_id, position, None))
+
+    try:
+        with get_metrics().stage("edge_search_packed") as sample:
+            responses = await es_client.msearch(index=EDGE_INDEX, body=query_body)
+            sample["docs"] = sum(len(response.get("hits", {}).get("hits", [])) for response in responses["responses"])
+    except Exception as e:
+        print(e)
+        return list(node_ids)
+
+    responses = responses["responses"]
+    failed = []
+
+    for index, node_id in enumerate(node_ids):
+        try:
+            first_hits = {
+                position: extract_hits_from_response(responses[2 * index + offset])
+                for offset, position in enumerate(POSITION_DIRECTIONS)
+            }
+        except Exception as e:
+            print(e)
+            failed.append(node_id)
+            continue
+
+        # more pages to come, keep going with this node alone
+        if any(len(hits) >= 10000 for hits in first_hits.values()):
+            if not await process_single_node(es_client, node_id, actions, first_hits):
+                failed.append(node_id)
+            continue
+
+        out_edges = [hit["_source"] for hit in first_hits["subject"]]
+        in_edges = [hit["_source"] for hit in first_hits["object"]]
+        for action in make_node_actions(node_id, out_edges, in_edges):
+            await actions.put(action)
+
+    return failed
 
 
 
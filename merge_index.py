@@ -2,15 +2,24 @@ import argparse
 import os
 import shutil
 import subprocess
+import sys
+import time
 
 from dotenv import load_dotenv
 
 from utils.benchmark import timeit
-from utils.constants import TEMP_DIR, BATCH_SIZE
-from utils.es import refresh_es_index
+from utils.checkpoint import RunManifest, get_run_id
+from utils.compression import prepare_input
+from utils.constants import TEMP_DIR, BATCH_SIZE, RUNS_DIR
+from utils.delta import prepare_delta, promote_release, record_release, delete_removed_edges, get_release_state_path
+from utils.es import refresh_es_index, publish_index, get_es_client
+from utils.executor import add_executor_args, get_executor
+from utils.lifecycle import get_build_name
 from utils.make_offsets import get_offsets
-from utils.parallel import distribute_tasks
-from utils.writes import stitch_temps
+from utils.metrics import get_metrics, get_metrics_snapshot, report_metrics
+from utils.offline import offline_merge
+from utils.parallel import distribute_tasks, get_n_workers
+from utils.writes import stitch_temps, publish_shards
 
 
 # 1. read in edges, indexing starting location for 10k batches
@@ -52,29 +61,135 @@ def main():
     # overwrite edge file if specified
     parser = argparse.ArgumentParser()
     parser.add_argument("filepath", nargs="?", default=EDGE_FILE, help="Path to the input file")
+    parser.add_argument("--offline", action="store_true", help="Join nodes and edges locally, without Elasticsearch")
+    parser.add_argument("--nodes", default=os.getenv("NODES_FILE"), help="Path to nodes.jsonl, required with --offline")
+    parser.add_argument("--edges-from-file", action="store_true", default=os.getenv("EDGES_FROM_FILE") == "true",
+                        help="Build merged edges from the lines in the input file instead of fetching them by id")
+    parser.add_argument("--shards", action="store_true",
+                        help="Dev mode: keep batch files as shards under output/merged_edges instead of stitching one file")
+    parser.add_argument("--compress", choices=["gzip", "zstd"], default=os.getenv("OUTPUT_COMPRESSION") or None,
+                        help="Dev mode: compress the output, batch by batch on the workers")
+    parser.add_argument("--resume", metavar="RUN_ID", help="Resume an unfinished run, skipping batches it already completed")
+    parser.add_argument("--force-merge", action="store_true", help="Prod mode: force merge the new index before it goes live")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("BATCH_SIZE") or BATCH_SIZE),
+                        help="Edges per batch (or BATCH_SIZE), no rescan of the input needed to change it")
+    parser.add_argument("--engine", choices=["batch", "pipeline"], default=os.getenv("MERGE_ENGINE") or "batch",
+                        help="batch: one batch at a time per worker; pipeline: several batches in flight per worker, "
+                             "each in a different stage (or MERGE_ENGINE)")
+    parser.add_argument("--memory-limit", type=int, default=os.getenv("WORKER_MEMORY_LIMIT_MB"), metavar="MB",
+                        help="Batch engine: stream each batch in sub-batches sized to stay within this much memory per worker (or WORKER_MEMORY_LIMIT_MB)")
+    parser.add_argument("--node-fields", default=os.getenv("NODE_FIELDS"), metavar="FIELDS",
+                        help="Comma separated node fields to embed in edges, id is always kept (or NODE_FIELDS), all of them by default")
+    parser.add_argument("--delta", action="store_true",
+                        help="Only merge edges changed since the recorded release, or touching changed nodes, and delete removed ones. Needs --nodes")
+    parser.add_argument("--record-release", action="store_true",
+                        help="Once a full run is done, record its nodes and edges as the release the next --delta run starts from. Needs --nodes")
+    add_executor_args(parser, default="dask")
     args = parser.parse_args()
 
+    if args.delta or args.record_release:
+        assert args.nodes is not None, "--delta and --record-release need a nodes file (--nodes or NODES_FILE)"
+
+    if args.resume is not None:
+        manifest = RunManifest.load(args.resume, "merge_index")
+        assert manifest.params["is_prod"] == is_prod, f"run {args.resume} was started with PROD={str(manifest.params['is_prod']).lower()}"
+
+        # same input and batches as the original run
+        args.filepath = manifest.params["edge_file"]
+        args.edges_from_file = manifest.params["edges_from_file"]
+        args.compress = manifest.params["compress"]
+        args.batch_size = manifest.params.get("batch_size", BATCH_SIZE)
+        args.node_fields = manifest.params.get("node_fields")
+        args.nodes = manifest.params.get("nodes_file")
+        args.record_release = manifest.params.get("record_release", False)
+
+    # read wherever nodes are fetched or joined, see utils.projection
+    if args.node_fields:
+        os.environ["NODE_FIELDS"] = args.node_fields
+    else:
+        os.environ.pop("NODE_FIELDS", None)
+
     edge_file_path = args.filepath
 
     print(edge_file_path)
 
-    os.makedirs(TEMP_DIR, exist_ok=True)
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-    print ("Indexing offsets")
-    offsets = get_offsets(edge_file_path, BATCH_SIZE)
-    print("Offsets indexed:", len(offsets), "start locations")
+    # local join only, no es involved
+    if args.offline:
+        assert args.nodes is not None, "--offline needs a nodes file (--nodes or NODES_FILE)"
+        if args.delta:
+            try:
+                delta = prepare_delta(args.nodes, edge_file_path, f"{TEMP_DIR}/delta")
+                offline_merge(args.nodes, delta["edges"], f'{OUTPUT_DIR}/merged_edges.jsonl')
+                shutil.copy(delta["removed"], f'{OUTPUT_DIR}/removed_edges.txt')
+                shutil.copy(delta["adjacency_changes"], f'{OUTPUT_DIR}/adjacency_changes.jsonl')
+                promote_release(delta)
+            finally:
+                # the affected edges are a copy of part of the dump, nothing here is needed once it's done
+                shutil.rmtree(f"{TEMP_DIR}/delta", ignore_errors=True)
+        else:
+            offline_merge(args.nodes, edge_file_path, f'{OUTPUT_DIR}/merged_edges.jsonl')
+            if args.record_release:
+                record_release(args.nodes, edge_file_path, get_release_state_path())
+        return
+
+    if args.resume is not None:
+        offsets = manifest.params["offsets"]
+        delta = manifest.params.get("delta")
+        print(f"Resuming run {manifest.run_id}")
+    else:
+        # temp files of an earlier, unfinished run would end up in the output
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+        prepare_input(edge_file_path)
+        run_id = get_run_id()
+
+        # only the affected edges go through the batches, see utils.delta
+        delta = None
+        if args.delta:
+            delta = prepare_delta(args.nodes, edge_file_path, f"{RUNS_DIR}/{run_id}")
+            edge_file_path = delta["edges"]
+
+        print ("Indexing offsets")
+        offsets = get_offsets(edge_file_path, args.batch_size) if delta is None or delta["affected_edges"] else []
+        print("Offsets indexed:", len(offsets), "start locations")
+
+        manifest = RunManifest.create(run_id, "merge_index", {
+            "edge_file": edge_file_path,
+            "edges_from_file": args.edges_from_file,
+            "is_prod": is_prod,
+            "compress": args.compress,
+            "batch_size": args.batch_size,
+            "node_fields": args.node_fields,
+            "nodes_file": args.nodes,
+            "record_release": args.record_release,
+            "delta": delta,
+            "offsets": offsets,
+        })
+        print(f"Run {manifest.run_id}, resume with --resume {manifest.run_id}")
+
+        # fresh index next to the live one, swapped in once loaded
+        if is_prod and delta is None:
+            refresh_es_index(ES_URL, manifest.run_id)
+
+    # every full run loads into its own index build, a delta run updates the live index
+    target_index = INDEX_NAME if delta is not None else get_build_name(INDEX_NAME, manifest.run_id)
 
+    os.makedirs(TEMP_DIR, exist_ok=True)
 
+    # workers read it, see utils.edges.get_worker_memory_limit
+    if args.memory_limit is not None:
+        os.environ["WORKER_MEMORY_LIMIT_MB"] = str(args.memory_limit)
 
-    # make sure we have a clean slate
-    if is_prod:
-        refresh_es_index(ES_URL)
+    # workers inherit it, and compress their own batches
+    if args.compress is not None:
+        os.environ["OUTPUT_COMPRESSION"] = args.compress
 
 
     # set worker number as needed
     if len(offsets) < 10:
-        os.environ["N_WORKERS"] = str(len(offsets))
+        os.environ["N_WORKERS"] = str(max(1, len(offsets)))
 
     '''
     Consecutive run
@@ -91,16 +206,57 @@ def main():
     '''
     Distributed/parallel run
     '''
+    started = time.perf_counter()
     with timeit('distributed tasks'):
-        distribute_tasks(es_url=ES_URL, target_file=edge_file_path, offsets=offsets, is_prod=is_prod)
+        with get_executor(args.executor, get_n_workers(), args.scheduler) as executor:
+            metric_snapshots = distribute_tasks(executor=executor, es_url=ES_URL, target_file=edge_file_path, offsets=offsets, is_prod=is_prod, edges_from_file=args.edges_from_file, manifest=manifest, target_index=target_index, engine=args.engine)
+            failures = executor.failures
+
+        # an incomplete index must not go live, nor an incomplete file out
+        if failures:
+            print(f"{len(failures)} batches failed, nothing published. Retry them with --resume {manifest.run_id}")
+            report_metrics("merge_index", manifest.run_id, metric_snapshots, time.perf_counter() - started)
+            sys.exit(1)
+
         # write final output file
-        if not is_prod:
-            stitch_temps(OUTPUT_DIR)
+        with get_metrics().stage("finalize"):
+            if is_prod and delta is not None:
+                es_client = get_es_client(ES_URL, request_timeout=240)
+                deleted, failed = delete_removed_edges(es_client, INDEX_NAME, delta["removed"])
+                if failed:
+                    print(f"{failed} removed edges are still in {INDEX_NAME}, release not recorded. Retry with --resume {manifest.run_id}")
+                    sys.exit(1)
+                es_client.indices.refresh(index=INDEX_NAME)
+                print(f"Deleted {deleted} removed edges")
+            elif is_prod:
+                publish_index(ES_URL, INDEX_NAME, target_index, force_merge=args.force_merge)
+            else:
+                if args.shards:
+                    publish_shards(OUTPUT_DIR)
+                else:
+                    stitch_temps(OUTPUT_DIR)
+                if delta is not None:
+                    shutil.copy(delta["removed"], f'{OUTPUT_DIR}/removed_edges.txt')
+                    shutil.copy(delta["adjacency_changes"], f'{OUTPUT_DIR}/adjacency_changes.jsonl')
         # subprocess.run(["./merge_temps.sh", OUTPUT_DIR], check=True)
 
+        # what the index (or output) now holds is what the next delta run starts from
+        if delta is not None:
+            promote_release(delta)
+            print(f"Adjacency changes in {delta['adjacency_changes']}, apply with merge_adjacency_list.py --engine changes --changes <path>")
+        elif args.record_release:
+            with get_metrics().stage("record_release"):
+                record_release(args.nodes, edge_file_path, get_release_state_path())
+
+    # workers plus this process, for the finalize stage
+    metric_snapshots.append(get_metrics_snapshot())
+    report_metrics("merge_index", manifest.run_id, metric_snapshots, time.perf_counter() - started)
+
     # remove temp files
     shutil.rmtree('./temp_output')
 
+    manifest.record({"finished": True})
+
 
 
 
@@ -1,19 +1,27 @@
+import argparse
 import os
 
 from elasticsearch import Elasticsearch
 
+from utils.checkpoint import get_run_id
 from utils.env import check_is_prod
 from utils.es import create_nested_index
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force-merge", action="store_true", help="Force merge the new nested index before it goes live")
+    args = parser.parse_args()
+
     is_prod = check_is_prod()
     SERVER = os.getenv("SERVER")
     PORT = os.getenv("PORT")
     ES_URL = "http://%s:%s" % (SERVER, PORT)
 
-    # create new index
-    migrate_handle = create_nested_index(ES_URL)
+    # create new index, a build of its own that replaces the live one once it's filled
+    run_id = get_run_id()
+    print(f"Building nested index for run {run_id}")
+    migrate_handle = create_nested_index(ES_URL, run_id, force_merge=args.force_merge)
 
 
     # one record test
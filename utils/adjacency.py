@@ -0,0 +1,270 @@
+import os
+import sys
+
+from utils.constants import ADJ_INDEX, ADJ_SUPER_NODE_THRESHOLD, ADJ_BUCKET_SIZE, ADJ_SWEEP_NODES, ADJ_SWEEP_SUPER_NODES
+
+DIRECTIONS = ("out", "in")
+
+
+def get_adj_index() -> str:
+    """
+    Index adjacency writes go to: a new build set by merge_adjacency_list.py, otherwise the live index.
+    """
+    return os.getenv("ADJACENCY_TARGET_INDEX") or ADJ_INDEX
+
+
+def make_node_action(node_id: str, out_edges: list, in_edges: list, index: str = ADJ_INDEX) -> dict:
+    """
+    Bulk update action setting the adjacency lists of one node, and clearing
+    the manifest it has if it was a super node before.
+    """
+    return {
+        "_op_type": "update",
+        "_index": index,
+        "_id": node_id,
+        "doc": {
+            "out_edges": out_edges,
+            "in_edges": in_edges,
+            "edge_buckets": None,
+        }
+    }
+
+
+def get_bucket_id(node_id: str, direction: str, bucket: int) -> str:
+    return f"{node_id}#{direction}#{bucket}"
+
+
+def get_parent_id(doc_id: str) -> str:
+    """
+    Node id of a bucket doc id, or the id itself for regular node docs.
+    """
+    parts = doc_id.rsplit("#", 2)
+    if len(parts) == 3 and parts[1] in DIRECTIONS and parts[2].isdigit():
+        return parts[0]
+
+    return doc_id
+
+
+def make_bucket_action(node_id: str, direction: str, bucket: int, edges: list, index: str = ADJ_INDEX) -> dict:
+    """
+    Bulk index action for one bucket of a super node's edges, stored as its own doc.
+    """
+    return {
+        "_op_type": "index",
+        "_index": index,
+        "_id": get_bucket_id(node_id, direction, bucket),
+        "_source": {
+            "bucket_of": node_id,
+            "bucket_direction": direction,
+            "bucket": bucket,
+            f"{direction}_edges": edges,
+        }
+    }
+
+
+def make_manifest_action(node_id: str, buckets: dict, counts: dict, index: str = ADJ_INDEX) -> dict:
+    """
+    Bulk update action for a super node's own doc: no edges inline, only where to find them.
+    """
+    return {
+        "_op_type": "update",
+        "_index": index,
+        "_id": node_id,
+        "doc": {
+            "out_edges": [],
+            "in_edges": [],
+            "edge_buckets": {
+                "out": buckets["out"],
+                "in": buckets["in"],
+                "out_count": counts["out"],
+                "in_count": counts["in"],
+            },
+        }
+    }
+
+
+class NodeActionBuilder:
+    """
+    Collects a node's edges as they arrive and turns them into bulk actions.
+
+    A node stays a single update unless it goes over the super node threshold.
+    From then on its edges are flushed as bucketed child docs whenever a bucket
+    fills up, so memory stays bounded by the bucket size, and the node doc only
+    gets a manifest of its buckets.
+    """
+
+    def __init__(self, node_id: str):
+        self.node_id = node_id
+        self.index = get_adj_index()
+        self.threshold = int(os.getenv("ADJ_SUPER_NODE_THRESHOLD", ADJ_SUPER_NODE_THRESHOLD))
+        self.bucket_size = int(os.getenv("ADJ_BUCKET_SIZE", ADJ_BUCKET_SIZE))
+
+        self.edges = {"out": [], "in": []}
+        self.buckets = {"out": 0, "in": 0}
+        self.counts = {"out": 0, "in": 0}
+        self.is_super_node = False
+
+    def add(self, direction: str, edges: list) -> list[dict]:
+        """
+        :return: bucket actions ready to be sent
+        """
+        self.edges[direction].extend(edges)
+        self.counts[direction] += len(edges)
+
+        if not self.is_super_node and len(self.edges["out"]) + len(self.edges["in"]) > self.threshold:
+            self.is_super_node = True
+
+        if not self.is_super_node:
+            return []
+
+        return self._flush(full_only=True)
+
+    def finish(self) -> list[dict]:
+        if not self.is_super_node:
+            return [make_node_action(self.node_id, self.edges["out"], self.edges["in"], self.index)]
+
+        actions = self._flush(full_only=False)
+        actions.append(make_manifest_action(self.node_id, self.buckets, self.counts, self.index))
+
+        return actions
+
+    def _flush(self, full_only: bool) -> list[dict]:
+        actions = []
+
+        for direction in DIRECTIONS:
+            edges = self.edges[direction]
+
+            while len(edges) >= self.bucket_size or (not full_only and edges):
+                bucket = edges[:self.bucket_size]
+                del edges[:self.bucket_size]
+
+                actions.append(make_bucket_action(self.node_id, direction, self.buckets[direction], bucket, self.index))
+                self.buckets[direction] += 1
+
+        return actions
+
+
+def make_node_actions(node_id: str, out_edges: list, in_edges: list) -> list[dict]:
+    """
+    Actions for a node whose edges are all known already, split into buckets if it is a super node.
+    """
+    builder = NodeActionBuilder(node_id)
+    actions = builder.add("out", out_edges)
+    actions.extend(builder.add("in", in_edges))
+    actions.extend(builder.finish())
+
+    return actions
+
+
+class StaleBuckets:
+    """
+    Bucket docs an earlier build left behind for nodes rebuilt since.
+
+    Node docs are partial updates, so a node rebuilt with fewer buckets than
+    it had, or as a regular node, keeps its old buckets past the new counts.
+    Node doc actions are noted on their way to bulk, and once they are written
+    `delete` removes every bucket doc past each node's new count.
+
+    The run that creates a build (`ADJ_NEW_BUILD`) writes every node there
+    for the first time, so there is nothing to delete and nothing is noted.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.is_new_build = os.getenv("ADJ_NEW_BUILD") == "true"
+
+    def note(self, action: dict):
+        # bucket docs are indexed, node docs updated
+        if self.is_new_build or action["_op_type"] != "update":
+            return
+
+        manifest = action["doc"].get("edge_buckets")
+        self.buckets[action["_id"]] = {direction: manifest[direction] if manifest else 0 for direction in DIRECTIONS}
+
+    def watch(self, actions):
+        for action in actions:
+            self.note(action)
+            yield action
+
+    def get_queries(self, failed_nodes: list):
+        """
+        :return: (node ids, delete_by_query query for their stale buckets), in chunks
+        """
+        # a node doc that failed still points at its old buckets, they go once it is retried
+        failed = set(failed_nodes)
+        buckets = {node_id: counts for node_id, counts in self.buckets.items() if node_id not in failed}
+        regular = [node_id for node_id, counts in buckets.items() if not any(counts.values())]
+        super_nodes = [node_id for node_id, counts in buckets.items() if any(counts.values())]
+
+        for i in range(0, len(regular), ADJ_SWEEP_NODES):
+            chunk = regular[i:i + ADJ_SWEEP_NODES]
+            yield chunk, {"terms": {"bucket_of": chunk}}
+
+        for i in range(0, len(super_nodes), ADJ_SWEEP_SUPER_NODES):
+            chunk = super_nodes[i:i + ADJ_SWEEP_SUPER_NODES]
+            yield chunk, {"bool": {"should": [
+                {"bool": {"filter": [
+                    {"term": {"bucket_of": node_id}},
+                    {"term": {"bucket_direction": direction}},
+                    {"range": {"bucket": {"gte": buckets[node_id][direction]}}},
+                ]}}
+                for node_id in chunk for direction in DIRECTIONS
+            ]}}
+
+    def delete(self, es_client, failed_nodes: list) -> int:
+        """
+        :return: number of bucket docs deleted
+        """
+        deleted = 0
+
+        for node_ids, query in self.get_queries(failed_nodes):
+            try:
+                response = es_client.delete_by_query(index=get_adj_index(), query=query, conflicts="proceed")
+                deleted += response["deleted"]
+            except Exception as e:
+                clean_print(f"❌ Failed to delete stale buckets of {len(node_ids)} nodes: {e!r}")
+                failed_nodes.extend(node_ids)
+
+        self.buckets.clear()
+
+        return deleted
+
+    async def async_delete(self, es_client, failed_nodes: list) -> int:
+        deleted = 0
+
+        for node_ids, query in self.get_queries(failed_nodes):
+            try:
+                response = await es_client.delete_by_query(index=get_adj_index(), query=query, conflicts="proceed")
+                deleted += response["deleted"]
+            except Exception as e:
+                clean_print(f"❌ Failed to delete stale buckets of {len(node_ids)} nodes: {e!r}")
+                failed_nodes.extend(node_ids)
+
+        self.buckets.clear()
+
+        return deleted
+
+
+def collect_failed_updates(errors: list, failed_nodes: list):
+    """
+    Print failed bulk actions and record their node ids as failed nodes.
+    """
+    for failure in errors:
+        # update for node docs, index for super node buckets
+        op_type = next(iter(failure))
+        action = failure[op_type]
+        error = action.get("error", {})
+        doc_id = action.get("_id", "<unknown>")
+
+        clean_print(f"❌ Failed document ID: {doc_id}")
+        clean_print(f"   Reason: {error.get('type')} - {error.get('reason')}")
+
+        clean_print("  ")
+
+        failed_nodes.append(get_parent_id(doc_id))
+
+
+def clean_print(*args, **kwargs):
+    sys.stdout.write('\033[2K\r')  # Clear line and move cursor to beginning
+    sys.stdout.flush()
+    print(*args, **kwargs, flush=True)
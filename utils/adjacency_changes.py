@@ -0,0 +1,229 @@
+"""
+Incremental adjacency updates, `merge_adjacency_list.py --engine changes --changes <path>`.
+
+A changes file is jsonl with one edge change per line:
+
+    {"op": "index", "edge": {...}}                                   an added or changed edge, the whole doc
+    {"op": "delete", "edge": {"id": ..., "subject": ..., "object": ...}}   a removed edge, or where a changed one used to be
+
+`merge_index.py --delta` writes one as `adjacency_changes.jsonl`.
+
+Changes are grouped by node and direction before anything is sent, so a node
+gets one update however many of its edges changed: its current lists are read,
+every changed edge id is dropped from them and the new versions are added, in
+edge id order like a full build. An index wins over a delete of the same edge
+at the same node, whatever their order in the file. Nodes missing from the
+adjacency index are taken from the node index and written whole.
+
+Super nodes keep their buckets. Only buckets that held a changed edge are
+written again, new edges go into the last bucket until it is full and then
+into new ones, and the manifest on the node doc gets the new counts. A regular
+node that grows past `ADJ_SUPER_NODE_THRESHOLD` is split into buckets, as in a
+full build; a super node stays one even if it shrinks.
+
+Applying the same changes twice gives the same docs, so failed nodes can just
+be run again.
+"""
+
+import os
+from collections import defaultdict
+
+from elasticsearch import Elasticsearch
+
+from utils import codec
+from utils.adjacency import DIRECTIONS, make_node_actions, make_bucket_action, make_manifest_action, \
+    get_adj_index, get_bucket_id, get_parent_id, clean_print
+from utils.bulk import AdaptiveBulkWriter
+from utils.constants import NODE_INDEX, UNITS_PER_WORKER, ADJ_BUCKET_SIZE
+from utils.es import get_es_client, get_es_docs_using_ids
+from utils.executor import Executor, get_worker_resource
+from utils.metrics import get_metrics
+from utils.offline import iter_lines
+
+POSITION_DIRECTIONS = {"subject": "out", "object": "in"}
+
+
+def load_changes(changes_file: str) -> dict[str, dict[str, dict]]:
+    """
+    :return: per node id and direction, the changed edge ids, each mapped to its
+             new edge or to None when it is only dropped
+    """
+    changes = defaultdict(lambda: {"out": {}, "in": {}})
+
+    for line in iter_lines(changes_file):
+        change = codec.loads(line)
+        edge = change["edge"]
+        assert change["op"] in ("index", "delete"), f"unknown op in {line!r}"
+
+        for position, direction in POSITION_DIRECTIONS.items():
+            if edge.get(position) is None:
+                continue
+
+            node_changes = changes[edge[position]][direction]
+            if change["op"] == "index":
+                node_changes[edge["id"]] = edge
+            else:
+                node_changes.setdefault(edge["id"], None)
+
+    return dict(changes)
+
+
+def merge_edges(edges: list[dict], changes: dict[str, dict | None]) -> list[dict]:
+    merged = [edge for edge in edges if edge.get("id") not in changes]
+    merged.extend(edge for edge in changes.values() if edge is not None)
+
+    return sorted(merged, key=lambda edge: edge["id"])
+
+
+def make_new_node_action(node: dict, action: dict) -> dict:
+    """
+    The node doc update of a node not in the adjacency index yet, as an index of the whole doc.
+    """
+    return {
+        "_op_type": "index",
+        "_index": action["_index"],
+        "_id": action["_id"],
+        "_source": {**node, **action["doc"]},
+    }
+
+
+def get_node_actions(node_id: str, doc: dict, node_changes: dict, node: dict | None = None) -> list[dict]:
+    """
+    Actions for a regular node, or a node new to the adjacency index (`node`).
+    """
+    out_edges = merge_edges(doc.get("out_edges") or [], node_changes["out"])
+    in_edges = merge_edges(doc.get("in_edges") or [], node_changes["in"])
+
+    # the node doc update comes last, see NodeActionBuilder.finish
+    actions = make_node_actions(node_id, out_edges, in_edges)
+    if node is not None:
+        actions[-1] = make_new_node_action(node, actions[-1])
+
+    return actions
+
+
+def get_super_node_actions(es_client: Elasticsearch, node_id: str, manifest: dict, node_changes: dict) -> list[dict]:
+    index = get_adj_index()
+    bucket_size = int(os.getenv("ADJ_BUCKET_SIZE", ADJ_BUCKET_SIZE))
+    buckets = {direction: manifest[direction] for direction in DIRECTIONS}
+    counts = {direction: manifest[f"{direction}_count"] for direction in DIRECTIONS}
+    actions = []
+
+    for direction in DIRECTIONS:
+        changes = node_changes[direction]
+        if not changes:
+            continue
+
+        field = f"{direction}_edges"
+        bucket_ids = [get_bucket_id(node_id, direction, bucket) for bucket in range(buckets[direction])]
+        bucket_docs = get_es_docs_using_ids(es_client, index, bucket_ids, return_id_dict=True, source_includes=[field])
+        assert len(bucket_docs) == len(bucket_ids), f"{len(bucket_ids) - len(bucket_docs)} buckets of {node_id} are missing"
+
+        edges = [bucket_docs[bucket_id].get(field) or [] for bucket_id in bucket_ids]
+        changed = set()
+
+        for bucket, bucket_edges in enumerate(edges):
+            kept = [edge for edge in bucket_edges if edge.get("id") not in changes]
+            if len(kept) < len(bucket_edges):
+                edges[bucket] = kept
+                changed.add(bucket)
+
+        for edge in sorted((edge for edge in changes.values() if edge is not None), key=lambda edge: edge["id"]):
+            if not edges or len(edges[-1]) >= bucket_size:
+                edges.append([])
+            edges[-1].append(edge)
+            changed.add(len(edges) - 1)
+
+        for bucket in sorted(changed):
+            actions.append(make_bucket_action(node_id, direction, bucket, edges[bucket], index))
+
+        buckets[direction] = len(edges)
+        counts[direction] = sum(map(len, edges))
+
+    actions.append(make_manifest_action(node_id, buckets, counts, index))
+
+    return actions
+
+
+def apply_changes(es_url: str, changes: dict[str, dict]) -> tuple[int, list[str]]:
+    """
+    Update the adjacency docs of a unit of nodes.
+
+    :return: number of nodes updated, ids of nodes that failed
+    """
+    es_client = get_worker_resource("es_client", lambda: get_es_client(es_url, request_timeout=300))
+    bulk_writer = get_worker_resource("bulk_writer", lambda: AdaptiveBulkWriter(es_client))
+    index = get_adj_index()
+    node_ids = list(changes)
+
+    with get_metrics().stage("adj_changes_read") as sample:
+        docs = get_es_docs_using_ids(es_client, index, node_ids, return_id_dict=True, source_includes=["out_edges", "in_edges", "edge_buckets"])
+        sample["docs"] = len(docs)
+
+        # not in the adjacency index yet, e.g. nodes new to this release
+        missing = [node_id for node_id in node_ids if node_id not in docs]
+        new_nodes = get_es_docs_using_ids(es_client, NODE_INDEX, missing, return_id_dict=True) if missing else {}
+
+    failed = []
+    actions = []
+
+    for node_id in node_ids:
+        try:
+            if node_id in docs and docs[node_id].get("edge_buckets"):
+                actions.extend(get_super_node_actions(es_client, node_id, docs[node_id]["edge_buckets"], changes[node_id]))
+            elif node_id in docs:
+                actions.extend(get_node_actions(node_id, docs[node_id], changes[node_id]))
+            elif node_id in new_nodes:
+                actions.extend(get_node_actions(node_id, {}, changes[node_id], new_nodes[node_id]))
+            else:
+                clean_print(f"❌ {node_id} is in neither {index} nor {NODE_INDEX}")
+                failed.append(node_id)
+        except Exception as e:
+            clean_print(f"❌ {node_id}: {e!r}")
+            failed.append(node_id)
+
+    with get_metrics().stage("adj_changes_write") as sample:
+        success, failures = bulk_writer.write(actions)
+        sample["docs"] = success
+
+    for failure in failures:
+        clean_print(f"❌ Failed document ID: {failure['_id']}")
+        clean_print(f"   Reason: {failure['status']} - {failure['error']}")
+        failed.append(get_parent_id(failure["_id"]))
+
+    # a node can fail for several of its buckets
+    failed = list(dict.fromkeys(failed))
+
+    get_metrics().inc("adj_nodes", len(node_ids))
+    get_metrics().inc("adj_failed_nodes", len(failed))
+
+    return len(node_ids), failed
+
+
+def run_changes(es_url: str, changes_file: str, executor: Executor, only_nodes: list[str] | None = None) -> list[str]:
+    """
+    Apply a changes file to the adjacency index, with units of nodes spread over the executor's workers.
+
+    :param only_nodes: apply the changes of these nodes only, e.g. the failed ones of an earlier run
+    :return: ids of nodes that failed
+    """
+    changes = load_changes(changes_file)
+    node_ids = sorted(changes if only_nodes is None else set(only_nodes) & changes.keys())
+    print(f"{len(node_ids)} nodes to update")
+
+    num_units = max(1, min(len(node_ids), executor.n_workers * UNITS_PER_WORKER))
+    tasks = {
+        unit: (es_url, {node_id: changes[node_id] for node_id in node_ids[unit::num_units]})
+        for unit in range(num_units)
+    }
+    units = {unit: list(args[1]) for unit, args in tasks.items()}
+
+    failed_nodes = []
+    for _, (_, unit_failed) in executor.run_tasks(apply_changes, tasks, label="changes", count=lambda result: result[0], unit="nodes"):
+        failed_nodes.extend(unit_failed)
+
+    for failure in executor.failures:
+        print(f"unit {failure.key} failed on {failure.worker}: {failure.error}")
+        failed_nodes.extend(units[failure.key])
+
+    return failed_nodes
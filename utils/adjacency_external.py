@@ -0,0 +1,314 @@
+"""
+Out-of-core adjacency list builder working from edges.jsonl, no edge index queries.
+
+1. Workers read byte ranges of the edges file and turn every edge into two
+   records, keyed by (node id, direction, edge id). Records are hash-partitioned
+   by node id, and whenever a worker's buffer hits its memory budget each
+   partition's records are sorted and spilled into a run file.
+2. Workers k-way merge the runs of one partition at a time. Records of a node
+   come out together, `out` before `in`, edges sorted by id, and are streamed
+   either into bulk updates (super nodes split into buckets) or into a jsonl file.
+
+Records are plain lines, `node id \\t direction \\t edge id \\t edge json`, so
+sorting the raw bytes sorts by that key: tab sorts before any printable
+character, and the edge json is never decoded again.
+
+Pool workers report metrics per task, every task adds its own snapshot to `snapshots`.
+"""
+
+import glob
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import zlib
+from itertools import groupby
+
+from elasticsearch import helpers
+
+from utils import codec
+from utils.adjacency import NodeActionBuilder, StaleBuckets, collect_failed_updates
+from utils.benchmark import timeit
+from utils.compression import open_input, get_input_size, prepare_input
+from utils.constants import TEMP_DIR, ADJ_SORT_MEMORY_MB, ADJ_SORT_MAX_FANIN
+from utils.es import get_es_client
+from utils.metrics import get_metrics, get_metrics_snapshot, reset_metrics
+
+SORT_DIR = f"{TEMP_DIR}/adjacency_sort"
+
+# out sorts before in, matching the field order of the update docs
+OUT = b"0"
+IN = b"1"
+
+
+def get_memory_limit() -> int:
+    return int(os.getenv("ADJ_SORT_MEMORY_MB", ADJ_SORT_MEMORY_MB)) * 1024 * 1024
+
+
+def get_partition(node_id: bytes, num_partitions: int) -> int:
+    return zlib.crc32(node_id) % num_partitions
+
+
+def split_file(target_file: str, num_chunks: int) -> list[tuple[int, int]]:
+    """
+    Split a file into byte ranges that start and end on line boundaries.
+    """
+    size = get_input_size(target_file)
+    boundaries = [0]
+
+    with open_input(target_file) as f:
+        for i in range(1, num_chunks):
+            f.seek(max(size * i // num_chunks, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+
+    boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def make_records(line: bytes):
+    edge = codec.loads(line)
+    edge_id = edge["id"].encode()
+
+    for position, direction in (("subject", OUT), ("object", IN)):
+        if position in edge:
+            node_id = edge[position].encode()
+            yield node_id, b"\t".join((node_id, direction, edge_id, line))
+
+
+def spill(buffers: list[list[bytes]], chunk_index: int, spill_index: int) -> list[str]:
+    runs = []
+
+    with get_metrics().stage("adj_sort") as sample:
+        for records in buffers:
+            records.sort()
+            sample["docs"] += len(records)
+
+    with get_metrics().stage("adj_spill") as sample:
+        for partition, records in enumerate(buffers):
+            if not records:
+                continue
+
+            path = f"{SORT_DIR}/run-{partition:04d}-{chunk_index:05d}-{spill_index:05d}"
+            with open(path, "wb") as f:
+                sample["bytes"] += f.write(b"\n".join(records) + b"\n")
+            sample["docs"] += len(records)
+
+            runs.append(path)
+            records.clear()
+
+    return runs
+
+
+def make_runs(target_file: str, start: int, end: int, chunk_index: int, num_partitions: int, memory_limit: int) -> list[str]:
+    """
+    Turn one byte range of the edges file into sorted runs, spilling whenever the buffer gets too big.
+    """
+    buffers = [[] for _ in range(num_partitions)]
+    buffered_bytes = 0
+    spill_index = 0
+    runs = []
+
+    with open_input(target_file) as f:
+        f.seek(start)
+
+        while f.tell() < end:
+            line = f.readline().strip()
+            if not line:
+                continue
+
+            for node_id, record in make_records(line):
+                buffers[get_partition(node_id, num_partitions)].append(record)
+                # object overhead of a bytes in a list is roughly 2x its payload
+                buffered_bytes += 2 * len(record)
+
+            if buffered_bytes >= memory_limit:
+                runs.extend(spill(buffers, chunk_index, spill_index))
+                spill_index += 1
+                buffered_bytes = 0
+
+    runs.extend(spill(buffers, chunk_index, spill_index))
+
+    return runs
+
+
+def iter_run(path: str):
+    with open(path, "rb") as f:
+        for line in f:
+            yield line.rstrip(b"\n")
+
+
+def merge_runs(runs: list[str], output_path: str) -> str:
+    with get_metrics().stage("adj_merge") as sample, open(output_path, "wb") as f:
+        for record in heapq.merge(*map(iter_run, runs)):
+            sample["bytes"] += f.write(record + b"\n")
+            sample["docs"] += 1
+
+    for run in runs:
+        os.remove(run)
+
+    return output_path
+
+
+def reduce_runs(runs: list[str], partition: int) -> list[str]:
+    """
+    Merge runs in groups until there are few enough to merge in one pass.
+    """
+    level = 0
+    while len(runs) > ADJ_SORT_MAX_FANIN:
+        groups = [runs[i:i + ADJ_SORT_MAX_FANIN] for i in range(0, len(runs), ADJ_SORT_MAX_FANIN)]
+        runs = [
+            merge_runs(group, f"{SORT_DIR}/merged-{partition:04d}-{level:02d}-{i:05d}")
+            for i, group in enumerate(groups)
+        ]
+        level += 1
+
+    return runs
+
+
+def get_node_id(record: bytes) -> bytes:
+    return record.split(b"\t", 1)[0]
+
+
+def split_record(record: bytes) -> tuple[bytes, bytes]:
+    _, direction, _, line = record.split(b"\t", 3)
+    return direction, line
+
+
+def iter_grouped_nodes(runs: list[str]):
+    """
+    Yield (node id, records) for each node, records in sorted order.
+    """
+    merged = heapq.merge(*map(iter_run, runs))
+    for node_id, records in groupby(merged, key=get_node_id):
+        yield node_id.decode(), map(split_record, records)
+
+
+def write_node_docs(runs: list[str], output_path: str) -> int:
+    """
+    Stream adjacency docs into a jsonl file, never holding a node's edges in memory.
+    """
+    count = 0
+
+    with open(output_path, "wb") as f:
+        for node_id, records in iter_grouped_nodes(runs):
+            f.write(b'{"id": ' + json.dumps(node_id).encode() + b', "out_edges": [')
+
+            current = OUT
+            first = True
+            for direction, line in records:
+                if direction != current:
+                    f.write(b'], "in_edges": [')
+                    current = direction
+                    first = True
+
+                if not first:
+                    f.write(b", ")
+                f.write(line)
+                first = False
+
+            if current == OUT:
+                f.write(b'], "in_edges": [')
+
+            f.write(b"]}\n")
+            count += 1
+
+    return count
+
+
+def generate_node_actions(runs: list[str]):
+    for node_id, records in iter_grouped_nodes(runs):
+        builder = NodeActionBuilder(node_id)
+
+        for direction, line in records:
+            yield from builder.add("out" if direction == OUT else "in", [codec.loads(line)])
+
+        yield from builder.finish()
+
+
+def process_partition(partition: int, es_url: str | None, failed_nodes: list) -> int:
+    runs = reduce_runs(sorted(glob.glob(f"{SORT_DIR}/run-{partition:04d}-*")), partition)
+
+    # runs are merged as docs go out, so both stages include the final merge
+    if es_url is None:
+        with get_metrics().stage("adj_write") as sample:
+            sample["docs"] = write_node_docs(runs, f"{SORT_DIR}/nodes-{partition:04d}.jsonl")
+
+        return sample["docs"]
+
+    es_client = get_es_client(es_url, request_timeout=300)
+    stale_buckets = StaleBuckets()
+    with get_metrics().stage("adj_bulk") as sample:
+        success, errors = helpers.bulk(
+            es_client,
+            stale_buckets.watch(generate_node_actions(runs)),
+            raise_on_error=False,
+            max_chunk_bytes=90 * 1024 * 1024
+        )
+        sample["docs"] = success
+
+    if errors:
+        collect_failed_updates(errors, failed_nodes)
+
+    with get_metrics().stage("adj_stale_buckets") as sample:
+        sample["docs"] = stale_buckets.delete(es_client, failed_nodes)
+
+    es_client.close()
+
+    return success + len(errors)
+
+
+def measured(fn, snapshots: list, *args):
+    """
+    Run a pool task on fresh metrics and add its snapshot to `snapshots`.
+    """
+    reset_metrics()
+
+    try:
+        return fn(*args)
+    finally:
+        snapshots.append(get_metrics_snapshot())
+
+
+def run_external(edge_file: str, total_workers: int, failed_nodes: list, snapshots: list, es_url: str | None = None, output_file: str | None = None):
+    """
+    Build adjacency docs from an edges jsonl file.
+    Docs go to the adjacency index when `es_url` is given, otherwise into `output_file`.
+    """
+    assert (es_url is None) != (output_file is None), "need exactly one of es_url and output_file"
+
+    memory_limit = get_memory_limit() // total_workers
+    num_partitions = total_workers * 4
+
+    shutil.rmtree(SORT_DIR, ignore_errors=True)
+    os.makedirs(SORT_DIR, exist_ok=True)
+    prepare_input(edge_file)
+
+    try:
+        with multiprocessing.Pool(total_workers) as pool:
+            # 1. sorted runs from file chunks, all cores
+            with timeit(f"sort runs of {edge_file}"):
+                chunks = split_file(edge_file, total_workers * 4)
+                run_lists = pool.starmap(measured, [
+                    (make_runs, snapshots, edge_file, start, end, i, num_partitions, memory_limit)
+                    for i, (start, end) in enumerate(chunks)
+                ])
+                print(f"{sum(map(len, run_lists))} sorted runs")
+
+            # 2. merge each partition and emit its nodes
+            with timeit(f"merge {num_partitions} partitions"):
+                counts = pool.starmap(measured, [
+                    (process_partition, snapshots, partition, es_url, failed_nodes) for partition in range(num_partitions)
+                ])
+                print(f"{sum(counts)} docs written")
+
+        if output_file is not None:
+            with open(output_file, "wb") as output:
+                for partition in range(num_partitions):
+                    with open(f"{SORT_DIR}/nodes-{partition:04d}.jsonl", "rb") as f:
+                        shutil.copyfileobj(f, output)
+
+    finally:
+        shutil.rmtree(SORT_DIR, ignore_errors=True)
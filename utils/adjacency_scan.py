@@ -0,0 +1,244 @@
+"""
+Single-pass adjacency list builder.
+
+Instead of two searches per node, the edge index is read once with a sliced
+point-in-time scan. Each worker scans one slice and spills every edge twice,
+as (subject, "out", edge) and (object, "in", edge), into files partitioned by
+node id. Then each worker groups a share of the partitions in memory and sends
+the same update actions the per-node engine produces.
+
+Every worker process adds its metrics snapshot to `snapshots` when it is done.
+"""
+
+import glob
+import multiprocessing
+import os
+import shutil
+import zlib
+from contextlib import ExitStack
+
+from elasticsearch import Elasticsearch, helpers
+
+from utils import codec
+from utils.adjacency import StaleBuckets, make_node_actions, collect_failed_updates, clean_print
+from utils.benchmark import timeit
+from utils.constants import EDGE_INDEX, TEMP_DIR, ADJ_SCAN_PAGE_SIZE, ADJ_SCAN_PARTITIONS
+from utils.es import get_es_client
+from utils.metrics import get_metrics, get_metrics_snapshot
+
+SCAN_DIR = f"{TEMP_DIR}/adjacency_scan"
+PIT_KEEP_ALIVE = "10m"
+
+
+def get_partition(node_id: str, num_partitions: int) -> int:
+    return zlib.crc32(node_id.encode()) % num_partitions
+
+
+def get_partition_path(partition: int, worker_id: int) -> str:
+    return f"{SCAN_DIR}/{partition:04d}-{worker_id:03d}.jsonl"
+
+
+def iter_slice(es_client: Elasticsearch, pit_id: str, slice_id: int, total_slices: int):
+    """
+    Yield edge sources of one slice of the point-in-time, page by page.
+    """
+    search_after = None
+
+    while True:
+        body = {
+            "size": ADJ_SCAN_PAGE_SIZE,
+            "pit": {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE},
+            "sort": ["_shard_doc"],
+        }
+
+        if total_slices > 1:
+            body["slice"] = {"id": slice_id, "max": total_slices}
+
+        if search_after is not None:
+            body["search_after"] = search_after
+
+        with get_metrics().stage("adj_scan") as sample:
+            response = es_client.search(body=body)
+            hits = response["hits"]["hits"]
+            sample["docs"] = len(hits)
+
+        if not hits:
+            break
+
+        yield [hit["_source"] for hit in hits]
+
+        search_after = hits[-1]["sort"]
+
+
+def scan_worker(es_url: str, pit_id: str, worker_id: int, total_workers: int, num_partitions: int, progress_array, snapshots: list):
+    es_client = get_es_client(es_url, request_timeout=300)
+
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(get_partition_path(p, worker_id), "wb")) for p in range(num_partitions)]
+
+        for edges in iter_slice(es_client, pit_id, worker_id, total_workers):
+            with get_metrics().stage("adj_spill") as sample:
+                for edge in edges:
+                    for node_id, direction in ((edge.get("subject"), "out"), (edge.get("object"), "in")):
+                        if node_id is None:
+                            continue
+
+                        record = codec.dumps([node_id, direction, edge])
+                        files[get_partition(node_id, num_partitions)].write(record + b"\n")
+                        sample["docs"] += 1
+                        sample["bytes"] += len(record) + 1
+
+            progress_array[worker_id] += len(edges)
+
+    es_client.close()
+    snapshots.append(get_metrics_snapshot())
+
+
+def group_partition(partition: int) -> dict:
+    """
+    Group spilled records of one partition into node id -> (out_edges, in_edges).
+    """
+    grouped = {}
+
+    for path in sorted(glob.glob(f"{SCAN_DIR}/{partition:04d}-*.jsonl")):
+        with open(path, "rb") as f:
+            for line in f:
+                node_id, direction, edge = codec.loads(line)
+
+                out_edges, in_edges = grouped.setdefault(node_id, ([], []))
+                if direction == "out":
+                    out_edges.append(edge)
+                else:
+                    in_edges.append(edge)
+
+    return grouped
+
+
+def get_partition_node_ids(partition: int) -> set[str]:
+    node_ids = set()
+
+    for path in glob.glob(f"{SCAN_DIR}/{partition:04d}-*.jsonl"):
+        with open(path, "rb") as f:
+            for line in f:
+                node_ids.add(codec.loads(line)[0])
+
+    return node_ids
+
+
+def sort_partition(grouped: dict):
+    for out_edges, in_edges in grouped.values():
+        # same order the per-node engine gets from its id-sorted queries
+        out_edges.sort(key=get_edge_id)
+        in_edges.sort(key=get_edge_id)
+
+
+def generate_partition_actions(grouped: dict):
+    for node_id, (out_edges, in_edges) in grouped.items():
+        yield from make_node_actions(node_id, out_edges, in_edges)
+
+
+def get_edge_id(edge: dict):
+    return edge["id"]
+
+
+def group_worker(es_url: str, partitions: list[int], failed_nodes: list, snapshots: list):
+    es_client = get_es_client(es_url, request_timeout=300)
+
+    # a partition at a time, so only one partition's nodes are held for the stale bucket cleanup
+    for partition in partitions:
+        with get_metrics().stage("adj_group") as sample:
+            grouped = group_partition(partition)
+            sample["docs"] = len(grouped)
+
+        with get_metrics().stage("adj_sort") as sample:
+            sort_partition(grouped)
+            sample["docs"] = len(grouped)
+
+        stale_buckets = StaleBuckets()
+        with get_metrics().stage("adj_bulk") as sample:
+            success, errors = helpers.bulk(
+                es_client,
+                stale_buckets.watch(generate_partition_actions(grouped)),
+                raise_on_error=False,
+                max_chunk_bytes=90 * 1024 * 1024
+            )
+            sample["docs"] = success
+
+        if errors:
+            collect_failed_updates(errors, failed_nodes)
+
+        with get_metrics().stage("adj_stale_buckets") as sample:
+            sample["docs"] = stale_buckets.delete(es_client, failed_nodes)
+
+        get_metrics().inc("adj_nodes", len(grouped))
+        del grouped
+
+    es_client.close()
+    snapshots.append(get_metrics_snapshot())
+
+
+def monitor_scan(progress_array, total_count: int, done):
+    while not done.wait(1):
+        clean_print(f"Scanned {sum(progress_array)}/{total_count} edges", end='')
+
+    print()
+
+
+def run_scan(es_url: str, total_workers: int, failed_nodes: list, snapshots: list):
+    """
+    Build adjacency lists for every node with edges, reading the edge index once.
+    """
+    num_partitions = int(os.getenv("ADJ_SCAN_PARTITIONS", ADJ_SCAN_PARTITIONS))
+
+    es_client = get_es_client(es_url, request_timeout=300)
+    total_edges = es_client.count(index=EDGE_INDEX)["count"]
+    pit_id = es_client.open_point_in_time(index=EDGE_INDEX, keep_alive=PIT_KEEP_ALIVE)["id"]
+
+    shutil.rmtree(SCAN_DIR, ignore_errors=True)
+    os.makedirs(SCAN_DIR, exist_ok=True)
+
+    try:
+        # 1. sliced scan, spilling edges into node partitions
+        with timeit(f"scan {total_edges} edges"):
+            progress_array = multiprocessing.Array('q', [0] * total_workers)
+            done = multiprocessing.Event()
+            monitor_proc = multiprocessing.Process(target=monitor_scan, args=(progress_array, total_edges, done))
+            monitor_proc.start()
+
+            workers = []
+            for i in range(total_workers):
+                p = multiprocessing.Process(target=scan_worker, args=(es_url, pit_id, i, total_workers, num_partitions, progress_array, snapshots))
+                p.start()
+                workers.append(p)
+
+            for p in workers:
+                p.join()
+
+            done.set()
+            monitor_proc.join()
+
+            assert all(p.exitcode == 0 for p in workers), "scan worker failed"
+
+        # 2. group partitions and bulk update
+        with timeit(f"group and update {num_partitions} partitions"):
+            workers = []
+            for i in range(total_workers):
+                partitions = list(range(i, num_partitions, total_workers))
+                p = multiprocessing.Process(target=group_worker, args=(es_url, partitions, failed_nodes, snapshots))
+                p.start()
+                workers.append((p, partitions))
+
+            for p, _ in workers:
+                p.join()
+
+            # a worker that died took its partitions with it, their nodes count as failed before the spill files go
+            for p, partitions in workers:
+                if p.exitcode != 0:
+                    node_ids = set().union(*map(get_partition_node_ids, partitions))
+                    clean_print(f"❌ group worker exited with {p.exitcode}, {len(node_ids)} nodes of its partitions failed")
+                    failed_nodes.extend(sorted(node_ids))
+
+    finally:
+        es_client.close_point_in_time(id=pit_id)
+        es_client.close()
+        shutil.rmtree(SCAN_DIR, ignore_errors=True)
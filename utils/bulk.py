@@ -0,0 +1,218 @@
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable
+
+from elasticsearch import Elasticsearch, ApiError, TransportError
+from elasticsearch.helpers import expand_action
+
+from utils import codec
+from utils.constants import BULK_CHUNK_BYTES, BULK_MAX_CONCURRENCY, BULK_MAX_RETRIES, BULK_TARGET_LATENCY, \
+    BULK_MAX_BACKOFF, RETRYABLE_STATUS
+from utils.metrics import get_metrics
+
+
+def get_bulk_max_concurrency():
+    return int(os.getenv("BULK_MAX_CONCURRENCY", BULK_MAX_CONCURRENCY))
+
+
+class BulkWriteError(Exception):
+    """
+    Docs that still failed after retries, so the batch they belong to counts as failed.
+    """
+
+    def __init__(self, failures: list[dict]):
+        super().__init__(f"{len(failures)} docs failed to index")
+        self.failures = failures
+
+    def __reduce__(self):
+        # dask sends task errors back pickled
+        return self.__class__, (self.failures,)
+
+
+class BulkItem:
+    __slots__ = ("doc_id", "lines", "size", "attempt", "not_before")
+
+    def __init__(self, doc_id: str, lines: list[bytes]):
+        self.doc_id = doc_id
+        self.lines = lines
+        self.size = sum(len(line) + 1 for line in lines)
+        self.attempt = 0
+        self.not_before = 0
+
+
+class AdaptiveBulkWriter:
+    """
+    Bulk writer that keeps several requests in flight and adapts to how the cluster copes.
+
+    - requests are cut by serialized bytes, not by doc count
+    - items rejected with 429, and whole requests failing with 429/5xx or a
+      transport error, are retried with exponential backoff and jitter
+    - concurrency is halved on rejections, grows by one while requests come back
+      under the target latency and shrinks by one when they come back slower
+      than twice that
+
+    One writer per worker, so what it learns about the cluster carries over between batches.
+    """
+
+    def __init__(self, es_client: Elasticsearch, max_chunk_bytes: int | None = None, max_concurrency: int | None = None,
+                 max_retries=BULK_MAX_RETRIES, target_latency=BULK_TARGET_LATENCY, request_timeout=240):
+        self.es_client = es_client
+        self.max_chunk_bytes = max_chunk_bytes or int(os.getenv("BULK_CHUNK_BYTES", BULK_CHUNK_BYTES))
+        self.max_concurrency = max_concurrency or get_bulk_max_concurrency()
+        self.max_retries = max_retries
+        self.target_latency = target_latency
+        self.request_timeout = request_timeout
+
+        self.concurrency = min(2, self.max_concurrency)
+
+        self.requests = 0
+        self.rejections = 0
+
+    def write(self, actions: Iterable[dict]) -> tuple[int, list[dict]]:
+        """
+        Send all actions.
+
+        :return: (number of successful items, list of every item that failed for good)
+        """
+        self._source = iter(actions)
+        self._peeked = None
+        self._retries = deque()
+        self._success = 0
+        self._failures = []
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            in_flight = {}
+
+            while True:
+                while len(in_flight) < self.concurrency:
+                    chunk = self._next_chunk()
+                    if not chunk:
+                        break
+                    in_flight[executor.submit(self._send, chunk)] = chunk
+
+                if not in_flight:
+                    if not self._retries:
+                        break
+
+                    # everything left is waiting out a backoff
+                    time.sleep(max(0, min(item.not_before for item in self._retries) - time.monotonic()))
+                    continue
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = in_flight.pop(future)
+                    self._handle(chunk, *future.result())
+
+        return self._success, self._failures
+
+    def _next_item(self) -> BulkItem | None:
+        now = time.monotonic()
+
+        # due retries go first
+        for _ in range(len(self._retries)):
+            item = self._retries.popleft()
+            if item.not_before <= now:
+                return item
+            self._retries.append(item)
+
+        action = next(self._source, None)
+        if action is None:
+            return None
+
+        meta, body = expand_action(action)
+        op_type = next(iter(meta))
+        lines = [codec.dumps(meta)]
+        if body is not None:
+            lines.append(codec.dumps(body))
+
+        return BulkItem(meta[op_type].get("_id"), lines)
+
+    def _next_chunk(self) -> list[BulkItem]:
+        chunk = []
+        chunk_bytes = 0
+
+        while True:
+            item = self._peeked if self._peeked is not None else self._next_item()
+            self._peeked = None
+
+            if item is None:
+                break
+
+            if chunk and chunk_bytes + item.size > self.max_chunk_bytes:
+                self._peeked = item
+                break
+
+            chunk.append(item)
+            chunk_bytes += item.size
+
+        return chunk
+
+    def _send(self, chunk: list[BulkItem]):
+        operations = [line for item in chunk for line in item.lines]
+        start = time.monotonic()
+
+        try:
+            response = self.es_client.bulk(operations=operations, request_timeout=self.request_timeout)
+            error = None
+        except ApiError as e:
+            response, error = None, e
+        except TransportError as e:
+            response, error = None, e
+
+        latency = time.monotonic() - start
+        get_metrics().observe("bulk_request", latency, len(chunk), sum(item.size for item in chunk))
+
+        return response, latency, error
+
+    def _handle(self, chunk: list[BulkItem], response, latency: float, error: Exception | None):
+        self.requests += 1
+
+        if error is not None:
+            status = getattr(error, "status_code", None)
+            retryable = status is None or status in RETRYABLE_STATUS
+
+            for item in chunk:
+                self._retry_or_fail(item, status, str(error), retryable)
+
+            self._adjust(latency, rejected=retryable)
+            return
+
+        rejected = False
+        for item, result in zip(chunk, response["items"]):
+            op = next(iter(result.values()))
+            status = op.get("status", 500)
+
+            if status < 300:
+                self._success += 1
+                continue
+
+            is_rejection = status == 429
+            rejected = rejected or is_rejection
+            self._retry_or_fail(item, status, op.get("error"), is_rejection)
+
+        self._adjust(latency, rejected=rejected)
+
+    def _retry_or_fail(self, item: BulkItem, status: int | None, error, retryable: bool):
+        if retryable and item.attempt < self.max_retries:
+            backoff = min(BULK_MAX_BACKOFF, 2 ** item.attempt)
+            item.attempt += 1
+            item.not_before = time.monotonic() + backoff * random.uniform(0.5, 1.5)
+            self._retries.append(item)
+            get_metrics().inc("bulk_retries")
+            return
+
+        get_metrics().inc("bulk_failures")
+        self._failures.append({"_id": item.doc_id, "status": status, "error": error, "attempts": item.attempt + 1})
+
+    def _adjust(self, latency: float, rejected: bool):
+        if rejected:
+            self.rejections += 1
+            get_metrics().inc("bulk_rejections")
+            self.concurrency = max(1, self.concurrency // 2)
+        elif latency < self.target_latency:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        elif latency > 2 * self.target_latency:
+            self.concurrency = max(1, self.concurrency - 1)
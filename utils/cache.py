@@ -0,0 +1,121 @@
+import os
+from collections import OrderedDict
+
+from utils import codec
+from utils.constants import NODE_CACHE_MAX_ENTRIES, NODE_CACHE_MAX_BYTES
+
+
+class NodeCache:
+    """
+    Size-bounded LRU cache for node `_source` documents.
+
+    Lives on a single worker, so it needs no locking. Eviction kicks in when
+    either the entry count or the approximate byte size goes over its limit.
+    """
+
+    def __init__(self, max_entries: int = NODE_CACHE_MAX_ENTRIES, max_bytes: int = NODE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # node id -> (source, approx size in bytes)
+        self._entries = OrderedDict()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, ids: list[str]) -> tuple[dict, list[str]]:
+        """
+        Look up given ids.
+
+        :param ids: a list of node ids
+        :return: (dict of cached id -> source, list of ids not in cache)
+        """
+        found = {}
+        missing = []
+
+        for _id in ids:
+            entry = self._entries.get(_id)
+            if entry is None:
+                missing.append(_id)
+                continue
+
+            self._entries.move_to_end(_id)
+            found[_id] = entry[0]
+
+        self.hits += len(found)
+        self.misses += len(missing)
+
+        return found, missing
+
+    def put_many(self, details: dict):
+        for _id, source in details.items():
+            self.put(_id, source)
+
+    def put(self, _id: str, source: dict):
+        size = approx_size(_id, source)
+
+        # never cache something that could not fit on its own
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+
+        previous = self._entries.pop(_id, None)
+        if previous is not None:
+            self.current_bytes -= previous[1]
+
+        self._entries[_id] = (source, size)
+        self.current_bytes += size
+
+        self._evict()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+        }
+
+
+def approx_size(_id: str, source: dict) -> int:
+    # serialized length is a good enough proxy for what the entry costs us
+    return len(_id) + len(codec.dumps(source))
+
+
+def make_node_cache() -> NodeCache:
+    max_entries = int(os.getenv("NODE_CACHE_MAX_ENTRIES", NODE_CACHE_MAX_ENTRIES))
+    max_bytes = int(os.getenv("NODE_CACHE_MAX_BYTES", NODE_CACHE_MAX_BYTES))
+
+    return NodeCache(max_entries=max_entries, max_bytes=max_bytes)
+
+
+def merge_cache_stats(all_stats: list[dict]) -> dict:
+    merged = {}
+    for stats in all_stats:
+        if not stats:
+            continue
+        for key, value in stats.items():
+            merged[key] = merged.get(key, 0) + value
+
+    return merged
+
+
+def print_cache_stats(stats: dict):
+    hits = stats.get("hits", 0)
+    misses = stats.get("misses", 0)
+    total = hits + misses
+    ratio = hits / total if total else 0
+
+    print(f"Node cache: {hits} hits, {misses} misses ({ratio:.1%} hit rate), "
+          f"{stats.get('evictions', 0)} evictions, {stats.get('entries', 0)} entries cached")
@@ -0,0 +1,75 @@
+import glob
+import json
+import os
+import uuid
+
+from utils.constants import RUNS_DIR
+
+
+def get_run_id():
+    return uuid.uuid4().hex[:10]
+
+
+class RunManifest:
+    """
+    Durable record of a run, kept under runs/<run_id>.
+
+    `manifest.json` holds what the run was started with, so a resumed run does
+    the exact same work. Progress goes to append-only `progress-<writer>.jsonl`
+    files, one per writing process, each entry flushed and fsync'd before the
+    work it describes is considered done.
+    """
+
+    def __init__(self, run_id: str, params: dict):
+        self.run_id = run_id
+        self.params = params
+        self.run_dir = f"{RUNS_DIR}/{run_id}"
+
+    @classmethod
+    def create(cls, run_id: str, kind: str, params: dict) -> "RunManifest":
+        manifest = cls(run_id, {"kind": kind, **params})
+        os.makedirs(manifest.run_dir, exist_ok=True)
+
+        tmp_path = f"{manifest.run_dir}/manifest.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest.params, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, f"{manifest.run_dir}/manifest.json")
+
+        return manifest
+
+    @classmethod
+    def load(cls, run_id: str, kind: str) -> "RunManifest":
+        path = f"{RUNS_DIR}/{run_id}/manifest.json"
+        assert os.path.exists(path), f"no manifest for run {run_id} at {path}"
+
+        with open(path, "rb") as f:
+            params = json.load(f)
+
+        assert params["kind"] == kind, f"run {run_id} is a {params['kind']} run, not {kind}"
+
+        return cls(run_id, params)
+
+    def record(self, entry: dict, writer="main"):
+        with open(f"{self.run_dir}/progress-{writer}.jsonl", "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_progress(self) -> list[dict]:
+        entries = []
+
+        for path in sorted(glob.glob(f"{self.run_dir}/progress-*.jsonl")):
+            with open(path, "rb") as f:
+                for line in f:
+                    # a crash mid-write can leave a partial last line, that work just gets redone
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+        return entries
+
+    def get_completed(self, key: str) -> set:
+        return {entry[key] for entry in self.get_progress() if key in entry}
@@ -0,0 +1,66 @@
+"""
+One place for JSON encoding and decoding.
+
+Uses orjson, or msgspec, when installed and falls back to the stdlib `json`.
+Set JSON_CODEC=stdlib to force the fallback.
+
+- `loads` takes bytes (or str) straight from files and responses.
+- `dumps` gives compact utf-8 bytes, for es request bodies and our own spill files.
+- `dumps_compat` gives exactly what `json.dumps(obj)` gives. Output files have
+  to stay byte-compatible, and neither fast encoder can produce the stdlib's
+  `", "`/`": "` separators and ascii escaping, so it stays on the stdlib.
+"""
+
+import json
+import os
+
+NAME = "stdlib"
+
+if os.getenv("JSON_CODEC") != "stdlib":
+    try:
+        import orjson
+        NAME = "orjson"
+    except ImportError:
+        try:
+            import msgspec
+            NAME = "msgspec"
+        except ImportError:
+            pass
+
+
+if NAME == "orjson":
+    def loads(data: bytes | str):
+        return orjson.loads(data)
+
+    def dumps(obj, default=None) -> bytes:
+        return orjson.dumps(obj, default=default)
+
+elif NAME == "msgspec":
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder()
+
+    def loads(data: bytes | str):
+        return _decoder.decode(data)
+
+    def dumps(obj, default=None) -> bytes:
+        if default is not None:
+            return msgspec.json.encode(obj, enc_hook=default)
+        return _encoder.encode(obj)
+
+else:
+    def loads(data: bytes | str):
+        return json.loads(data)
+
+    def dumps(obj, default=None) -> bytes:
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":")).encode("utf-8", "surrogatepass")
+
+
+def load(f):
+    """
+    Decode a whole file opened in binary mode.
+    """
+    return loads(f.read())
+
+
+def dumps_compat(obj) -> str:
+    return json.dumps(obj)
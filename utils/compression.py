@@ -0,0 +1,191 @@
+"""
+Compressed inputs and outputs, picked by file suffix.
+
+Inputs are opened as seekable streams of their decompressed bytes, so byte
+offsets keep meaning "position in the uncompressed file" and workers can still
+jump straight to their batch:
+
+- `.zst` in the seekable zstd format is read with `pyzstd.SeekableZstdFile`,
+  which only decompresses the frames a read touches.
+- `.gz` is read with `indexed_gzip`, using a block index (`<file>.gzidx`)
+  built once up front by `prepare_input` and shared by all workers. Like the
+  line index, it is stamped with the size and mtime of the input
+  (`<file>.gzidx.stamp`) and rebuilt once they stop matching.
+
+Workers keep their inputs open across tasks (`get_input`), so an index is
+imported once per process, not once per batch.
+
+Both packages are optional, only needed for compressed inputs
+(`pip install pyzstd indexed_gzip`). Plain zstd or gzip files, or gzip
+without `indexed_gzip`, still work but every seek decompresses from the start.
+
+Outputs are compressed per batch on the workers. Concatenated gzip members
+and concatenated zstd frames are valid files themselves, so batches can
+still be stitched by plain byte copies.
+"""
+
+import gzip
+import importlib
+import os
+import struct
+import warnings
+
+from utils.constants import GZIP_INDEX_SPACING, OUTPUT_COMPRESSION_LEVELS
+from utils.executor import get_worker_resource
+
+SUFFIXES = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+GZIP_INDEX_MAGIC = b"RTXGZIX1"
+GZIP_INDEX_STAMP = struct.Struct("<8sQQ")
+
+
+def get_compression(path: str) -> str | None:
+    for compression, suffix in SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+
+    return None
+
+
+def get_gzip_index_path(path: str) -> str:
+    return f"{path}.gzidx"
+
+
+def get_gzip_index_stamp_path(path: str) -> str:
+    return f"{get_gzip_index_path(path)}.stamp"
+
+
+def get_gzip_index_stamp(path: str) -> bytes:
+    stat = os.stat(path)
+
+    return GZIP_INDEX_STAMP.pack(GZIP_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns)
+
+
+def has_gzip_index(path: str) -> bool:
+    """
+    Whether there is a gzip index built from `path` as it is on disk now.
+    """
+    if not os.path.exists(get_gzip_index_path(path)):
+        return False
+
+    try:
+        with open(get_gzip_index_stamp_path(path), "rb") as f:
+            return f.read() == get_gzip_index_stamp(path)
+    except FileNotFoundError:
+        return False
+
+
+def import_optional(name: str):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def prepare_input(path: str):
+    """
+    Build whatever random access into a compressed input needs, once, before workers start.
+    """
+    if get_compression(path) != "gzip":
+        return
+
+    indexed_gzip = import_optional("indexed_gzip")
+    index_path = get_gzip_index_path(path)
+
+    if indexed_gzip is None or has_gzip_index(path):
+        return
+
+    stamp_path = get_gzip_index_stamp_path(path)
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+
+    print(f"Building gzip index {index_path}")
+    with indexed_gzip.IndexedGzipFile(path, spacing=GZIP_INDEX_SPACING) as f:
+        f.build_full_index()
+        f.export_index(f"{index_path}.tmp")
+
+    # the stamp goes last, an index without one is never used
+    os.replace(f"{index_path}.tmp", index_path)
+    with open(stamp_path, "wb") as f:
+        f.write(get_gzip_index_stamp(path))
+
+
+def open_input(path: str):
+    """
+    Open a possibly compressed file for reading its decompressed bytes, seekable.
+    """
+    compression = get_compression(path)
+
+    if compression is None:
+        return open(path, "rb")
+
+    if compression == "zstd":
+        pyzstd = import_optional("pyzstd")
+        assert pyzstd is not None, f"reading {path} needs pyzstd"
+
+        try:
+            return pyzstd.SeekableZstdFile(path, "r")
+        except pyzstd.SeekableFormatError:
+            warnings.warn(f"{path} is not in the seekable zstd format, seeking will decompress from the start")
+            return pyzstd.ZstdFile(path, "r")
+
+    indexed_gzip = import_optional("indexed_gzip")
+    if indexed_gzip is None:
+        warnings.warn(f"indexed_gzip not installed, seeking in {path} will decompress from the start")
+        return gzip.open(path, "rb")
+
+    if has_gzip_index(path):
+        return indexed_gzip.IndexedGzipFile(path, index_file=get_gzip_index_path(path))
+
+    return indexed_gzip.IndexedGzipFile(path, spacing=GZIP_INDEX_SPACING)
+
+
+def get_input(path: str):
+    """
+    The worker's open_input of `path`, kept open across its tasks. Seek before reading, and don't close it.
+    """
+    return get_worker_resource(f"input:{path}", lambda: open_input(path))
+
+
+def get_input_size(path: str) -> int:
+    """
+    Size of the decompressed content.
+    """
+    if get_compression(path) is None:
+        return os.path.getsize(path)
+
+    with open_input(path) as f:
+        # indexed_gzip only seeks from the end once its index covers the whole file
+        if hasattr(f, "build_full_index"):
+            f.build_full_index()
+
+        return f.seek(0, os.SEEK_END)
+
+
+def get_output_compression() -> str | None:
+    compression = os.getenv("OUTPUT_COMPRESSION") or None
+    assert compression is None or compression in SUFFIXES, f"unknown OUTPUT_COMPRESSION {compression}"
+
+    return compression
+
+
+def get_output_suffix(compression: str | None) -> str:
+    return SUFFIXES[compression] if compression is not None else ""
+
+
+def compress(data: bytes, compression: str | None) -> bytes:
+    if compression is None:
+        return data
+
+    level = OUTPUT_COMPRESSION_LEVELS[compression]
+
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=level)
+
+    pyzstd = import_optional("pyzstd")
+    assert pyzstd is not None, "zstd output needs pyzstd"
+
+    return pyzstd.compress(data, level)
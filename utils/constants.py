@@ -4,7 +4,116 @@ BATCH_SIZE = 10000
 NODE_INDEX="rtx_kg2_nodes"
 EDGE_INDEX="rtx_kg2_edges"
 TEMP_DIR="temp_output"
-OFFSET_OUTPUT="offsets.json"
 THREADS_PER_WORKER=1
 
 ADJ_INDEX="rtx_kg2_nodes_adjacency_list"
+
+# per-worker node cache limits, overridable via env
+NODE_CACHE_MAX_ENTRIES=500000
+NODE_CACHE_MAX_BYTES=1024 * 1024 * 1024
+
+# offline merge: memory budget for an in-memory hash join, and how much larger
+# a jsonl file gets once parsed into python dicts
+OFFLINE_MEMORY_LIMIT_MB=4096
+NODE_MEMORY_FACTOR=5
+
+# mget sub-requests: max ids and id payload bytes per request, requests in flight per worker, retries per sub-request
+MGET_CHUNK_SIZE=1000
+MGET_CHUNK_BYTES=256 * 1024
+MGET_CONCURRENCY=4
+MGET_RETRIES=3
+
+# single-pass adjacency scan: hits per page and number of on-disk node partitions
+ADJ_SCAN_PAGE_SIZE=10000
+ADJ_SCAN_PARTITIONS=256
+
+# out-of-core adjacency build: total sort buffer across workers, and max runs merged at once
+ADJ_SORT_MEMORY_MB=2048
+ADJ_SORT_MAX_FANIN=256
+
+# adjacency work units per worker, more units means finer work stealing
+UNITS_PER_WORKER=20
+
+# nodes with more edges than this are split into bucket docs of ADJ_BUCKET_SIZE edges,
+# keeping each doc well under index.mapping.nested_objects.limit
+ADJ_SUPER_NODE_THRESHOLD=40000
+ADJ_BUCKET_SIZE=20000
+
+# stale bucket cleanup: regular node ids per delete_by_query, and super nodes, which take two clauses each
+ADJ_SWEEP_NODES=10000
+ADJ_SWEEP_SUPER_NODES=500
+
+# adjacency node engine: nodes packed into one msearch for their first page of edges
+ADJ_MSEARCH_PACK=50
+
+# run manifests for --resume
+RUNS_DIR="runs"
+
+# buffer size when a stitch has to fall back to copying in user space
+COPY_CHUNK_BYTES=8 * 1024 * 1024
+
+# compressed io: distance between gzip index seek points, and output compression levels
+GZIP_INDEX_SPACING=4 * 1024 * 1024
+OUTPUT_COMPRESSION_LEVELS={"gzip": 6, "zstd": 3}
+
+# statuses worth retrying on es requests
+RETRYABLE_STATUS={429, 502, 503, 504}
+
+# adaptive bulk writes: max serialized bytes per request, max requests in flight per worker,
+# retries per item, latency below which concurrency grows (seconds), and backoff cap (seconds)
+BULK_CHUNK_BYTES=10 * 1024 * 1024
+BULK_MAX_CONCURRENCY=8
+BULK_MAX_RETRIES=5
+BULK_TARGET_LATENCY=2.0
+BULK_MAX_BACKOFF=60
+
+# index builds: settings while bulk loading, and once the index goes live (replicas overridable via INDEX_REPLICAS)
+INDEX_LOAD_SETTINGS={
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": 0,
+    "index.translog.durability": "async",
+    "index.translog.flush_threshold_size": "2gb",
+}
+INDEX_SERVE_SETTINGS={
+    "index.refresh_interval": "1s",
+    "index.number_of_replicas": 0,
+    "index.translog.durability": "request",
+    "index.translog.flush_threshold_size": "512mb",
+}
+
+# upper bounds (seconds) of the stage latency histogram buckets, see utils.metrics
+METRICS_LATENCY_BUCKETS=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# binary node id list written by utils/node_id_extractor.py, see utils.node_ids
+NODE_IDS_FILE="./nodes_id.bin"
+
+# per-line offset index of an input, see utils.make_offsets: file suffix, bytes scanned per
+# task, and how many samples of how many bytes go into the input hash it is stamped with
+LINE_INDEX_SUFFIX=".lineidx"
+LINE_INDEX_SCAN_CHUNK=64 * 1024 * 1024
+LINE_INDEX_HASH_SAMPLES=16
+LINE_INDEX_HASH_SAMPLE_BYTES=64 * 1024
+
+# env vars that worker-side code reads, copied to workers of a dask cluster on other hosts, see utils.executor
+WORKER_ENV=(
+    "INDEX_NAME", "ADJACENCY_LIST_INDEX_NAME", "ADJACENCY_TARGET_INDEX", "OUTPUT_COMPRESSION", "JSON_CODEC",
+    "MGET_CHUNK_SIZE", "MGET_CHUNK_BYTES", "MGET_CONCURRENCY", "BULK_CHUNK_BYTES", "BULK_MAX_CONCURRENCY",
+    "NODE_CACHE_MAX_ENTRIES", "NODE_CACHE_MAX_BYTES", "ADJ_SUPER_NODE_THRESHOLD", "ADJ_BUCKET_SIZE",
+    "WORKER_MEMORY_LIMIT_MB", "NODE_FIELDS", "ADJ_NEW_BUILD",
+)
+
+# delta re-merge, see utils.delta: where the recorded release is kept (overridable via RELEASE_STATE),
+# and bytes per node and edge hash
+RELEASE_STATE_FILE="./release_state.sqlite"
+RELEASE_HASH_BYTES=16
+
+# pipelined merge engine, see utils.pipeline: batches queued between stages, and max batches per task
+PIPELINE_DEPTH=2
+PIPELINE_GROUP_SIZE=8
+
+# streamed batches (WORKER_MEMORY_LIMIT_MB set): edges in the first sub-batch, fewest edges per sub-batch,
+# bytes read from the input at a time, and edges sampled to estimate the size of an edge
+STREAM_SUB_BATCH=1000
+STREAM_MIN_SUB_BATCH=50
+STREAM_READ_CHUNK=1024 * 1024
+STREAM_SIZE_SAMPLE=20
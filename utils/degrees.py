@@ -0,0 +1,124 @@
+import json
+import os
+
+from elasticsearch import Elasticsearch
+
+from utils import codec
+from utils.constants import EDGE_INDEX, UNITS_PER_WORKER
+
+POSITIONS = ("subject", "object")
+
+
+def load_degree_table(target_file: str) -> dict:
+    with open(target_file, "rb") as f:
+        return codec.load(f)
+
+
+def build_degree_table(es_client: Elasticsearch, target_file: str) -> dict:
+    """
+    Count edges per node over the whole edge index with composite aggregations, and save them as {node id: degree}.
+    """
+    degrees = {}
+
+    for position in POSITIONS:
+        after = None
+        while True:
+            composite = {
+                "size": 10000,
+                "sources": [{"node": {"terms": {"field": f"{position}.keyword"}}}],
+            }
+            if after is not None:
+                composite["after"] = after
+
+            response = es_client.search(index=EDGE_INDEX, body={"size": 0, "aggs": {"nodes": {"composite": composite}}})
+            agg = response["aggregations"]["nodes"]
+
+            for bucket in agg["buckets"]:
+                node_id = bucket["key"]["node"]
+                degrees[node_id] = degrees.get(node_id, 0) + bucket["doc_count"]
+
+            after = agg.get("after_key")
+            if after is None or not agg["buckets"]:
+                break
+
+    with open(target_file, "w") as f:
+        json.dump(degrees, f)
+
+    return degrees
+
+
+def get_degree_table(es_client: Elasticsearch, target_file: str) -> dict:
+    if os.path.exists(target_file):
+        return load_degree_table(target_file)
+
+    print(f"Building degree table {target_file}")
+    return build_degree_table(es_client, target_file)
+
+
+def fetch_degrees(es_client: Elasticsearch, node_ids: list[str], chunk_size=1000) -> dict:
+    """
+    Count edges for given nodes only, with terms aggregations restricted to those ids.
+    """
+    degrees = {}
+
+    for i in range(0, len(node_ids), chunk_size):
+        chunk = node_ids[i:i + chunk_size]
+
+        for position in POSITIONS:
+            field = f"{position}.keyword"
+            body = {
+                "size": 0,
+                "query": {"terms": {field: chunk}},
+                "aggs": {"nodes": {"terms": {"field": field, "include": chunk, "size": len(chunk)}}},
+            }
+            response = es_client.search(index=EDGE_INDEX, body=body)
+
+            for bucket in response["aggregations"]["nodes"]["buckets"]:
+                degrees[bucket["key"]] = degrees.get(bucket["key"], 0) + bucket["doc_count"]
+
+    return degrees
+
+
+def plan_work_units(node_ids: list[str], degrees: dict | None, total_workers: int, min_unit_cost: int = 1) -> list[tuple[int, int]]:
+    """
+    Cut node ids into contiguous (start, end) ranges of roughly equal estimated cost, heaviest first.
+
+    Cost of a node is its degree plus one for the request itself. Nodes costing more than a
+    whole unit get a unit of their own. Without degrees every node costs the same.
+
+    :param min_unit_cost: units cost at least this much, e.g. the msearch pack size, so that
+                          small or degree-less runs still put enough nodes in a unit to pack
+    """
+    def get_cost(node_id: str):
+        return 1 + (degrees.get(node_id, 0) if degrees else 0)
+
+    costs = list(map(get_cost, node_ids))
+    target = max(1, min_unit_cost, sum(costs) // (total_workers * UNITS_PER_WORKER))
+
+    units = []
+    start = 0
+    unit_cost = 0
+
+    for index, cost in enumerate(costs):
+        # hub node, close the current unit and give it its own
+        if cost >= target:
+            if index > start:
+                units.append((unit_cost, start, index))
+            units.append((cost, index, index + 1))
+            start = index + 1
+            unit_cost = 0
+            continue
+
+        unit_cost += cost
+        if unit_cost >= target:
+            units.append((unit_cost, start, index + 1))
+            start = index + 1
+            unit_cost = 0
+
+    if start < len(node_ids):
+        units.append((unit_cost, start, len(node_ids)))
+
+    # largest first, so the long tail is made of small units any idle worker can pick up
+    units.sort(key=lambda unit: unit[0], reverse=True)
+
+    return [(start, end) for _, start, end in units]
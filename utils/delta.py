@@ -0,0 +1,275 @@
+"""
+Delta re-merge (`merge_index.py --delta`).
+
+What the merged index was built from is kept as a release state, a sqlite file:
+
+- `nodes(id, hash)`: hash of every node as it gets embedded, so with `NODE_FIELDS` applied
+- `edges(id, hash, subject, object, line)`: hash of every edge line and where it is in the edges dump
+- indexes on `edges(subject)` and `edges(object)`, the reverse node -> edge index
+- `meta`: the `NODE_FIELDS` the node hashes were taken with
+
+A delta run hashes the new nodes and edges dumps into a new state and diffs it
+against the recorded one. Merged edges to write again are the edges added or
+changed, plus the edges of every node added, changed or removed. Edges gone
+from the new release are deleted. The lines of affected edges are copied into
+a delta edges file, which goes through the usual batches. Edges added, changed,
+moved or removed also go into an adjacency changes file, for
+`merge_adjacency_list.py --engine changes`. The new state only
+replaces the recorded one once the run is done, so a failed run can be resumed
+or redone from the same starting point.
+
+Hashes are taken over records as they are in the dumps, key order included.
+A dump with keys in another order only means more edges get written, never fewer.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+from elasticsearch import Elasticsearch
+
+from utils import codec
+from utils.bulk import AdaptiveBulkWriter
+from utils.compression import open_input
+from utils.constants import RELEASE_STATE_FILE, RELEASE_HASH_BYTES
+from utils.metrics import get_metrics
+from utils.offline import iter_lines
+from utils.projection import get_node_fields, project_source
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE nodes (id TEXT PRIMARY KEY, hash BLOB) WITHOUT ROWID;
+CREATE TABLE edges (id TEXT PRIMARY KEY, hash BLOB, subject TEXT, object TEXT, line INTEGER) WITHOUT ROWID;
+"""
+
+# built once edges are in, faster than keeping them up to date row by row
+REVERSE_INDEX = """
+CREATE INDEX edges_subject ON edges (subject);
+CREATE INDEX edges_object ON edges (object);
+"""
+
+# `old` is the recorded release, the main database the new one
+DIFF = """
+CREATE TEMP TABLE changed_nodes (id TEXT PRIMARY KEY) WITHOUT ROWID;
+INSERT INTO changed_nodes
+    SELECT n.id FROM nodes n LEFT JOIN old.nodes o ON o.id = n.id WHERE o.hash IS NULL OR o.hash != n.hash;
+INSERT OR IGNORE INTO changed_nodes
+    SELECT o.id FROM old.nodes o LEFT JOIN nodes n ON n.id = o.id WHERE n.id IS NULL;
+
+CREATE TEMP TABLE changed_edges (line INTEGER PRIMARY KEY);
+INSERT INTO changed_edges
+    SELECT e.line FROM edges e LEFT JOIN old.edges o ON o.id = e.id WHERE o.hash IS NULL OR o.hash != e.hash;
+
+CREATE TEMP TABLE affected (line INTEGER PRIMARY KEY);
+INSERT INTO affected SELECT line FROM changed_edges;
+INSERT OR IGNORE INTO affected
+    SELECT e.line FROM changed_nodes c JOIN edges e ON e.subject = c.id;
+INSERT OR IGNORE INTO affected
+    SELECT e.line FROM changed_nodes c JOIN edges e ON e.object = c.id;
+"""
+
+REMOVED = "SELECT o.id, o.subject, o.object FROM old.edges o LEFT JOIN edges e ON e.id = o.id WHERE e.id IS NULL"
+
+# changed edges whose subject or object is not what it was, their old nodes have to let go of them
+MOVED = "SELECT o.id, o.subject, o.object FROM old.edges o JOIN edges e ON e.id = o.id WHERE o.subject IS NOT e.subject OR o.object IS NOT e.object"
+
+
+def get_release_state_path() -> str:
+    return os.getenv("RELEASE_STATE") or RELEASE_STATE_FILE
+
+
+def hash_record(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=RELEASE_HASH_BYTES).digest()
+
+
+def iter_node_hashes(nodes_file: str, fields: list[str] | None):
+    for line in iter_lines(nodes_file):
+        node = codec.loads(line)
+        if fields is not None:
+            line = codec.dumps(project_source(node, fields))
+
+        yield node["id"], hash_record(line)
+
+
+def iter_edge_hashes(edges_file: str):
+    # line numbers count blank lines too, the same as copy_lines reading them back
+    with open_input(edges_file) as f:
+        for line_number, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+
+            edge = codec.loads(line)
+            yield edge["id"], hash_record(line), edge.get("subject"), edge.get("object"), line_number
+
+
+def record_release(nodes_file: str, edges_file: str, state_path: str):
+    """
+    Hash a release into a new state file at `state_path`, replacing whatever is there.
+    """
+    tmp_path = f"{state_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    fields = get_node_fields()
+    conn = sqlite3.connect(tmp_path)
+
+    try:
+        # a half written state is thrown away anyway
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(SCHEMA)
+        conn.execute("INSERT INTO meta VALUES ('node_fields', ?)", (json.dumps(fields),))
+
+        with get_metrics().stage("hash_nodes") as sample:
+            # like the node index, a later duplicate replaces an earlier one
+            conn.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?)", iter_node_hashes(nodes_file, fields))
+            sample["docs"] = conn.execute("SELECT count(*) FROM nodes").fetchone()[0]
+
+        with get_metrics().stage("hash_edges") as sample:
+            # like load_edges_from_file, the first of duplicated edges wins
+            conn.executemany("INSERT OR IGNORE INTO edges VALUES (?, ?, ?, ?, ?)", iter_edge_hashes(edges_file))
+            conn.executescript(REVERSE_INDEX)
+            sample["docs"] = conn.execute("SELECT count(*) FROM edges").fetchone()[0]
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, state_path)
+
+
+def iter_lines_at(f, line_numbers):
+    """
+    The lines of f at `line_numbers`, ascending, without their line ends.
+    """
+    wanted = next(line_numbers, None)
+
+    for line_number, line in enumerate(f):
+        if wanted is None:
+            break
+
+        if line_number == wanted:
+            yield line.rstrip(b"\r\n")
+            wanted = next(line_numbers, None)
+
+
+def make_delete_change(edge_id: str, subject: str | None, object_: str | None) -> bytes:
+    return codec.dumps({"op": "delete", "edge": {"id": edge_id, "subject": subject, "object": object_}}) + b"\n"
+
+
+def diff_releases(old_path: str, new_path: str, edges_file: str, delta_file: str, removed_file: str, changes_file: str) -> dict:
+    """
+    Diff two release states, copying the lines of affected edges into `delta_file`,
+    the ids of removed edges into `removed_file`, one per line, and the edge
+    changes into `changes_file`, see utils.adjacency_changes.
+
+    :param edges_file: the edges dump `new_path` was recorded from
+    :return: counts of changed nodes, affected edges and removed edges
+    """
+    conn = sqlite3.connect(new_path)
+
+    try:
+        conn.execute("ATTACH DATABASE ? AS old", (old_path,))
+
+        recorded = conn.execute("SELECT value FROM old.meta WHERE key = 'node_fields'").fetchone()[0]
+        current = conn.execute("SELECT value FROM meta WHERE key = 'node_fields'").fetchone()[0]
+        assert recorded == current, f"NODE_FIELDS changed since the recorded release ({recorded} -> {current}), do a full run instead"
+
+        with get_metrics().stage("diff") as sample:
+            conn.executescript(DIFF)
+
+            affected = 0
+            with open_input(edges_file) as f, open(delta_file, "wb") as out:
+                line_numbers = (line for line, in conn.execute("SELECT line FROM affected ORDER BY line"))
+                for line in iter_lines_at(f, line_numbers):
+                    out.write(line + b"\n")
+                    affected += 1
+
+            removed = 0
+            with open(removed_file, "w") as out, open(changes_file, "wb") as changes:
+                for edge_id, subject, object_ in conn.execute(REMOVED):
+                    out.write(edge_id + "\n")
+                    changes.write(make_delete_change(edge_id, subject, object_))
+                    removed += 1
+
+                for edge_id, subject, object_ in conn.execute(MOVED):
+                    changes.write(make_delete_change(edge_id, subject, object_))
+
+                # edges are already json, wrapped as they are
+                with open_input(edges_file) as f:
+                    line_numbers = (line for line, in conn.execute("SELECT line FROM changed_edges ORDER BY line"))
+                    for line in iter_lines_at(f, line_numbers):
+                        changes.write(b'{"op":"index","edge":' + line + b"}\n")
+
+            changed_nodes = conn.execute("SELECT count(*) FROM changed_nodes").fetchone()[0]
+            sample["docs"] = affected + removed
+    finally:
+        conn.close()
+
+    return {"changed_nodes": changed_nodes, "affected_edges": affected, "removed_edges": removed}
+
+
+def prepare_delta(nodes_file: str, edges_file: str, work_dir: str) -> dict:
+    """
+    Record the new release under `work_dir` and diff it against the recorded one.
+
+    :return: paths of the new state (`state`), the affected edges (`edges`), the removed
+             edge ids (`removed`) and the adjacency changes (`adjacency_changes`),
+             plus the counts of diff_releases
+    """
+    state_path = get_release_state_path()
+    assert os.path.exists(state_path), f"no recorded release at {state_path}, do a full run with --record-release first"
+
+    os.makedirs(work_dir, exist_ok=True)
+    delta = {
+        "state": f"{work_dir}/release_state.sqlite",
+        "edges": f"{work_dir}/delta_edges.jsonl",
+        "removed": f"{work_dir}/removed_edges.txt",
+        "adjacency_changes": f"{work_dir}/adjacency_changes.jsonl",
+    }
+
+    print("Hashing release")
+    record_release(nodes_file, edges_file, delta["state"])
+
+    delta.update(diff_releases(state_path, delta["state"], edges_file, delta["edges"], delta["removed"], delta["adjacency_changes"]))
+    print(f"{delta['changed_nodes']} nodes changed, {delta['affected_edges']} edges to merge, {delta['removed_edges']} to delete")
+
+    return delta
+
+
+def promote_release(delta: dict):
+    """
+    Make the state of a finished delta run the recorded one.
+    """
+    # already done if a resumed run got this far before
+    if os.path.exists(delta["state"]):
+        os.replace(delta["state"], get_release_state_path())
+
+
+def iter_removed(removed_file: str):
+    with open(removed_file) as f:
+        for line in f:
+            if line.strip():
+                yield line.rstrip("\n")
+
+
+def delete_removed_edges(es_client: Elasticsearch, index_name: str, removed_file: str) -> tuple[int, int]:
+    """
+    :return: number of edges deleted, and of edges that failed to
+    """
+    actions = ({"_op_type": "delete", "_index": index_name, "_id": edge_id} for edge_id in iter_removed(removed_file))
+
+    with get_metrics().stage("bulk_delete") as sample:
+        deleted, failures = AdaptiveBulkWriter(es_client).write(actions)
+        sample["docs"] = deleted
+
+    # not found is as good as deleted
+    failures = [failure for failure in failures if failure["status"] != 404]
+    if failures:
+        print(f"{len(failures)} removed edges failed to delete")
+        for i, failure in enumerate(failures):
+            print(f"[{i}] ID={failure['_id']} status={failure['status']} → {failure['error']}")
+
+    return deleted, len(failures)
@@ -1,14 +1,39 @@
-import json
 import os
 from functools import reduce
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
 from elasticsearch import Elasticsearch
 
-from utils.constants import EDGE_INDEX
+from utils import codec
+from utils.bulk import AdaptiveBulkWriter
+from utils.cache import NodeCache
+from utils.compression import get_input, get_output_compression
+from utils.constants import EDGE_INDEX, NODE_MEMORY_FACTOR, STREAM_SUB_BATCH, STREAM_MIN_SUB_BATCH, STREAM_READ_CHUNK, \
+    STREAM_SIZE_SAMPLE
 from utils.es import get_es_docs_using_ids, insert_docs_to_index
+from utils.metrics import get_metrics
 from utils.nodes import get_nodes_details
-from utils.writes import write_to_temp
+from utils.writes import write_to_temp, open_temp, append_to_temp
+
+
+def read_block(target_file: str, start: int, end: Optional[int]) -> list[bytes]:
+    """
+    Reads lines from file given start and ending byte locations.
+    """
+    f = get_input(target_file)
+
+    with get_metrics().stage("read") as sample:
+        f.seek(start)
+        if end is None:
+            block = f.read()
+        else:
+            block = f.read(end - start)
+
+        lines = block.splitlines()
+        sample["docs"] = len(lines)
+        sample["bytes"] = len(block)
+
+    return lines
 
 
 def load_edge_ids(target_file:str, start: int, end:Optional[int]) -> list[str]:
@@ -18,35 +43,49 @@ def load_edge_ids(target_file:str, start: int, end:Optional[int]) -> list[str]:
     :param target_file: str, location of edges json file
     :param start: int, byte location for start of block
     :param end: int, byte location for end of block
-    :return: a list of ids of loaded edges
+    :return: a list of ids of loaded edges, deduplicated in file order
     """
     def id_loader(line: bytes):
-        data = json.loads(line)
+        data = codec.loads(line)
         return data["id"]
 
-    with open(target_file, "rb") as f:
-        f.seek(start)
-        if end is None:
-            block = f.read()
-        else:
-            block = f.read(end - start)
+    lines = read_block(target_file, start, end)
 
-        lines = block.splitlines()
-        # loaded = list(map(json.loads, lines))
+    # dict keeps first-seen order, unlike set
+    loaded_ids = list(dict.fromkeys(map(id_loader, lines)))
+
+    return loaded_ids
+
+
+def load_edges_from_file(target_file: str, start: int, end: Optional[int]) -> list[dict]:
+    """
+    Loads full edges from file given start and ending byte locations, treating the file as source of truth.
+
+    :return: a list of edges in file order; for duplicated ids the first occurrence wins
+    """
+    loaded = {}
+    for line in read_block(target_file, start, end):
+        edge = codec.loads(line)
+        loaded.setdefault(edge["id"], edge)
 
-        loaded_ids = list(set(map(id_loader, lines)))
+    return list(loaded.values())
 
 
-        return loaded_ids
+def load_edges(es_client: Elasticsearch, target_file: str, start: int, end: Optional[int], from_file=False) -> list:
+    if from_file:
+        return load_edges_from_file(target_file, start, end)
 
-def load_edges(es_client: Elasticsearch, target_file: str, start: int, end: Optional[int]) -> list:
     loaded_edge_ids = load_edge_ids(target_file, start, end)
-    return get_es_docs_using_ids(es_client, EDGE_INDEX, loaded_edge_ids)
 
+    with get_metrics().stage("edge_mget") as sample:
+        edges = get_es_docs_using_ids(es_client, EDGE_INDEX, loaded_edge_ids)
+        sample["docs"] = len(edges)
 
+    return edges
 
-def process_edges(es_client: Elasticsearch, target_file:str, start: int, end: Optional[int], meta_index: int, is_prod=False) -> int:
-    loaded = load_edges(es_client, target_file, start, end)
+
+
+def get_edge_node_ids(edges: list[dict]) -> list[str]:
     # 0. get `subject` and `object`
     def ids_getter(id_set: set, edge: dict):
         if "subject" in edge:
@@ -56,38 +95,225 @@ def process_edges(es_client: Elasticsearch, target_file:str, start: int, end: Op
 
         return id_set
 
-    node_ids = reduce(ids_getter, loaded, set()) # functional programming
+    return list(reduce(ids_getter, edges, set())) # functional programming
 
 
-    # 1. use es to get details
-    node_details = get_nodes_details(es_client, list(node_ids))
+def transform_edges(loaded: list[dict], node_details: dict, is_prod=False, target_index: Optional[str] = None) -> list:
+    """
+    Embed node details into edges, in place, turning each edge into a bulk action (prod) or an output line (dev).
+    """
+    with get_metrics().stage("transform") as sample:
+        for index, edge in enumerate(loaded):
+            if "subject" in edge:
+                edge["subject"] = node_details[edge["subject"]]
+            if "object" in edge:
+                edge["object"] = node_details[edge["object"]]
 
-    # 2. update edges and write back to file
-    for index, edge in enumerate(loaded):
-        if "subject" in edge:
-            edge["subject"] = node_details[edge["subject"]]
-        if "object" in edge:
-            edge["object"] = node_details[edge["object"]]
+            # loaded[index] = json.dumps(edge)
 
-        # loaded[index] = json.dumps(edge)
+            # prepare for insertions
+            if is_prod:
+                loaded[index] = {
+                    "_index": target_index or os.getenv("INDEX_NAME"),
+                    "_id": edge['id'],
+                    "_source": edge
+                }
+            else:
+                loaded[index] = codec.dumps_compat(edge)
 
-        # prepare for insertions
-        if is_prod:
-            loaded[index] = {
-                "_index": os.getenv("INDEX_NAME"),
-                "_id": edge['id'],
-                "_source": edge
-            }
-        else:
-            loaded[index] = json.dumps(edge)
+        sample["docs"] = len(loaded)
+
+    return loaded
 
+
+def write_edges(es_client: Elasticsearch, loaded: list, meta_index: int, is_prod=False, bulk_writer: Optional[AdaptiveBulkWriter] = None, temp_file=None):
+    """
+    :param temp_file: dev mode, an open temp file to append to instead of writing the batch's temp file in one go
+    """
     if is_prod:
-        insert_docs_to_index(es_client, loaded)
+        insert_docs_to_index(es_client, loaded, writer=bulk_writer)
     else:
-        write_to_temp(meta_index, loaded)
+        with get_metrics().stage("temp_write") as sample:
+            if temp_file is None:
+                sample["bytes"] = write_to_temp(meta_index, loaded)
+            else:
+                sample["bytes"] = append_to_temp(temp_file, loaded, get_output_compression())
+            sample["docs"] = len(loaded)
+
+
+def process_edges(es_client: Elasticsearch, target_file:str, start: int, end: Optional[int], meta_index: int, is_prod=False, node_cache: Optional[NodeCache] = None, edges_from_file=False, bulk_writer: Optional[AdaptiveBulkWriter] = None, target_index: Optional[str] = None, memory_limit: Optional[int] = None) -> int:
+    """
+    :param memory_limit: bytes, when given the batch is streamed in sub-batches that should stay within it
+    """
+    if memory_limit is not None:
+        return stream_edges(es_client, target_file, start, end, meta_index, is_prod, node_cache, edges_from_file, bulk_writer, target_index, memory_limit)
+
+    loaded = load_edges(es_client, target_file, start, end, from_file=edges_from_file)
+    node_ids = get_edge_node_ids(loaded)
+
+    # 1. use es to get details
+    with get_metrics().stage("node_mget") as sample:
+        node_details = get_nodes_details(es_client, node_ids, cache=node_cache)
+        sample["docs"] = len(node_ids)
+
+    # 2. update edges and write back to file
+    transform_edges(loaded, node_details, is_prod, target_index)
+    write_edges(es_client, loaded, meta_index, is_prod, bulk_writer)
 
     num_processed = len(loaded)
 
     del loaded
 
     return num_processed
+
+
+def get_worker_memory_limit() -> Optional[int]:
+    limit = os.getenv("WORKER_MEMORY_LIMIT_MB")
+
+    return int(limit) * 1024 * 1024 if limit else None
+
+
+def iter_block_lines(target_file: str, start: int, end: Optional[int], chunk_bytes=STREAM_READ_CHUNK) -> Iterator[bytes]:
+    """
+    Lines between start and ending byte locations, read a chunk at a time.
+    """
+    remaining = None if end is None else end - start
+    tail = b""
+
+    f = get_input(target_file)
+    f.seek(start)
+
+    while remaining is None or remaining > 0:
+        with get_metrics().stage("read") as sample:
+            chunk = f.read(chunk_bytes if remaining is None else min(chunk_bytes, remaining))
+            if remaining is not None:
+                remaining -= len(chunk)
+
+            # a line cut off at the end of the chunk waits for the next one
+            data = tail + chunk
+            cut = data.rfind(b"\n") + 1
+            tail = data[cut:]
+            lines = data[:cut].splitlines()
+
+            sample["docs"] = len(lines)
+            sample["bytes"] = len(chunk)
+
+        if not chunk:
+            break
+
+        yield from lines
+
+    if tail:
+        yield from tail.splitlines()
+
+
+class SubBatchSizer:
+    """
+    Picks how many edges go into the next sub-batch, so that one sub-batch,
+    nested node copies and all, stays within the memory limit. The estimate
+    comes from the serialized size of edges already processed.
+    """
+
+    def __init__(self, memory_limit: int, initial_size=STREAM_SUB_BATCH, min_size=STREAM_MIN_SUB_BATCH):
+        self.memory_limit = memory_limit
+        self.min_size = min_size
+        self.size = initial_size
+
+    def update(self, transformed: list):
+        sample = transformed[:STREAM_SIZE_SAMPLE]
+        if not sample:
+            return
+
+        # output lines in dev, bulk actions in prod
+        sample_bytes = sum(len(edge) if isinstance(edge, str) else len(codec.dumps(edge["_source"])) for edge in sample)
+        edge_bytes = sample_bytes / len(sample)
+
+        self.size = max(self.min_size, int(self.memory_limit / (edge_bytes * NODE_MEMORY_FACTOR)))
+
+
+def iter_sub_batches(lines: Iterable[bytes], sizer: SubBatchSizer) -> Iterator[list[bytes]]:
+    sub_batch = []
+
+    for line in lines:
+        sub_batch.append(line)
+
+        # the sizer may have changed its mind since the last sub-batch
+        if len(sub_batch) >= sizer.size:
+            yield sub_batch
+            sub_batch = []
+
+    if sub_batch:
+        yield sub_batch
+
+
+def load_sub_batch(es_client: Elasticsearch, lines: list[bytes], seen: set, from_file=False) -> list[dict]:
+    """
+    Edges of a sub-batch, skipping ids already seen earlier in the batch, so the
+    first occurrence wins across the whole batch like in `load_edges`.
+    """
+    if from_file:
+        loaded = {}
+        for line in lines:
+            edge = codec.loads(line)
+            if edge["id"] not in seen:
+                loaded.setdefault(edge["id"], edge)
+
+        seen.update(loaded)
+
+        return list(loaded.values())
+
+    loaded_ids = [_id for _id in dict.fromkeys(codec.loads(line)["id"] for line in lines) if _id not in seen]
+    seen.update(loaded_ids)
+
+    with get_metrics().stage("edge_mget") as sample:
+        edges = get_es_docs_using_ids(es_client, EDGE_INDEX, loaded_ids)
+        sample["docs"] = len(edges)
+
+    return edges
+
+
+def iter_transformed(es_client: Elasticsearch, target_file: str, start: int, end: Optional[int], sizer: SubBatchSizer, is_prod=False, node_cache: Optional[NodeCache] = None, edges_from_file=False, target_index: Optional[str] = None) -> Iterator[list]:
+    """
+    Transformed sub-batches of a batch, in file order. Nothing is fetched for the next one until the last is consumed.
+    """
+    seen = set()
+
+    for lines in iter_sub_batches(iter_block_lines(target_file, start, end), sizer):
+        loaded = load_sub_batch(es_client, lines, seen, edges_from_file)
+        del lines
+        if not loaded:
+            continue
+
+        node_ids = get_edge_node_ids(loaded)
+        with get_metrics().stage("node_mget") as sample:
+            node_details = get_nodes_details(es_client, node_ids, cache=node_cache)
+            sample["docs"] = len(node_ids)
+
+        transformed = transform_edges(loaded, node_details, is_prod, target_index)
+        del node_details
+
+        sizer.update(transformed)
+        yield transformed
+
+
+def stream_edges(es_client: Elasticsearch, target_file: str, start: int, end: Optional[int], meta_index: int, is_prod=False, node_cache: Optional[NodeCache] = None, edges_from_file=False, bulk_writer: Optional[AdaptiveBulkWriter] = None, target_index: Optional[str] = None, memory_limit: int = 256 * 1024 * 1024) -> int:
+    """
+    process_edges, a sub-batch at a time: each is read, fetched, enriched and
+    written (bulk, or appended to the batch's temp file) before the next one starts.
+
+    :return: number of edges processed
+    """
+    sizer = SubBatchSizer(memory_limit)
+    num_processed = 0
+    temp_file = None if is_prod else open_temp(meta_index, get_output_compression())
+
+    try:
+        for transformed in iter_transformed(es_client, target_file, start, end, sizer, is_prod, node_cache, edges_from_file, target_index):
+            write_edges(es_client, transformed, meta_index, is_prod, bulk_writer, temp_file=temp_file)
+            num_processed += len(transformed)
+            get_metrics().inc("sub_batches")
+    finally:
+        if temp_file is not None:
+            temp_file.close()
+
+    return num_processed
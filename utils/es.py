@@ -1,14 +1,212 @@
+import asyncio
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from elasticsearch import Elasticsearch, helpers
-from elasticsearch.helpers import BulkIndexError
-from utils.constants import NODE_INDEX, EDGE_INDEX
+from elasticsearch import Elasticsearch, AsyncElasticsearch, ApiError, TransportError
+from elasticsearch.serializer import JsonSerializer, NdjsonSerializer
 
+from utils import codec
+from utils.bulk import AdaptiveBulkWriter, BulkWriteError
+from utils.constants import NODE_INDEX, EDGE_INDEX, MGET_CHUNK_SIZE, MGET_CHUNK_BYTES, MGET_CONCURRENCY, MGET_RETRIES, \
+    RETRYABLE_STATUS
+from utils.lifecycle import begin_build, finish_build, wait_for_task
+from utils.metrics import get_metrics
+from utils.projection import get_node_fields, project_props
 
-def get_es_docs_using_ids(client: Elasticsearch, index_name: str, ids: list[str], return_id_dict=False) -> list | dict:
-    res = client.mget(index=index_name, ids=ids)
-    docs = res['docs']
 
+class CodecJsonSerializer(JsonSerializer):
+    def json_dumps(self, data) -> bytes:
+        return codec.dumps(data, default=self.default)
+
+    def json_loads(self, data: bytes):
+        return codec.loads(data)
+
+
+class CodecNdjsonSerializer(NdjsonSerializer):
+    def json_dumps(self, data) -> bytes:
+        return codec.dumps(data, default=self.default)
+
+    def json_loads(self, data: bytes):
+        return codec.loads(data)
+
+
+def get_serializers() -> dict:
+    json_serializer = CodecJsonSerializer()
+    ndjson_serializer = CodecNdjsonSerializer()
+
+    return {
+        "application/json": json_serializer,
+        "application/vnd.elasticsearch+json": json_serializer,
+        "application/x-ndjson": ndjson_serializer,
+        "application/vnd.elasticsearch+x-ndjson": ndjson_serializer,
+    }
+
+
+def get_es_client(es_url: str, **kwargs) -> Elasticsearch:
+    """
+    Elasticsearch client that (de)serializes bodies with our codec, including bulk and msearch.
+    """
+    return Elasticsearch(es_url, serializers=get_serializers(), **kwargs)
+
+
+def get_async_es_client(es_url: str, **kwargs) -> AsyncElasticsearch:
+    return AsyncElasticsearch(es_url, serializers=get_serializers(), **kwargs)
+
+
+def get_mget_concurrency():
+    return int(os.getenv("MGET_CONCURRENCY", MGET_CONCURRENCY))
+
+
+def chunk_ids(ids: list[str], max_count: int, max_bytes: int):
+    """
+    Split ids into sub-lists capped by count and by their size in the request body.
+    """
+    chunk = []
+    chunk_bytes = 0
+
+    for _id in ids:
+        # quoted id plus separator
+        id_bytes = len(_id.encode()) + 3
+
+        if chunk and (len(chunk) >= max_count or chunk_bytes + id_bytes > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append(_id)
+        chunk_bytes += id_bytes
+
+    if chunk:
+        yield chunk
+
+
+def collect_mget_docs(res, docs_by_id: dict) -> list[str]:
+    """
+    Keep the docs of an mget response that came back fine.
+
+    :return: ids of docs with an error, to retry
+    """
+    failed = []
+    for doc in res['docs']:
+        if 'error' in doc:
+            failed.append(doc['_id'])
+        else:
+            docs_by_id[doc['_id']] = doc
+
+    return failed
+
+
+def mget_chunk(client: Elasticsearch, index_name: str, ids: list[str], retries=MGET_RETRIES, source_includes: list[str] | None = None) -> list:
+    """
+    mget one sub-chunk, retrying the whole request on transport errors and only the failed ids on per-doc errors.
+    `source_includes` limits the fields each doc comes back with.
+
+    :return: docs in the same order as given ids
+    """
+    docs_by_id = {}
+    pending = ids
+    metrics = get_metrics()
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            metrics.inc("mget_retries")
+
+        try:
+            with metrics.stage("mget_request") as sample:
+                res = client.mget(index=index_name, ids=pending, source_includes=source_includes)
+                sample["docs"] = len(pending)
+        except ApiError as e:
+            if e.status_code not in RETRYABLE_STATUS or attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+        except TransportError:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+
+        failed = collect_mget_docs(res, docs_by_id)
+        if not failed:
+            break
+
+        if attempt == retries:
+            raise Exception(f'mget failed for {len(failed)} ids in {index_name}, e.g. {failed[0]}')
+
+        pending = failed
+        time.sleep(2 ** attempt)
+
+    return [docs_by_id[_id] for _id in ids if _id in docs_by_id]
+
+
+async def async_mget_chunk(client: AsyncElasticsearch, index_name: str, ids: list[str], retries=MGET_RETRIES, source_includes: list[str] | None = None) -> list:
+    """
+    mget_chunk on an async client.
+    """
+    docs_by_id = {}
+    pending = ids
+    metrics = get_metrics()
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            metrics.inc("mget_retries")
+
+        try:
+            with metrics.stage("mget_request") as sample:
+                res = await client.mget(index=index_name, ids=pending, source_includes=source_includes)
+                sample["docs"] = len(pending)
+        except ApiError as e:
+            if e.status_code not in RETRYABLE_STATUS or attempt == retries:
+                raise
+            await asyncio.sleep(2 ** attempt)
+            continue
+        except TransportError:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(2 ** attempt)
+            continue
+
+        failed = collect_mget_docs(res, docs_by_id)
+        if not failed:
+            break
+
+        if attempt == retries:
+            raise Exception(f'mget failed for {len(failed)} ids in {index_name}, e.g. {failed[0]}')
+
+        pending = failed
+        await asyncio.sleep(2 ** attempt)
+
+    return [docs_by_id[_id] for _id in ids if _id in docs_by_id]
+
+
+def iter_es_docs_using_ids(client: Elasticsearch, index_name: str, ids: list[str], source_includes: list[str] | None = None):
+    """
+    Yield raw mget docs for given ids, fetched in concurrent sub-requests.
+    Docs come out in the order of `ids`, one sub-chunk at a time.
+    """
+    max_count = int(os.getenv("MGET_CHUNK_SIZE", MGET_CHUNK_SIZE))
+    max_bytes = int(os.getenv("MGET_CHUNK_BYTES", MGET_CHUNK_BYTES))
+    concurrency = get_mget_concurrency()
+
+    chunks = chunk_ids(ids, max_count, max_bytes)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+
+        # keep a bounded number of sub-requests going, so responses are not all held at once
+        for chunk in chunks:
+            in_flight.append(executor.submit(mget_chunk, client, index_name, chunk, MGET_RETRIES, source_includes))
+
+            if len(in_flight) >= concurrency * 2:
+                yield from in_flight.popleft().result()
+
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def select_sources(docs, return_id_dict=False) -> list | dict:
     def get_source(node_doc):
         return node_doc["_source"]
 
@@ -34,18 +232,55 @@ def get_es_docs_using_ids(client: Elasticsearch, index_name: str, ids: list[str]
     return list(map(get_source, valid_docs_filter))
 
 
-def insert_docs_to_index(es_client: Elasticsearch, operations: list):
-    try:
-        helpers.bulk(es_client, operations, chunk_size=5000, request_timeout=240)
-        # helpers.bulk(es_client, operations, chunk_size=5000)
-    except BulkIndexError as e:
-        for i, error in enumerate(e.errors[:1]):  # Only show first
-            doc_id = error["index"].get("_id", "N/A")
-            reason = error["index"]["error"].get("reason", "Unknown")
-            print(f"[{i}] ID={doc_id} → {reason}")
+def get_es_docs_using_ids(client: Elasticsearch, index_name: str, ids: list[str], return_id_dict=False, source_includes: list[str] | None = None) -> list | dict:
+    return select_sources(iter_es_docs_using_ids(client, index_name, ids, source_includes), return_id_dict)
+
+
+async def async_get_es_docs_using_ids(client: AsyncElasticsearch, index_name: str, ids: list[str], return_id_dict=False, source_includes: list[str] | None = None) -> list | dict:
+    """
+    get_es_docs_using_ids on an async client, with the same sub-requests and the same limit on how many are in flight.
+    """
+    max_count = int(os.getenv("MGET_CHUNK_SIZE", MGET_CHUNK_SIZE))
+    max_bytes = int(os.getenv("MGET_CHUNK_BYTES", MGET_CHUNK_BYTES))
+    semaphore = asyncio.Semaphore(get_mget_concurrency())
+
+    async def fetch(chunk: list[str]) -> list:
+        async with semaphore:
+            return await async_mget_chunk(client, index_name, chunk, MGET_RETRIES, source_includes)
+
+    chunks = await asyncio.gather(*(fetch(chunk) for chunk in chunk_ids(ids, max_count, max_bytes)))
+
+    return select_sources((doc for chunk in chunks for doc in chunk), return_id_dict)
+
+
+def insert_docs_to_index(es_client: Elasticsearch, operations: list, writer: AdaptiveBulkWriter | None = None) -> int:
+    """
+    Bulk write docs, reporting every doc that still failed after retries.
 
+    :param writer: a long-lived writer to reuse, so its concurrency carries over between calls
+    :return: number of docs written
+    :raises BulkWriteError: if any doc failed for good, so its batch is not recorded as done
+    """
+    if writer is None:
+        writer = AdaptiveBulkWriter(es_client)
 
-def reindex(es_client: Elasticsearch, source_index_name, dest_index_name: str):
+    with get_metrics().stage("bulk_write") as sample:
+        success, failures = writer.write(operations)
+        sample["docs"] = success
+
+    if failures:
+        print(f"{len(failures)} of {len(operations)} docs failed to index")
+        for i, failure in enumerate(failures):
+            error = failure["error"]
+            reason = error.get("reason", "Unknown") if isinstance(error, dict) else error
+            print(f"[{i}] ID={failure['_id']} status={failure['status']} → {reason}")
+
+        raise BulkWriteError(failures)
+
+    return success
+
+
+def reindex(es_client: Elasticsearch, source_index_name, dest_index_name: str) -> str:
     reindex_body = {
         "source": {
             "index": source_index_name,
@@ -54,44 +289,41 @@ def reindex(es_client: Elasticsearch, source_index_name, dest_index_name: str):
             "index": dest_index_name,
         }
     }
-    es_client.reindex(body=reindex_body, wait_for_completion=False)
+    response = es_client.reindex(body=reindex_body, wait_for_completion=False)
 
+    return response["task"]
 
-def migrate_merged_index_to_nested(es_client):
-    nested_index_name = os.environ.get("NESTED_INDEX_NAME")
+
+def migrate_merged_index_to_nested(es_client, nested_index_name: str) -> str:
     merged_index_name = os.environ.get("INDEX_NAME")
 
-    reindex(es_client, source_index_name=merged_index_name, dest_index_name=nested_index_name)
+    return reindex(es_client, source_index_name=merged_index_name, dest_index_name=nested_index_name)
 
 
-def create_index_using_mapping(es_client:Elasticsearch, name: str, props):
-    mapping_and_settings = {
-        "mappings": {
-            "properties": props
-        },
-        "settings": {
-            "number_of_shards": 5,
-            "number_of_replicas": 0,
-            "codec": "best_compression",
-            "index.mapping.nested_objects.limit": 50000
-        }
-    }
+INDEX_SETTINGS = {
+    "number_of_shards": 5,
+    "codec": "best_compression",
+    "index.mapping.nested_objects.limit": 50000
+}
 
-    if es_client.indices.exists(index=name):
-        es_client.indices.delete(index=name)
 
-    es_client.indices.create(index=name, body=mapping_and_settings)
+def get_props(es_client: Elasticsearch, name: str) -> dict:
+    # keyed by the concrete index, which differs from `name` when it is an alias
+    mapping = es_client.indices.get_mapping(index=name)
+    return next(iter(mapping.values()))["mappings"]["properties"]
 
 
-def created_adjacency_list_index(es_url:str):
-    es_client = Elasticsearch(es_url, request_timeout=240)
-    adj_index_name = os.environ.get("ADJACENCY_LIST_INDEX_NAME")
+def created_adjacency_list_index(es_url:str, version: str):
+    """
+    Create a new build of the adjacency list index, see utils.lifecycle.
 
-    node_mapping = es_client.indices.get_mapping(index=NODE_INDEX)
-    node_props = node_mapping[NODE_INDEX]["mappings"]["properties"]
+    :return: (name of the new index, handle copying nodes into it as a base)
+    """
+    es_client = get_es_client(es_url, request_timeout=240)
+    adj_index_name = os.environ.get("ADJACENCY_LIST_INDEX_NAME")
 
-    edge_mapping = es_client.indices.get_mapping(index=EDGE_INDEX)
-    edge_props = edge_mapping[EDGE_INDEX]["mappings"]["properties"]
+    node_props = get_props(es_client, NODE_INDEX)
+    edge_props = get_props(es_client, EDGE_INDEX)
 
     # add edges props
     fields = ['in_edges', 'out_edges']
@@ -101,22 +333,39 @@ def created_adjacency_list_index(es_url:str):
             'properties': edge_props
         }
 
-    create_index_using_mapping(es_client, adj_index_name, node_props)
+    # super nodes keep their edges in bucket docs, see utils.adjacency.NodeActionBuilder
+    node_props['bucket_of'] = {'type': 'keyword'}
+    node_props['bucket_direction'] = {'type': 'keyword'}
+    node_props['bucket'] = {'type': 'integer'}
+    node_props['edge_buckets'] = {
+        'properties': {
+            'out': {'type': 'integer'},
+            'in': {'type': 'integer'},
+            'out_count': {'type': 'integer'},
+            'in_count': {'type': 'integer'},
+        }
+    }
+
+    build_name = begin_build(es_client, adj_index_name, version, node_props, INDEX_SETTINGS)
 
     def migrate_handle():
-        reindex(es_client, source_index_name=NODE_INDEX, dest_index_name=adj_index_name)
+        wait_for_task(es_client, reindex(es_client, source_index_name=NODE_INDEX, dest_index_name=build_name))
 
-    return migrate_handle
+    return build_name, migrate_handle
 
 
 
-def create_nested_index(es_url:str):
-    es_client = Elasticsearch(es_url, request_timeout=240)
+def create_nested_index(es_url:str, version: str, force_merge=False):
+    """
+    Create a new build of the nested index.
+
+    :return: handle copying the merged index into it, then swapping the nested index alias over
+    """
+    es_client = get_es_client(es_url, request_timeout=240)
     nested_index_name = os.environ.get("NESTED_INDEX_NAME")
     merged_index_name = os.environ.get("INDEX_NAME")
 
-    merged_edges_mappings = es_client.indices.get_mapping(index=merged_index_name)
-    nested_props = merged_edges_mappings[merged_index_name]["mappings"]["properties"]
+    nested_props = get_props(es_client, merged_index_name)
 
     # modify `subject` and `object` field to be nested
     fields = ["object", "subject"]
@@ -127,26 +376,35 @@ def create_nested_index(es_url:str):
             "type": "nested"
         }
 
-    create_index_using_mapping(es_client, nested_index_name, nested_props)
+    build_name = begin_build(es_client, nested_index_name, version, nested_props, INDEX_SETTINGS)
 
     def migrate_handle():
-        migrate_merged_index_to_nested(es_client)
+        wait_for_task(es_client, migrate_merged_index_to_nested(es_client, build_name))
+        finish_build(es_client, nested_index_name, build_name, force_merge=force_merge)
 
     return migrate_handle
 
 
-def refresh_es_index(es_url: str):
-    es_client = Elasticsearch(es_url, request_timeout=240)
-    INDEX_NAME = os.environ.get("INDEX_NAME")
+def refresh_es_index(es_url: str, version: str) -> str:
+    """
+    Create a new build of the merged index. The live one stays untouched until `publish_index`.
 
-    node_mapping = es_client.indices.get_mapping(index=NODE_INDEX)
-    node_props = node_mapping[NODE_INDEX]["mappings"]["properties"]
+    :return: name of the new index
+    """
+    es_client = get_es_client(es_url, request_timeout=240)
+    INDEX_NAME = os.environ.get("INDEX_NAME")
 
-    edge_mapping = es_client.indices.get_mapping(index=EDGE_INDEX)
-    edge_props = edge_mapping[EDGE_INDEX]["mappings"]["properties"]
+    # only the node fields that get embedded, see utils.projection
+    node_props = project_props(get_props(es_client, NODE_INDEX), get_node_fields())
+    edge_props = get_props(es_client, EDGE_INDEX)
 
     edge_props["subject"] = {"properties": node_props}
     edge_props["object"] = {"properties": node_props}
 
 
-    create_index_using_mapping(es_client, INDEX_NAME, edge_props)
+    return begin_build(es_client, INDEX_NAME, version, edge_props, INDEX_SETTINGS)
+
+
+def publish_index(es_url: str, alias: str, name: str, force_merge=False):
+    es_client = get_es_client(es_url, request_timeout=3600)
+    finish_build(es_client, alias, name, force_merge=force_merge)
@@ -0,0 +1,358 @@
+"""
+One way for both scripts to run tasks across processes, on one host or many.
+
+- `process`: a pool of local worker processes
+- `dask`: a dask `LocalCluster` on this host
+- `dask` with a scheduler address: an existing dask cluster, which can span
+  several hosts (`dask scheduler` on one, `dask worker --nthreads 1 <address>` on each)
+
+A task is a plain function plus picklable arguments. Whatever workers keep
+between tasks (es clients, node caches, bulk writers, event loops) goes
+through `get_worker_resource`, once per process on every backend, so a worker
+process runs one task at a time: dask workers need a single thread. Results
+come back as tasks finish, with progress printed along the way; a task that
+raises is collected as a failure instead of taking the run down, so callers
+decide what a failed task means. Per-worker values such as metrics snapshots
+are gathered with `run_on_workers`, keyed by (host, pid).
+
+Workers on other hosts need the repo on their PYTHONPATH and the inputs at the
+same paths. The env vars in `WORKER_ENV` are copied over to them on start, and whatever
+an earlier run left in their state and metrics is dropped.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import queue
+import socket
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Iterator, NamedTuple, Optional
+
+from utils.constants import THREADS_PER_WORKER, WORKER_ENV
+from utils.metrics import reset_metrics
+
+EXECUTORS = ["process", "dask"]
+
+_state = None
+
+
+def get_worker_id() -> tuple[str, int]:
+    return socket.gethostname(), os.getpid()
+
+
+def get_worker_state() -> dict:
+    """
+    State kept by the current worker process across tasks. A forked child starts from scratch.
+    """
+    global _state
+    if _state is None or _state["pid"] != os.getpid():
+        _state = {"pid": os.getpid()}
+
+    return _state
+
+
+def get_worker_resource(name: str, factory: Callable[[], Any]):
+    """
+    The worker's `name` resource, made by `factory` on first use in this process.
+    """
+    state = get_worker_state()
+    if name not in state:
+        state[name] = factory()
+
+    return state[name]
+
+
+def close_worker_loop():
+    """
+    Close the async clients a worker keeps on its event loop, before it goes away.
+    """
+    state = get_worker_state()
+    loop = state.get("event_loop")
+    if loop is None:
+        return
+
+    for name, resource in list(state.items()):
+        if asyncio.iscoroutinefunction(getattr(resource, "close", None)):
+            loop.run_until_complete(state.pop(name).close())
+
+
+def get_worker_env() -> dict:
+    return {name: os.environ[name] for name in WORKER_ENV if name in os.environ}
+
+
+def start_worker(env: dict):
+    """
+    Get a worker ready for a run: the coordinator's env, no state or metrics left from earlier runs.
+    """
+    global _state
+    # what an earlier run set and this one doesn't must not carry over
+    for name in WORKER_ENV:
+        if name not in env:
+            os.environ.pop(name, None)
+    os.environ.update(env)
+    _state = None
+    reset_metrics()
+
+
+def call_on_worker(fn: Callable, *args):
+    return get_worker_id(), fn(*args)
+
+
+def call_off_loop(fn: Callable, *args):
+    # dask's client.run calls in on the worker's event loop, tasks don't run there
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(call_on_worker, fn, *args).result()
+
+
+class TaskFailure(NamedTuple):
+    key: Hashable
+    error: str
+    worker: Optional[tuple[str, int]]
+
+
+class Progress:
+    def __init__(self, label: str, total: int, unit="items"):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.failed = 0
+        self.items = 0
+
+    def update(self, items=0, failed=False):
+        self.done += 1
+        self.failed += failed
+        self.items += items
+
+        failures = f", {self.failed} failed" if self.failed else ""
+        print(f"{self.label}: {self.done}/{self.total} tasks, {self.items} {self.unit}{failures}", end='\r', flush=True)
+
+    def finish(self):
+        print()
+
+
+class Executor:
+    """
+    Base for the backends, see the module docstring.
+    """
+    n_workers: int
+
+    def __init__(self):
+        self.failures: list[TaskFailure] = []
+
+    def run_tasks(self, fn: Callable, tasks: dict[Hashable, tuple], label="tasks", count: Optional[Callable[[Any], int]] = None, unit="items") -> Iterator[tuple[Hashable, Any]]:
+        """
+        Run fn(*args) for every key, args in `tasks`, in that order of submission.
+
+        :param count: items a result stands for, summed up in the progress line
+        :return: (key, result) of every task that succeeded, as they finish;
+                 the others end up in `self.failures`
+        """
+        progress = Progress(label, len(tasks), unit)
+
+        for key, ok, value, worker in self._run(fn, tasks):
+            if ok:
+                progress.update(count(value) if count is not None else 0)
+                yield key, value
+            else:
+                progress.update(failed=True)
+                self.failures.append(TaskFailure(key, value, worker))
+
+        progress.finish()
+
+    def _run(self, fn: Callable, tasks: dict[Hashable, tuple]) -> Iterator[tuple[Hashable, bool, Any, Optional[tuple[str, int]]]]:
+        raise NotImplementedError
+
+    def run_on_workers(self, fn: Callable, *args) -> dict[tuple[str, int], Any]:
+        """
+        Call fn(*args) once in every worker process.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def process_worker_main(inbox, outbox, slot: int, env: dict):
+    start_worker(env)
+    worker = get_worker_id()
+
+    while (message := inbox.get()) is not None:
+        key, fn, args = message
+        try:
+            outbox.put((slot, key, True, fn(*args), worker))
+        except Exception as e:
+            traceback.print_exc()
+            outbox.put((slot, key, False, repr(e), worker))
+
+
+class ProcessExecutor(Executor):
+    """
+    Local worker processes, each with its own inbox so the coordinator knows
+    which one runs what. Idle workers get the next task as soon as they report
+    back, and a worker that dies is replaced, its task counted as failed.
+    """
+
+    def __init__(self, n_workers: int):
+        super().__init__()
+        self.n_workers = n_workers
+        self.env = get_worker_env()
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = []
+        self.processes = []
+
+        for slot in range(n_workers):
+            self.inboxes.append(multiprocessing.Queue())
+            self.processes.append(None)
+            self._start(slot)
+
+    def _start(self, slot: int):
+        process = multiprocessing.Process(target=process_worker_main, args=(self.inboxes[slot], self.outbox, slot, self.env))
+        process.start()
+        self.processes[slot] = process
+
+    def _collect(self, running: dict) -> list:
+        """
+        Wait for the next results, or for dead workers to show up.
+        """
+        while True:
+            try:
+                return [self.outbox.get(timeout=1)]
+            except queue.Empty:
+                pass
+
+            dead = []
+            for slot, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+
+                # whatever it was running will not report back
+                if slot in running:
+                    key = running.pop(slot)
+                    dead.append((slot, key, False, f"worker exited with code {process.exitcode}", None))
+
+                self.inboxes[slot] = multiprocessing.Queue()
+                self._start(slot)
+
+            if dead:
+                return dead
+
+    def _run(self, fn, tasks):
+        pending = list(tasks.items())
+        pending.reverse()
+        running = {}
+
+        while pending or running:
+            for slot in range(self.n_workers):
+                if slot not in running and pending:
+                    key, args = pending.pop()
+                    self.inboxes[slot].put((key, fn, args))
+                    running[slot] = key
+
+            for slot, key, ok, value, worker in self._collect(running):
+                if running.get(slot) == key:
+                    del running[slot]
+                yield key, ok, value, worker
+
+    def run_on_workers(self, fn, *args):
+        results = {}
+
+        for key, ok, value, worker in self._run(call_on_worker, {slot: (fn, *args) for slot in range(self.n_workers)}):
+            if ok:
+                worker, value = value
+                results[worker] = value
+
+        return results
+
+    def close(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+
+        for process in self.processes:
+            process.join()
+
+
+class DaskExecutor(Executor):
+    """
+    A new dask LocalCluster, or the cluster behind `address`.
+    """
+
+    def __init__(self, n_workers: int, address: Optional[str] = None):
+        super().__init__()
+        from dask.distributed import Client, LocalCluster
+
+        if address is None:
+            self.cluster = LocalCluster(n_workers=n_workers, threads_per_worker=THREADS_PER_WORKER)
+            self.client = Client(self.cluster)
+        else:
+            self.cluster = None
+            self.client = Client(address)
+
+        # worker resources (bulk writer, event loop) are per process and not thread safe
+        workers = self.client.scheduler_info()["workers"]
+        threaded = [address for address, info in workers.items() if info["nthreads"] != 1]
+        assert not threaded, f"dask workers {threaded} run several threads, start them with --nthreads 1"
+
+        # workers of a running cluster may have served other runs before
+        self.client.run(call_off_loop, start_worker, get_worker_env())
+        self.n_workers = len(workers)
+
+    def _run(self, fn, tasks):
+        from dask.distributed import as_completed
+
+        futures = {self.client.submit(call_on_worker, fn, *args, pure=False): key for key, args in tasks.items()}
+
+        for future in as_completed(futures):
+            key = futures[future]
+
+            # a result lost with its worker in the meantime is recomputed by the scheduler, result() waits for that
+            try:
+                worker, value = future.result()
+            except Exception as e:
+                yield key, False, repr(e), None
+                continue
+
+            yield key, True, value, worker
+
+            # results are in the caller's hands now, free them on the cluster
+            future.release()
+
+    def run_on_workers(self, fn, *args):
+        # dask passes its worker to functions taking a dask_worker argument, so fn is wrapped either way
+        return dict(self.client.run(call_off_loop, fn, *args).values())
+
+    def close(self):
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+def get_executor(kind: Optional[str], n_workers: int, address: Optional[str] = None) -> Executor:
+    """
+    :param kind: "process" or "dask", a scheduler address implies dask whatever the kind
+    """
+    if address is not None:
+        print(f"connecting to dask scheduler at {address}")
+        return DaskExecutor(n_workers, address)
+
+    assert kind in EXECUTORS, f"unknown executor {kind}"
+    print(f"starting {n_workers} {kind} workers with {THREADS_PER_WORKER}-thread each")
+
+    if kind == "dask":
+        return DaskExecutor(n_workers)
+
+    return ProcessExecutor(n_workers)
+
+
+def add_executor_args(parser, default: str):
+    parser.add_argument("--executor", choices=EXECUTORS, default=os.getenv("EXECUTOR") or default,
+                        help=f"Run workers as local processes or on dask (or EXECUTOR), {default} by default")
+    parser.add_argument("--scheduler", default=os.getenv("DASK_SCHEDULER_ADDRESS"),
+                        help="Address of a running dask scheduler (or DASK_SCHEDULER_ADDRESS), its workers do the work, implies --executor dask")
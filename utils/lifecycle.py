@@ -0,0 +1,126 @@
+"""
+Build an index next to the live one and switch readers over in one step.
+
+1. `begin_build` creates `<alias>_<version>` with load-time settings: no
+   refresh, no replicas, async translog with a large flush threshold.
+2. Everything is bulk loaded into that index, by name.
+3. `finish_build` refreshes it, restores serving settings, optionally
+   force-merges it, and moves the alias over with a single `update_aliases`
+   call. A concrete index still sitting on the alias name (what older runs
+   created) is dropped in that same call.
+
+Readers query the alias and see either the old index or the finished new one,
+never something missing or half loaded. Previous builds are left in place,
+detached, and listed so they can be deleted once the new one checks out.
+"""
+
+import os
+import time
+
+from elasticsearch import Elasticsearch
+
+from utils.constants import INDEX_LOAD_SETTINGS, INDEX_SERVE_SETTINGS
+
+
+def get_build_name(alias: str, version: str) -> str:
+    return f"{alias}_{version}"
+
+
+def get_serve_settings() -> dict:
+    return {
+        **INDEX_SERVE_SETTINGS,
+        "index.number_of_replicas": int(os.getenv("INDEX_REPLICAS", INDEX_SERVE_SETTINGS["index.number_of_replicas"])),
+    }
+
+
+def begin_build(es_client: Elasticsearch, alias: str, version: str, props: dict, settings: dict) -> str:
+    """
+    Create a fresh index for a build of `alias`, tuned for loading.
+
+    :param settings: static index settings (shards, codec, ...)
+    :return: name of the new index, the one to write into
+    """
+    name = get_build_name(alias, version)
+
+    if es_client.indices.exists(index=name):
+        es_client.indices.delete(index=name)
+
+    es_client.indices.create(index=name, body={
+        "mappings": {
+            "properties": props
+        },
+        "settings": {
+            **settings,
+            **INDEX_LOAD_SETTINGS,
+        }
+    })
+    print(f"Created {name} for {alias}")
+
+    return name
+
+
+def finish_build(es_client: Elasticsearch, alias: str, name: str, force_merge=False) -> list[str]:
+    """
+    Make a loaded index ready to serve and point `alias` at it.
+
+    :return: indices the alias pointed to before
+    """
+    es_client.indices.refresh(index=name)
+    es_client.indices.put_settings(index=name, settings=get_serve_settings())
+
+    if force_merge:
+        print(f"Force merging {name}")
+        response = es_client.indices.forcemerge(index=name, max_num_segments=1, wait_for_completion=False)
+        wait_for_task(es_client, response["task"])
+
+    previous = swap_alias(es_client, alias, name)
+    print(f"{alias} -> {name}" + (f", detached {', '.join(previous)}" if previous else ""))
+
+    return previous
+
+
+def swap_alias(es_client: Elasticsearch, alias: str, name: str) -> list[str]:
+    actions = []
+    previous = []
+
+    if es_client.indices.exists_alias(name=alias):
+        previous = [index for index in es_client.indices.get_alias(name=alias) if index != name]
+        actions.extend({"remove": {"index": index, "alias": alias}} for index in previous)
+    elif es_client.indices.exists(index=alias):
+        # legacy concrete index in the way of the alias, goes away atomically with the swap
+        actions.append({"remove_index": {"index": alias}})
+
+    actions.append({"add": {"index": name, "alias": alias}})
+    es_client.indices.update_aliases(actions=actions)
+
+    return previous
+
+
+def resolve_index(es_client: Elasticsearch, name: str) -> str:
+    """
+    Concrete index behind an alias, or the name itself.
+    """
+    if es_client.indices.exists_alias(name=name):
+        indices = list(es_client.indices.get_alias(name=name))
+        assert len(indices) == 1, f"{name} points to {len(indices)} indices"
+        return indices[0]
+
+    return name
+
+
+def wait_for_task(es_client: Elasticsearch, task_id: str, poll_interval=30):
+    polled = False
+    while True:
+        task = es_client.tasks.get(task_id=task_id)
+        if task["completed"]:
+            if polled:
+                print()
+            failures = task.get("response", {}).get("failures") or task.get("error")
+            assert not failures, f"task {task_id} failed: {failures}"
+            return task
+
+        status = task["task"].get("status") or {}
+        print(f"{task_id}: {status.get('created', 0)}/{status.get('total', '?')}", end='\r', flush=True)
+        polled = True
+        time.sleep(poll_interval)
+
@@ -1,48 +1,270 @@
-import json
+"""
+Per-line byte offset index of an edges file, `<file>.lineidx` next to it.
+
+Layout, all integers little-endian uint64 except the hash:
+
+    header:  magic, number of lines n, input size, input mtime (ns), 16 byte input hash
+    offsets: n + 1 positions, line i is file[offsets[i]:offsets[i + 1]]
+
+The index is stamped with the size, mtime and a hash of the input as it is on
+disk, and rebuilt as soon as any of them stops matching. The hash covers the
+size plus evenly spaced samples of the file, so checking it stays cheap on a
+file of any size and still catches an input swapped for one of the same size.
+
+Since every line start is in there, batches of any size are a lookup, not a
+rescan. Plain files are scanned in parallel, every process mmaps the input
+and looks for newlines in its own chunk. Offsets of compressed inputs refer to
+the decompressed content, like everywhere else, and are found in one pass.
+"""
+
+import hashlib
+import mmap
+import multiprocessing
 import os
+import shutil
+import struct
+import sys
+from array import array
+
+from utils.compression import open_input, get_compression
+from utils.constants import LINE_INDEX_SUFFIX, LINE_INDEX_SCAN_CHUNK, LINE_INDEX_HASH_SAMPLES, LINE_INDEX_HASH_SAMPLE_BYTES
+
+MAGIC = b"RTXLIDX1"
+HEADER = struct.Struct("<8sQQQ16s")
+
+
+def get_line_index_path(path: str) -> str:
+    return f"{path}{LINE_INDEX_SUFFIX}"
+
+
+def get_input_hash(path: str, size: int) -> bytes:
+    """
+    Hash of the size plus head, tail and evenly spaced samples of a file.
+    """
+    digest = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=16)
+    step = max(1, (size - LINE_INDEX_HASH_SAMPLE_BYTES) // max(1, LINE_INDEX_HASH_SAMPLES - 1))
+
+    with open(path, "rb") as f:
+        for sample in range(LINE_INDEX_HASH_SAMPLES):
+            position = min(sample * step, max(0, size - LINE_INDEX_HASH_SAMPLE_BYTES))
+            f.seek(position)
+            digest.update(f.read(LINE_INDEX_HASH_SAMPLE_BYTES))
+
+    return digest.digest()
+
+
+def get_stamp(path: str) -> tuple[int, int, bytes]:
+    stat = os.stat(path)
+
+    return stat.st_size, stat.st_mtime_ns, get_input_hash(path, stat.st_size)
+
 
-from utils.constants import OFFSET_OUTPUT
+def scan_chunk(path: str, start: int, end: int, part_path: str) -> int:
+    """
+    Write the start of every line beginning in (start, end] to a part file.
+
+    :return: number of line starts written
+    """
+    starts = array("Q")
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        size = len(data)
+        find = data.find
+        position = find(b"\n", start, end)
+
+        while position != -1:
+            if position + 1 < size:
+                starts.append(position + 1)
+            position = find(b"\n", position + 1, end)
 
-def write_offsets(offsets):
-    with open(OFFSET_OUTPUT,"w") as f:
-        json.dump(offsets,f)
+    if sys.byteorder != "little":
+        starts.byteswap()
+
+    with open(part_path, "wb") as f:
+        starts.tofile(f)
+
+    return len(starts)
+
+
+def scan_plain(path: str, size: int, out, workers: int) -> int:
+    """
+    Write the line starts of a plain file to `out`, scanning chunks of it on all cores.
 
-def make_offsets(target_file:str, batch_size:int):
-    offsets = []
+    :return: number of lines
+    """
+    chunks = [(start, min(start + LINE_INDEX_SCAN_CHUNK, size)) for start in range(0, size, LINE_INDEX_SCAN_CHUNK)]
+    part_paths = [f"{out.name}.part{i}" for i in range(len(chunks))]
+    args = [(path, start, end, part_path) for (start, end), part_path in zip(chunks, part_paths)]
+
+    try:
+        if len(chunks) > 1 and workers > 1:
+            with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+                counts = pool.starmap(scan_chunk, args)
+        else:
+            counts = [scan_chunk(*arg) for arg in args]
+
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, out)
+    finally:
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    return sum(counts)
+
+
+def scan_stream(path: str, out) -> tuple[int, int]:
+    """
+    Write the line starts of a compressed file's content to `out`, in one pass.
+
+    :return: number of lines, decompressed size
+    """
+    count = 0
     offset = 0
-    line_count = 0
+    pending = False
 
-    with open(target_file, "rb") as f:
-        for line in f:
-            if line_count % batch_size == 0:
-                offsets.append(offset)
+    with open_input(path) as f:
+        while block := f.read(LINE_INDEX_SCAN_CHUNK):
+            starts = array("Q")
+            # a newline at the very end of the previous block starts a line here
+            if pending:
+                starts.append(offset)
 
-            offset += len(line)
-            line_count += 1
+            find = block.find
+            position = find(b"\n")
+            while position != -1 and position + 1 < len(block):
+                starts.append(offset + position + 1)
+                position = find(b"\n", position + 1)
 
-    print("total lines", line_count)
+            pending = position != -1
+            offset += len(block)
+
+            if sys.byteorder != "little":
+                starts.byteswap()
+            starts.tofile(out)
+            count += len(starts)
+
+    return count, offset
+
+
+def build_line_index(target_file: str, workers: int | None = None) -> str:
+    """
+    Scan an input for line starts and write its line index, replacing it atomically.
+
+    :return: path of the index
+    """
+    index_path = get_line_index_path(target_file)
+    tmp_path = f"{index_path}.tmp"
+    size, mtime, digest = get_stamp(target_file)
+    workers = workers or os.cpu_count() or 1
+
+    with open(tmp_path, "wb") as out:
+        out.write(HEADER.pack(MAGIC, 0, 0, 0, b""))
+
+        if get_compression(target_file) is None:
+            # line 0 starts at 0, unless there is no line at all
+            if size > 0:
+                out.write((0).to_bytes(8, "little"))
+            count = scan_plain(target_file, size, out, workers) + (size > 0)
+            end = size
+        else:
+            out.write((0).to_bytes(8, "little"))
+            count, end = scan_stream(target_file, out)
+            count += 1
+            if end == 0:
+                # nothing after all, take the 0 back
+                out.seek(HEADER.size)
+                out.truncate()
+                count = 0
+
+        out.write(end.to_bytes(8, "little"))
+
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, count, size, mtime, digest))
+
+    os.replace(tmp_path, index_path)
+    print(f"Line index {index_path}: {count} lines")
+
+    return index_path
+
+
+class LineIndex:
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.size, self.mtime, self.digest = HEADER.unpack_from(self._mmap)
+        assert magic == MAGIC, f"{path} is not a line index"
+        assert sys.byteorder == "little", "line indexes are little-endian"
+
+        self._view = memoryview(self._mmap)
+        self._offsets = self._view[HEADER.size:HEADER.size + 8 * (self.count + 1)].cast("Q")
+
+    def __len__(self):
+        return self.count
+
+    def get_offset(self, line: int) -> int:
+        """
+        Byte position where `line` starts, or the end of the content for line == len(self).
+        """
+        return self._offsets[line]
+
+    def get_batch_offsets(self, batch_size: int) -> list[int]:
+        """
+        Start of every batch of `batch_size` lines.
+        """
+        return self._offsets[:self.count:batch_size].tolist()
+
+    def matches(self, target_file: str) -> bool:
+        """
+        Whether the index was built from `target_file` as it is now on disk.
+        """
+        stat = os.stat(target_file)
+        if (stat.st_size, stat.st_mtime_ns) != (self.size, self.mtime):
+            return False
+
+        return get_input_hash(target_file, stat.st_size) == self.digest
+
+    def close(self):
+        self._offsets.release()
+        self._view.release()
+        self._mmap.close()
+
+
+def open_line_index(target_file: str, force=False) -> LineIndex:
+    """
+    Line index of an input, built first if it is missing, stale or `force` is set.
+    """
+    index_path = get_line_index_path(target_file)
+
+    if not force and os.path.exists(index_path):
+        index = LineIndex(index_path)
+        if index.matches(target_file):
+            return index
+
+        index.close()
+        print(f"{index_path} does not match {target_file}, rebuilding")
+
+    return LineIndex(build_line_index(target_file))
 
-    return offsets
 
 def get_offsets(target_file:str, batch_size=10000, force=False) -> list[int]:
     """
     Make byte offsets for given batch size.
     e.g. if the batch size is 10k, it will give byte location for line 0, line 10k ...
+    The line index behind them is reused across runs and batch sizes, as long as the input is unchanged.
     :param
         batch_size: number, default 10000
         target_file: string, reference filename
+        force: rebuild the line index even if it matches
     :return: a list of byte offsets, denoting starting location of each batch
     """
+    index = open_line_index(target_file, force)
+    offsets = index.get_batch_offsets(batch_size)
+    print("total lines", len(index))
+    index.close()
 
-
-    if force or not os.path.exists(OFFSET_OUTPUT):
-        offsets = make_offsets(target_file, batch_size)
-        write_offsets(offsets)
-
-        return offsets
-
-    # if offset file already exists, use that unless forced not to
-    with open(OFFSET_OUTPUT, "rb") as offset_file:
-        loaded_offsets = json.load(offset_file)
-        return loaded_offsets
-
+    return offsets
@@ -0,0 +1,275 @@
+"""
+Per-stage timing and throughput.
+
+Every process keeps its own `Metrics` (see `get_metrics`), so workers record
+without locks across processes or extra round trips. Each stage gets a
+latency histogram plus the docs and bytes that went through it, next to plain
+counters like retries.
+
+At the end of a run the coordinator collects one snapshot per worker, keyed by
+host and pid (several from one worker, e.g. one per pool task, are added up),
+and `report_metrics` writes:
+
+- a JSON run report, `runs/<run_id>/metrics.json`, with merged stages and
+  every worker's own numbers
+- a Prometheus textfile `<METRICS_TEXTFILE_DIR>/rtx_<job>.prom`, if that env
+  var is set, for the node exporter's textfile collector
+"""
+
+import bisect
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from utils.constants import RUNS_DIR, METRICS_LATENCY_BUCKETS
+
+
+def new_stage() -> dict:
+    return {
+        "count": 0,
+        "seconds": 0.0,
+        "docs": 0,
+        "bytes": 0,
+        # per bucket, not cumulative; the last one is +Inf
+        "buckets": [0] * (len(METRICS_LATENCY_BUCKETS) + 1),
+    }
+
+
+class Metrics:
+    """
+    Stage histograms and counters of one process. Safe to share between threads.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.worker = f"{socket.gethostname()}:{self.pid}"
+
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a block. Fill in `docs` and `bytes` of the yielded dict to get throughput too.
+        """
+        sample = {"docs": 0, "bytes": 0}
+        start = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            self.observe(name, time.perf_counter() - start, sample["docs"], sample["bytes"])
+
+    def observe(self, name: str, seconds: float, docs=0, nbytes=0):
+        bucket = bisect.bisect_left(METRICS_LATENCY_BUCKETS, seconds)
+
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = new_stage()
+
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["docs"] += docs
+            stage["bytes"] += nbytes
+            stage["buckets"][bucket] += 1
+
+    def inc(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "worker": self.worker,
+                "stages": {name: {**stage, "buckets": list(stage["buckets"])} for name, stage in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+
+_metrics = None
+
+
+def get_metrics() -> Metrics:
+    """
+    Metrics of the current process, created on first use. A forked child starts from scratch.
+    """
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        _metrics = Metrics()
+
+    return _metrics
+
+
+def reset_metrics():
+    """
+    Start the current process over, for workers that outlive a run.
+    """
+    global _metrics
+    _metrics = None
+
+
+def get_metrics_snapshot(dask_worker=None) -> dict:
+    # signature fits dask's `client.run`
+    return get_metrics().snapshot()
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict:
+    stages = {}
+    counters = {}
+
+    for snapshot in snapshots:
+        for name, stage in snapshot["stages"].items():
+            merged = stages.setdefault(name, new_stage())
+            for key in ("count", "seconds", "docs", "bytes"):
+                merged[key] += stage[key]
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], stage["buckets"])]
+
+        for name, value in snapshot["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+
+    return {"stages": stages, "counters": counters}
+
+
+def combine_workers(snapshots: list[dict]) -> list[dict]:
+    """
+    One snapshot per worker, adding up the ones of a worker that sent several.
+    """
+    by_worker = {}
+    for snapshot in snapshots:
+        by_worker.setdefault(snapshot["worker"], []).append(snapshot)
+
+    return [{"worker": worker, **merge_snapshots(group)} for worker, group in by_worker.items()]
+
+
+def get_quantile(stage: dict, q: float) -> float | None:
+    """
+    Upper bound of the histogram bucket holding the q-quantile, None if it is in the +Inf bucket.
+    """
+    target = q * stage["count"]
+    seen = 0
+    for bound, count in zip(METRICS_LATENCY_BUCKETS, stage["buckets"]):
+        seen += count
+        if seen >= target:
+            return bound
+
+    return None
+
+
+def summarize_stage(stage: dict, wall_seconds: float) -> dict:
+    seconds = stage["seconds"]
+
+    return {
+        "count": stage["count"],
+        "seconds": round(seconds, 3),
+        "mean_seconds": round(seconds / stage["count"], 4) if stage["count"] else 0,
+        "p50_seconds": get_quantile(stage, 0.5),
+        "p95_seconds": get_quantile(stage, 0.95),
+        "p99_seconds": get_quantile(stage, 0.99),
+        "docs": stage["docs"],
+        "bytes": stage["bytes"],
+        # over time spent in the stage, summed across workers
+        "docs_per_sec": round(stage["docs"] / seconds, 1) if seconds else 0,
+        "bytes_per_sec": round(stage["bytes"] / seconds, 1) if seconds else 0,
+        # over the whole run
+        "docs_per_wall_sec": round(stage["docs"] / wall_seconds, 1) if wall_seconds else 0,
+        "buckets": dict(zip([*map(str, METRICS_LATENCY_BUCKETS), "+Inf"], stage["buckets"])),
+    }
+
+
+def build_report(job: str, run_id: str, snapshots: list[dict], wall_seconds: float) -> dict:
+    merged = merge_snapshots(snapshots)
+
+    return {
+        "job": job,
+        "run_id": run_id,
+        "finished_at": time.time(),
+        "wall_seconds": round(wall_seconds, 3),
+        "stages": {name: summarize_stage(stage, wall_seconds) for name, stage in merged["stages"].items()},
+        "counters": merged["counters"],
+        "workers": {
+            snapshot["worker"]: {
+                "stages": {name: {key: stage[key] for key in ("count", "seconds", "docs", "bytes")}
+                           for name, stage in snapshot["stages"].items()},
+                "counters": snapshot["counters"],
+            }
+            for snapshot in snapshots
+        },
+    }
+
+
+def format_prometheus(job: str, run_id: str, snapshots: list[dict], wall_seconds: float) -> str:
+    merged = merge_snapshots(snapshots)
+    labels = f'job="{job}"'
+    lines = []
+
+    lines.append("# HELP rtx_stage_seconds Time spent per call of a pipeline stage.")
+    lines.append("# TYPE rtx_stage_seconds histogram")
+    for name, stage in sorted(merged["stages"].items()):
+        cumulative = 0
+        for bound, count in zip([*map(str, METRICS_LATENCY_BUCKETS), "+Inf"], stage["buckets"]):
+            cumulative += count
+            lines.append(f'rtx_stage_seconds_bucket{{{labels},stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'rtx_stage_seconds_sum{{{labels},stage="{name}"}} {stage["seconds"]}')
+        lines.append(f'rtx_stage_seconds_count{{{labels},stage="{name}"}} {stage["count"]}')
+
+    for metric, key, help_text in (("rtx_stage_docs_total", "docs", "Docs through a pipeline stage."),
+                                   ("rtx_stage_bytes_total", "bytes", "Bytes through a pipeline stage.")):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, stage in sorted(merged["stages"].items()):
+            lines.append(f'{metric}{{{labels},stage="{name}"}} {stage[key]}')
+
+    lines.append("# HELP rtx_events_total Counted events, e.g. retries.")
+    lines.append("# TYPE rtx_events_total counter")
+    for name, value in sorted(merged["counters"].items()):
+        lines.append(f'rtx_events_total{{{labels},event="{name}"}} {value}')
+
+    lines.append("# HELP rtx_run_wall_seconds Wall time of the last run.")
+    lines.append("# TYPE rtx_run_wall_seconds gauge")
+    lines.append(f'rtx_run_wall_seconds{{{labels},run_id="{run_id}"}} {wall_seconds}')
+    lines.append("# HELP rtx_run_workers Workers that reported metrics in the last run.")
+    lines.append("# TYPE rtx_run_workers gauge")
+    lines.append(f'rtx_run_workers{{{labels}}} {len(snapshots)}')
+    lines.append("# HELP rtx_run_finished_timestamp_seconds When the last run finished.")
+    lines.append("# TYPE rtx_run_finished_timestamp_seconds gauge")
+    lines.append(f'rtx_run_finished_timestamp_seconds{{{labels}}} {time.time()}')
+
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path: str, content: str):
+    # the textfile collector must never see a half written file; it skips non-.prom names
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def print_stages(report: dict):
+    for name, stage in report["stages"].items():
+        print(f"{name:>16}: {stage['count']} calls, {stage['seconds']:.1f}s, mean {stage['mean_seconds']:.3f}s, "
+              f"p95 <= {stage['p95_seconds'] or '+Inf'}s, {stage['docs_per_sec']} docs/s, {stage['bytes_per_sec'] / 1e6:.1f} MB/s")
+
+
+def report_metrics(job: str, run_id: str, snapshots: list[dict], wall_seconds: float) -> dict:
+    """
+    Write the JSON run report and, if configured, the Prometheus textfile.
+    """
+    snapshots = combine_workers([snapshot for snapshot in snapshots if snapshot])
+    report = build_report(job, run_id, snapshots, wall_seconds)
+
+    run_dir = f"{RUNS_DIR}/{run_id}"
+    os.makedirs(run_dir, exist_ok=True)
+    write_atomic(f"{run_dir}/metrics.json", json.dumps(report, indent=2))
+
+    textfile_dir = os.getenv("METRICS_TEXTFILE_DIR")
+    if textfile_dir:
+        write_atomic(f"{textfile_dir}/rtx_{job}.prom", format_prometheus(job, run_id, snapshots, wall_seconds))
+
+    print_stages(report)
+
+    return report
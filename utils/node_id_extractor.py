@@ -1,45 +1,45 @@
 """
-cd utils
-python node_id_extractor.py
+python -m utils.node_id_extractor
 
+Reads ./nodes.jsonl and writes ./nodes_id.bin, see utils/node_ids.py for the format.
 """
 
 
 import json
 
-from benchmark import timeit
+from utils.benchmark import timeit
+from utils.constants import NODE_IDS_FILE
+from utils.node_ids import write_node_id_file, NodeIdFile
 
 
 def main():
     name = 'nodes'
 
     with timeit(f"extract {name} ids"):
-        ids = list(map(extract_id, get_line(name)))
-        write_locally(name, ids)
-        ids_loaded = read_in_ids(name)
-        assert len(ids_loaded) == len(ids)
+        count = write_locally(map(extract_id, get_line(name)))
+        ids_loaded = read_in_ids()
+        assert len(ids_loaded) == count
         print(f'Loaded {len(ids_loaded)} ids')
 
 
-def read_in_ids(name):
-    with open(f'../{name}_ids.json', 'rb') as f:
-        return json.load(f)
+def read_in_ids():
+    return NodeIdFile(NODE_IDS_FILE)
 
 
-def write_locally(name: str, ids: list[str]):
-    with open(f'../{name}_ids.json', 'w') as f:
-        json.dump(ids, f)
+def write_locally(ids) -> int:
+    # streamed, ids never sit in memory all at once
+    return write_node_id_file(NODE_IDS_FILE, ids)
 
 def extract_id(line: str) -> str:
     data = json.loads(line)
     return data["id"]
 
 def get_line(name: str):
-    with open(f'../{name}.jsonl', 'r') as f:
+    with open(f'./{name}.jsonl', 'r') as f:
         for line in f:
             yield line
 
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,166 @@
+"""
+Compact, memory-mappable node id list.
+
+Layout, all integers little-endian uint64:
+
+    header:  magic, number of ids n, blob size
+    blob:    utf-8 ids back to back, zero padded to 8 bytes
+    offsets: n + 1 positions into the blob, id i is blob[offsets[i]:offsets[i + 1]]
+
+Opening the file reads nothing but the header. Looking up a range touches only
+the offsets and blob pages of that range, and processes mapping the same file
+share its pages, so neither startup time nor per-process memory depend on how
+many ids the file holds.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+from typing import Iterable
+
+from utils import codec
+from utils.constants import NODE_IDS_FILE
+
+MAGIC = b"RTXNIDS1"
+HEADER = struct.Struct("<8sQQ")
+
+
+def write_node_id_file(path: str, ids: Iterable[str]) -> int:
+    """
+    Stream ids into a node id file, replacing it atomically.
+
+    :return: number of ids written
+    """
+    offsets = array("Q", [0])
+    position = 0
+    tmp_path = f"{path}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+
+        for node_id in ids:
+            data = node_id.encode()
+            f.write(data)
+            position += len(data)
+            offsets.append(position)
+
+        f.write(b"\0" * (-position % 8))
+
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        offsets.tofile(f)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(offsets) - 1, position))
+
+    os.replace(tmp_path, path)
+
+    return len(offsets) - 1
+
+
+class NodeIdFile:
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, blob_size = HEADER.unpack_from(self._mmap)
+        assert magic == MAGIC, f"{path} is not a node id file"
+        assert sys.byteorder == "little", "node id files are little-endian"
+
+        view = memoryview(self._mmap)
+        self._blob = view[HEADER.size:HEADER.size + blob_size]
+
+        offsets_start = HEADER.size + blob_size + (-blob_size % 8)
+        self._offsets = view[offsets_start:offsets_start + 8 * (self.count + 1)].cast("Q")
+
+    def __len__(self):
+        return self.count
+
+    def get(self, index: int) -> str:
+        return str(self._blob[self._offsets[index]:self._offsets[index + 1]], "utf-8")
+
+    def get_range(self, start: int, end: int) -> list[str]:
+        offsets = self._offsets
+        blob = self._blob
+
+        return [str(blob[offsets[i]:offsets[i + 1]], "utf-8") for i in range(start, end)]
+
+
+class NodeIds(Sequence):
+    """
+    A contiguous range of a node id file, usable like a list of ids.
+
+    Slicing decodes only the ids asked for. Pickles as (path, start, end), so
+    handing it to another process costs nothing and the process maps the file itself.
+    """
+
+    def __init__(self, path: str, start=0, end: int | None = None):
+        # absolute, so the view still resolves in a worker with another cwd
+        self.path = os.path.abspath(path)
+        self._file = NodeIdFile(path)
+        self.start = start
+        self.end = len(self._file) if end is None else min(end, len(self._file))
+
+    def __len__(self):
+        return max(0, self.end - self.start)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, "only contiguous slices"
+            return self._file.get_range(self.start + start, self.start + max(start, stop))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        return self._file.get(self.start + index)
+
+    def __iter__(self, chunk_size=10000):
+        for start in range(0, len(self), chunk_size):
+            yield from self[start:start + chunk_size]
+
+    def sub_range(self, start: int, end: int) -> "NodeIds":
+        return NodeIds(self.path, self.start + start, self.start + min(end, len(self)))
+
+    def __getstate__(self):
+        return self.path, self.start, self.end
+
+    def __setstate__(self, state):
+        self.path, self.start, self.end = state
+        self._file = NodeIdFile(self.path)
+
+
+def take_range(ids: Sequence[str], start: int, end: int) -> Sequence[str]:
+    """
+    ids[start:end], without reading anything when ids come from a node id file.
+    """
+    if isinstance(ids, NodeIds):
+        return ids.sub_range(start, end)
+
+    return ids[start:end]
+
+
+def get_default_node_id_file() -> str:
+    if os.path.exists(NODE_IDS_FILE):
+        return NODE_IDS_FILE
+
+    # what older extractors wrote
+    return "./nodes_id.json"
+
+
+def open_node_ids(path: str) -> Sequence[str]:
+    """
+    Node ids from a node id file, or from a json list for files made by older extractors.
+    """
+    if path.endswith(".json"):
+        with open(path, "rb") as f:
+            return codec.load(f)
+
+    return NodeIds(path)
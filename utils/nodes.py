@@ -1,17 +1,52 @@
-from elasticsearch import Elasticsearch
+from typing import Optional
+
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+
+from utils.cache import NodeCache
 from utils.constants import NODE_INDEX
-from utils.es import get_es_docs_using_ids
+from utils.es import get_es_docs_using_ids, async_get_es_docs_using_ids
+from utils.projection import get_node_fields
 
 
-def get_nodes_details(client: Elasticsearch, ids: list[str]) -> dict:
+def get_nodes_details(client: Elasticsearch, ids: list[str], cache: Optional[NodeCache] = None) -> dict:
     """
     Get source details for given list of ids of nodes
 
     :param client: an elasticsearch client
     :param ids: a list of ids of nodes
-    :return: dict, where keys are node ids and values are node details
+    :param cache: optional node cache, only ids missing from it are fetched from es
+    :return: dict, where keys are node ids and values are node details, limited to NODE_FIELDS if set
     """
-    # we generate a dict like {"NCBITaxon:2051579" : {...}} for fast accessing
-    details = get_es_docs_using_ids(client, NODE_INDEX, ids, return_id_dict=True)
+    fields = get_node_fields()
+
+    if cache is None:
+        # we generate a dict like {"NCBITaxon:2051579" : {...}} for fast accessing
+        return get_es_docs_using_ids(client, NODE_INDEX, ids, return_id_dict=True, source_includes=fields)
+
+    details, missing = cache.get_many(ids)
+
+    if missing:
+        fetched = get_es_docs_using_ids(client, NODE_INDEX, missing, return_id_dict=True, source_includes=fields)
+        cache.put_many(fetched)
+        details.update(fetched)
+
+    return details
+
+
+async def async_get_nodes_details(client: AsyncElasticsearch, ids: list[str], cache: Optional[NodeCache] = None) -> dict:
+    """
+    get_nodes_details on an async client.
+    """
+    fields = get_node_fields()
+
+    if cache is None:
+        return await async_get_es_docs_using_ids(client, NODE_INDEX, ids, return_id_dict=True, source_includes=fields)
+
+    details, missing = cache.get_many(ids)
+
+    if missing:
+        fetched = await async_get_es_docs_using_ids(client, NODE_INDEX, missing, return_id_dict=True, source_includes=fields)
+        cache.put_many(fetched)
+        details.update(fetched)
 
-    return details
\ No newline at end of file
+    return details
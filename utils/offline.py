@@ -0,0 +1,234 @@
+"""
+ES-free merge: joins a nodes dump and an edges dump locally into merged_edges.jsonl.
+
+Nodes that fit in memory are joined with a plain hash join. Otherwise both
+inputs are hash-partitioned on disk (grace hash join), the subject and object
+sides are resolved one partition at a time, and the results are merged back
+into input order.
+
+Like the online paths, the first of several edges with the same id wins and
+the others are dropped. The partitioned join finds them by partitioning edges
+on their id first, so memory stays bounded there too.
+"""
+
+import heapq
+import math
+import os
+import shutil
+import zlib
+from contextlib import ExitStack
+
+from utils import codec
+from utils.benchmark import timeit
+from utils.compression import open_input, get_input_size
+from utils.constants import TEMP_DIR, OFFLINE_MEMORY_LIMIT_MB, NODE_MEMORY_FACTOR
+from utils.projection import get_node_fields, project_source
+
+POSITIONS = ("subject", "object")
+
+
+def get_memory_limit() -> int:
+    return int(os.getenv("OFFLINE_MEMORY_LIMIT_MB", OFFLINE_MEMORY_LIMIT_MB)) * 1024 * 1024
+
+
+def estimate_memory(target_file: str) -> int:
+    """
+    Rough size of a jsonl file once loaded as python dicts, going by its decompressed size.
+    """
+    return get_input_size(target_file) * NODE_MEMORY_FACTOR
+
+
+def get_partition(_id: str, num_partitions: int) -> int:
+    # crc32 rather than hash() so partitions are stable across runs
+    return zlib.crc32(_id.encode()) % num_partitions
+
+
+def iter_lines(target_file: str):
+    with open_input(target_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def load_nodes(target_file: str) -> dict:
+    fields = get_node_fields()
+
+    nodes = {}
+    for line in iter_lines(target_file):
+        node = project_source(codec.loads(line), fields)
+        nodes[node["id"]] = node
+
+    return nodes
+
+
+def enrich_edge(edge: dict, nodes: dict, positions=POSITIONS) -> int:
+    """
+    Replace node ids in place with node details.
+
+    :return: number of node ids that could not be resolved
+    """
+    unresolved = 0
+    for position in positions:
+        if position not in edge:
+            continue
+
+        node = nodes.get(edge[position])
+        if node is None:
+            unresolved += 1
+            continue
+
+        edge[position] = node
+
+    return unresolved
+
+
+def offline_merge(nodes_file: str, edges_file: str, output_file: str, memory_limit: int | None = None):
+    if memory_limit is None:
+        memory_limit = get_memory_limit()
+
+    nodes_memory = estimate_memory(nodes_file)
+
+    if nodes_memory <= memory_limit:
+        with timeit("offline hash join"):
+            unresolved = hash_join(nodes_file, edges_file, output_file)
+    else:
+        edges_memory = estimate_memory(edges_file)
+        num_partitions = math.ceil(max(nodes_memory, edges_memory) / memory_limit) + 1
+
+        with timeit(f"offline partitioned join ({num_partitions} partitions)"):
+            unresolved = partitioned_join(nodes_file, edges_file, output_file, num_partitions)
+
+    if unresolved:
+        print(f"{unresolved} node references could not be resolved and were left as ids")
+
+
+def hash_join(nodes_file: str, edges_file: str, output_file: str) -> int:
+    nodes = load_nodes(nodes_file)
+    print(f"Loaded {len(nodes)} nodes")
+
+    unresolved = 0
+    seen = set()
+    with open(output_file, "w") as output:
+        for line in iter_lines(edges_file):
+            edge = codec.loads(line)
+            if edge["id"] in seen:
+                continue
+            seen.add(edge["id"])
+
+            unresolved += enrich_edge(edge, nodes)
+            output.write(codec.dumps_compat(edge) + "\n")
+
+    return unresolved
+
+
+def partitioned_join(nodes_file: str, edges_file: str, output_file: str, num_partitions: int) -> int:
+    work_dir = f"{TEMP_DIR}/offline"
+    os.makedirs(work_dir, exist_ok=True)
+
+    def path(name: str, partition: int):
+        return f"{work_dir}/{name}-{partition:04d}.jsonl"
+
+    def partition_records(records, name: str):
+        """
+        Write (partition, line) records into partition files named `name`.
+        """
+        with ExitStack() as stack:
+            files = [stack.enter_context(open(path(name, p), "wb")) for p in range(num_partitions)]
+            for partition, line in records:
+                files[partition].write(line + b"\n")
+
+    def get_edge_partition(edge: dict, position: str):
+        # edges without this side can go anywhere, they are passed through untouched
+        return get_partition(edge[position], num_partitions) if position in edge else 0
+
+    try:
+        # 1. partition nodes by id, with just the fields that get embedded
+        fields = get_node_fields()
+
+        def node_records():
+            for line in iter_lines(nodes_file):
+                if fields is None:
+                    yield get_partition(codec.loads(line)["id"], num_partitions), line
+                else:
+                    node = project_source(codec.loads(line), fields)
+                    yield get_partition(node["id"], num_partitions), codec.dumps(node)
+
+        partition_records(node_records(), "nodes")
+
+        # 2. partition edges by id, tagging each with its line number to restore order later
+        def edge_records():
+            for seq, line in enumerate(iter_lines(edges_file)):
+                yield get_partition(codec.loads(line)["id"], num_partitions), b"%d\t%s" % (seq, line)
+
+        partition_records(edge_records(), "edges")
+
+        # 3. drop all but the first of duplicated ids, re-partitioning by subject
+        def unique_records():
+            for p in range(num_partitions):
+                seen = set()
+                for record in sorted(iter_lines(path("edges", p)), key=get_seq):
+                    edge = codec.loads(record.split(b"\t", 1)[1])
+                    if edge["id"] in seen:
+                        continue
+                    seen.add(edge["id"])
+
+                    yield get_edge_partition(edge, "subject"), record
+
+                os.remove(path("edges", p))
+
+        partition_records(unique_records(), "subject")
+
+        # 4. resolve one side per pass, re-partitioning by the next side
+        unresolved = 0
+        next_names = {"subject": "object", "object": "joined"}
+
+        for position in POSITIONS:
+            next_name = next_names[position]
+
+            def joined_records():
+                nonlocal unresolved
+                for p in range(num_partitions):
+                    nodes = {}
+                    for line in iter_lines(path("nodes", p)):
+                        node = codec.loads(line)
+                        nodes[node["id"]] = node
+
+                    for record in iter_lines(path(position, p)):
+                        seq, line = record.split(b"\t", 1)
+                        edge = codec.loads(line)
+                        unresolved += enrich_edge(edge, nodes, positions=(position,))
+
+                        next_partition = get_edge_partition(edge, next_name) if next_name in POSITIONS else p
+                        # last pass writes what ends up in the output, so it has to match json.dumps
+                        if next_name in POSITIONS:
+                            yield next_partition, seq + b"\t" + codec.dumps(edge)
+                        else:
+                            yield next_partition, seq + b"\t" + codec.dumps_compat(edge).encode()
+
+                    os.remove(path(position, p))
+                    del nodes
+
+            partition_records(joined_records(), next_name)
+
+        # 5. sort each joined partition by line number, then merge them back into input order
+        for p in range(num_partitions):
+            records = sorted(iter_lines(path("joined", p)), key=get_seq)
+            with open(path("joined", p), "wb") as f:
+                for record in records:
+                    f.write(record + b"\n")
+            del records
+
+        with open(output_file, "wb") as output:
+            runs = [iter_lines(path("joined", p)) for p in range(num_partitions)]
+            for record in heapq.merge(*runs, key=get_seq):
+                output.write(record.split(b"\t", 1)[1] + b"\n")
+
+        return unresolved
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def get_seq(record: bytes) -> int:
+    return int(record.split(b"\t", 1)[0])
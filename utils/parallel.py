@@ -1,49 +1,87 @@
 import os
 from typing import Optional
 
-from dask import delayed
-from dask.distributed import Client, get_worker, LocalCluster, as_completed
-from elasticsearch import Elasticsearch
-
-from utils.constants import THREADS_PER_WORKER
-from utils.edges import process_edges
+from utils.bulk import AdaptiveBulkWriter, get_bulk_max_concurrency
+from utils.cache import make_node_cache, merge_cache_stats, print_cache_stats
+from utils.checkpoint import RunManifest
+from utils.constants import PIPELINE_GROUP_SIZE
+from utils.edges import process_edges, get_worker_memory_limit
+from utils.es import get_mget_concurrency, get_es_client
+from utils.executor import Executor, TaskFailure, get_worker_resource, get_worker_state, close_worker_loop
+from utils.metrics import get_metrics_snapshot
+from utils.pipeline import run_batch_group, group_batches
 from utils.writes import write_to_temp
 
 
-@delayed
-def delayed_task(es_url: str, target_file: str, index: int, start: int, end: Optional[int], is_prod=False) -> int:
-    worker = get_worker()
-    if not hasattr(worker, "es_client"):
-        worker.es_client = Elasticsearch(es_url)
+def run_batch(es_url: str, target_file: str, index: int, start: int, end: Optional[int], is_prod=False, edges_from_file=False, target_index: Optional[str] = None) -> int:
+    # one pooled connection per concurrent mget sub-request or bulk request
+    es_client = get_worker_resource("es_client", lambda: get_es_client(es_url, connections_per_node=max(get_mget_concurrency(), get_bulk_max_concurrency())))
+    node_cache = get_worker_resource("node_cache", make_node_cache)
+    bulk_writer = get_worker_resource("bulk_writer", lambda: AdaptiveBulkWriter(es_client)) if is_prod else None
 
-    num_processed = process_edges(worker.es_client, target_file, start, end, meta_index=index, is_prod=is_prod)
+    num_processed = process_edges(es_client, target_file, start, end, meta_index=index, is_prod=is_prod, node_cache=node_cache, edges_from_file=edges_from_file, bulk_writer=bulk_writer, target_index=target_index, memory_limit=get_worker_memory_limit())
     # write_to_temp(index, updated_edges)
 
     return num_processed
 
+def get_node_cache_stats() -> dict | None:
+    cache = get_worker_state().get("node_cache")
+    if cache is None:
+        return None
+
+    return cache.stats()
+
 def get_n_workers():
     return int(os.getenv("N_WORKERS", 10))
 
-def distribute_tasks(*, es_url: str, target_file:str, offsets: list[int], is_prod=False):
-    n_workers = get_n_workers()
-    print(f"starting {n_workers} workers with {THREADS_PER_WORKER}-thread each")
+def distribute_tasks(*, executor: Executor, es_url: str, target_file:str, offsets: list[int], is_prod=False, edges_from_file=False, manifest: Optional[RunManifest] = None, target_index: Optional[str] = None, engine="batch") -> list[dict]:
+    """
+    Run every batch not completed yet on the executor's workers, one task per batch,
+    or with the pipeline engine, one task per group of batches that a worker pipelines.
+    Batches that fail are left in `executor.failures` and out of the manifest, so a resume picks them up again.
+
+    :return: one metrics snapshot per worker process
+    """
+    # batches finished by an earlier attempt of this run
+    completed = manifest.get_completed("batch") if manifest is not None else set()
+    if completed:
+        print(f"Skipping {len(completed)} completed batches")
+
+    batches = [
+        (index, start, offsets[index + 1] if index + 1 < len(offsets) else None)
+        for index, start in enumerate(offsets)
+        if index not in completed
+    ]
+
+    def record(index: int, lines_processed: int):
+        if manifest is not None:
+            manifest.record({"batch": index, "lines": lines_processed})
 
-    cluster = LocalCluster(n_workers=n_workers, threads_per_worker=THREADS_PER_WORKER)
-    client = Client(cluster)
+    if engine == "pipeline":
+        tasks = {
+            # keyed by first and last batch index
+            (group[0][0], group[-1][0]): (es_url, target_file, group, is_prod, edges_from_file, target_index)
+            for group in group_batches(batches, executor.n_workers, PIPELINE_GROUP_SIZE)
+        }
 
-    tasks = []
+        for _, (done, failed) in executor.run_tasks(run_batch_group, tasks, label="batch groups", count=lambda result: sum(result[0].values()), unit="lines"):
+            for index, lines_processed in done.items():
+                record(index, lines_processed)
+            # failed batches of a group that went through count like failed tasks
+            executor.failures.extend(TaskFailure(index, error, None) for index, error in failed.items())
 
-    for index, start in enumerate(offsets):
-        tasks.append(delayed_task(es_url, target_file, index, start, offsets[index + 1] if index + 1 < len(offsets) else None, is_prod))
+        executor.run_on_workers(close_worker_loop)
+    else:
+        tasks = {index: (es_url, target_file, index, start, end, is_prod, edges_from_file, target_index) for index, start, end in batches}
 
-    futures = client.compute(tasks)
+        for index, lines_processed in executor.run_tasks(run_batch, tasks, label="batches", count=lambda lines: lines, unit="lines"):
+            record(index, lines_processed)
 
-    total_lines_processed = 0
-    for future in as_completed(futures):
-        lines_processed = future.result()
-        total_lines_processed += lines_processed
-        print(f"Total lines processed: {total_lines_processed}", end='\r', flush=True)
+    for failure in executor.failures:
+        print(f"batch {failure.key} failed on {failure.worker}: {failure.error}")
 
-    client.close()
+    cache_stats = executor.run_on_workers(get_node_cache_stats)
+    print_cache_stats(merge_cache_stats(list(cache_stats.values())))
 
-    # client.gather(futures)
+    # one snapshot per worker process
+    return list(executor.run_on_workers(get_metrics_snapshot).values())
@@ -0,0 +1,135 @@
+"""
+Pipelined batch engine for merge_index (`--engine pipeline`).
+
+A worker takes a group of batches and runs them through four stages, with a
+bounded queue between each pair:
+
+    read -> fetch (edge mget) -> enrich (node mget + transform) -> write (bulk or temp file)
+
+Every stage works on a different batch at the same time, so while one batch
+waits on es another is read, transformed or written, and a group moves at the
+pace of its slowest stage instead of the sum of all of them. Queues hold at
+most `PIPELINE_DEPTH` batches, which bounds how many are in memory per worker.
+
+Requests go through an `AsyncElasticsearch` client, kept with its event loop
+for the life of the worker. File reads and writes, and the bulk writer (which
+has its own threads), run in threads off the loop.
+"""
+
+import asyncio
+import os
+import traceback
+from typing import Optional
+
+from utils.bulk import AdaptiveBulkWriter, get_bulk_max_concurrency
+from utils.cache import make_node_cache
+from utils.constants import EDGE_INDEX, PIPELINE_DEPTH
+from utils.edges import load_edge_ids, load_edges_from_file, get_edge_node_ids, transform_edges, write_edges
+from utils.es import get_es_client, get_async_es_client, get_mget_concurrency, async_get_es_docs_using_ids
+from utils.executor import get_worker_resource
+from utils.metrics import get_metrics
+from utils.nodes import async_get_nodes_details
+
+# end of a queue
+DONE = None
+
+
+def get_pipeline_depth():
+    return int(os.getenv("PIPELINE_DEPTH", PIPELINE_DEPTH))
+
+
+async def run_stage(fn, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue], failed: dict):
+    """
+    Pass (batch index, data) items from inbox through fn to outbox, until DONE.
+    A batch that fails is dropped here and noted in `failed`, the rest keep going.
+    """
+    while (item := await inbox.get()) is not DONE:
+        index, data = item
+        try:
+            result = await fn(index, data)
+        except Exception as e:
+            traceback.print_exc()
+            failed[index] = repr(e)
+            continue
+
+        if outbox is not None:
+            await outbox.put((index, result))
+
+    if outbox is not None:
+        await outbox.put(DONE)
+
+
+async def process_batches(es_url: str, target_file: str, batches: list[tuple[int, int, Optional[int]]], is_prod=False, edges_from_file=False, target_index: Optional[str] = None) -> tuple[dict, dict]:
+    """
+    :param batches: (index, start, end) of every batch in the group
+    :return: lines processed per finished batch, error per failed batch
+    """
+    es_client = get_worker_resource("es_client", lambda: get_es_client(es_url, connections_per_node=max(get_mget_concurrency(), get_bulk_max_concurrency())))
+    # edge and node mgets of different batches are in flight at once
+    async_es_client = get_worker_resource("async_es_client", lambda: get_async_es_client(es_url, connections_per_node=2 * get_mget_concurrency()))
+    node_cache = get_worker_resource("node_cache", make_node_cache)
+    bulk_writer = get_worker_resource("bulk_writer", lambda: AdaptiveBulkWriter(es_client)) if is_prod else None
+
+    depth = get_pipeline_depth()
+    pending = asyncio.Queue()
+    read, fetched, enriched = (asyncio.Queue(maxsize=depth) for _ in range(3))
+    done = {}
+    failed = {}
+
+    for index, start, end in batches:
+        pending.put_nowait((index, (start, end)))
+    pending.put_nowait(DONE)
+
+    async def read_batch(index: int, span: tuple[int, Optional[int]]) -> list:
+        if edges_from_file:
+            return await asyncio.to_thread(load_edges_from_file, target_file, *span)
+
+        return await asyncio.to_thread(load_edge_ids, target_file, *span)
+
+    async def fetch_edges(index: int, loaded: list) -> list[dict]:
+        if edges_from_file:
+            return loaded
+
+        with get_metrics().stage("edge_mget") as sample:
+            edges = await async_get_es_docs_using_ids(async_es_client, EDGE_INDEX, loaded)
+            sample["docs"] = len(edges)
+
+        return edges
+
+    async def enrich_edges(index: int, edges: list[dict]) -> list:
+        node_ids = get_edge_node_ids(edges)
+
+        with get_metrics().stage("node_mget") as sample:
+            node_details = await async_get_nodes_details(async_es_client, node_ids, cache=node_cache)
+            sample["docs"] = len(node_ids)
+
+        return transform_edges(edges, node_details, is_prod, target_index)
+
+    async def write_batch(index: int, loaded: list):
+        await asyncio.to_thread(write_edges, es_client, loaded, index, is_prod, bulk_writer)
+        done[index] = len(loaded)
+
+    await asyncio.gather(
+        run_stage(read_batch, pending, read, failed),
+        run_stage(fetch_edges, read, fetched, failed),
+        run_stage(enrich_edges, fetched, enriched, failed),
+        run_stage(write_batch, enriched, None, failed),
+    )
+
+    return done, failed
+
+
+def run_batch_group(es_url: str, target_file: str, batches: list[tuple[int, int, Optional[int]]], is_prod=False, edges_from_file=False, target_index: Optional[str] = None) -> tuple[dict, dict]:
+    # one event loop per worker process, so its async client outlives single groups
+    loop = get_worker_resource("event_loop", asyncio.new_event_loop)
+
+    return loop.run_until_complete(process_batches(es_url, target_file, batches, is_prod, edges_from_file, target_index))
+
+
+def group_batches(batches: list[tuple[int, int, Optional[int]]], n_workers: int, max_group_size: int) -> list[list[tuple[int, int, Optional[int]]]]:
+    """
+    Cut batches into consecutive groups, small enough that every worker gets a few of them.
+    """
+    group_size = max(1, min(max_group_size, len(batches) // (2 * max(1, n_workers))))
+
+    return [batches[i:i + group_size] for i in range(0, len(batches), group_size)]
@@ -0,0 +1,96 @@
+"""
+Which node fields get embedded in merged edges.
+
+`NODE_FIELDS` is a comma separated list of field paths, like
+`id,name,category,publications`. Paths can be dotted (`attributes.value`) and
+each part can hold `*` wildcards, the same as es `_source_includes`. Naming
+a field keeps everything under it. `id` is always kept, queries on merged
+edges go through `subject.id` and `object.id`. Without `NODE_FIELDS` nodes
+are embedded whole.
+
+The same list drives the `_source_includes` of node mgets, the offline join,
+and the subject/object mapping of a new merged index, so fields left out are
+neither moved nor stored nor indexed.
+"""
+
+import os
+from fnmatch import fnmatchcase
+
+
+def get_node_fields() -> list[str] | None:
+    fields = [field.strip() for field in os.getenv("NODE_FIELDS", "").split(",") if field.strip()]
+    if not fields:
+        return None
+
+    if "id" not in fields:
+        fields.insert(0, "id")
+
+    return fields
+
+
+def split_paths(fields: list[str]) -> list[list[str]]:
+    return [field.split(".") for field in fields]
+
+
+def get_rests(key: str, paths: list[list[str]]) -> list[list[str]]:
+    """
+    What is left of the paths that go through `key`, an empty one meaning all of it.
+    """
+    return [path[1:] for path in paths if fnmatchcase(key, path[0])]
+
+
+def project_source(source: dict, fields: list[str] | None) -> dict:
+    """
+    A node `_source` cut down to `fields`, like es does for `_source_includes`.
+    """
+    if fields is None:
+        return source
+
+    return _project_source(source, split_paths(fields))
+
+
+def _project_source(source: dict, paths: list[list[str]]) -> dict:
+    projected = {}
+
+    for key, value in source.items():
+        rests = get_rests(key, paths)
+        if not rests:
+            continue
+
+        if any(not rest for rest in rests):
+            projected[key] = value
+        elif isinstance(value, dict):
+            if sub := _project_source(value, rests):
+                projected[key] = sub
+        elif isinstance(value, list):
+            if items := [sub for item in value if isinstance(item, dict) and (sub := _project_source(item, rests))]:
+                projected[key] = items
+
+    return projected
+
+
+def project_props(props: dict, fields: list[str] | None) -> dict:
+    """
+    Mapping properties cut down to `fields`.
+    """
+    if fields is None:
+        return props
+
+    return _project_props(props, split_paths(fields))
+
+
+def _project_props(props: dict, paths: list[list[str]]) -> dict:
+    projected = {}
+
+    for name, mapping in props.items():
+        rests = get_rests(name, paths)
+        if not rests:
+            continue
+
+        if any(not rest for rest in rests):
+            projected[name] = mapping
+        elif "properties" in mapping:
+            if sub := _project_props(mapping["properties"], rests):
+                projected[name] = {**mapping, "properties": sub}
+
+    return projected
@@ -1,23 +1,113 @@
 import glob
+import json
+import os
+import shutil
 
-from utils.constants import TEMP_DIR
+from utils.compression import get_output_compression, get_output_suffix, compress
+from utils.constants import TEMP_DIR, COPY_CHUNK_BYTES
 
 
-def write_to_temp(batch_id: int, edges: list[str]):
+def open_temp(batch_id: int, compression: str | None):
+    return open(f"{TEMP_DIR}/{batch_id:05d}.tmp.jsonl{get_output_suffix(compression)}", "wb")
+
+
+def append_to_temp(f, edges: list[str], compression: str | None) -> int:
+    """
+    Append serialized edges to an open temp file, as a gzip member or zstd frame of their own when compressed.
+
+    :return: bytes written
+    """
+    data = ("\n".join(edges) + '\n').encode()
+
+    return f.write(compress(data, compression))
+
+
+def write_to_temp(batch_id: int, edges: list[str]) -> int:
     """
-    Write serialized edges to a temporary file.
+    Write serialized edges to a temporary file, compressed if OUTPUT_COMPRESSION is set.
+    Each worker compresses its own batches, so compression runs in parallel.
+
+    :return: bytes written
+    """
+    compression = get_output_compression()
+
+    with open_temp(batch_id, compression) as f:
+        return append_to_temp(f, edges, compression)
+
+
+def append_file(output, filepath: str):
+    """
+    Append a file to an open unbuffered output, copying in the kernel where possible.
+    Nothing is ever read fully into memory.
     """
-    with open(f"{TEMP_DIR}/{batch_id:05d}.tmp.jsonl", "w") as f:
-        f.write("\n".join(edges) + '\n')
+    with open(filepath, "rb") as infile:
+        size = os.fstat(infile.fileno()).st_size
+        copied = 0
+
+        # both file offsets move along with copy_file_range, like with read/write
+        try:
+            while copied < size:
+                n = os.copy_file_range(infile.fileno(), output.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return
+        except (AttributeError, OSError):
+            # not on linux, or not supported between these filesystems
+            pass
+
+        infile.seek(copied)
+        shutil.copyfileobj(infile, output, COPY_CHUNK_BYTES)
+
+
+def get_temp_batch_id(filepath: str) -> int:
+    return int(os.path.basename(filepath).split('.')[0])
+
+
+def get_temp_files() -> list[str]:
+    # in batch order, names stop sorting as numbers past 99999 batches
+    return sorted(glob.glob(f"{TEMP_DIR}/*.tmp.jsonl{get_output_suffix(get_output_compression())}"), key=get_temp_batch_id)
+
 
 def stitch_temps(output_dir: str):
-    files = sorted(glob.glob(f"{TEMP_DIR}/*.tmp.jsonl"))
+    """
+    Concatenate temp files into merged_edges.jsonl. Compressed batches are
+    gzip members or zstd frames, which concatenate into one valid file.
+    """
+    files = get_temp_files()
     total = len(files)
+    suffix = get_output_suffix(get_output_compression())
 
-    with open(f'{output_dir}/merged_edges.jsonl', 'wb') as output:
+    with open(f'{output_dir}/merged_edges.jsonl{suffix}', 'wb', buffering=0) as output:
         for i, filepath in enumerate(files, 1):
-            with open(filepath, "rb") as infile:
-                output.write(infile.read())
+            append_file(output, filepath)
             print(f"\rStitched {i}/{total} files", end='', flush=True)
 
-    print("\nDone.")
\ No newline at end of file
+    print("\nDone.")
+
+
+def publish_shards(output_dir: str):
+    """
+    Move temp files into place as shards of the output, with a manifest listing them in order.
+    Renames only, no data is copied.
+    """
+    shard_dir = f'{output_dir}/merged_edges'
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.makedirs(shard_dir)
+
+    suffix = get_output_suffix(get_output_compression())
+
+    files = get_temp_files()
+    # wide enough for shard names to list in order too
+    width = max(5, len(str(get_temp_batch_id(files[-1])))) if files else 5
+
+    shards = []
+    for filepath in files:
+        name = f"part-{get_temp_batch_id(filepath):0{width}d}.jsonl{suffix}"
+        os.replace(filepath, f'{shard_dir}/{name}')
+        shards.append({"file": name, "bytes": os.path.getsize(f'{shard_dir}/{name}')})
+
+    with open(f'{shard_dir}/manifest.json', 'w') as f:
+        json.dump({"shards": shards}, f, indent=2)
+
+    print(f"Published {len(shards)} shards to {shard_dir}")